@@ -0,0 +1,149 @@
+"""
+Benchmarks the leaderboard against synthetic users.
+
+The in-memory part always runs: it builds a Leaderboard from N synthetic balances and measures top(), rank()
+and observe() latency, and the error of the approximate ranks against exact ones. With --mongo-uri it also
+fills a scratch database with N users and compares the per-request queries the leaderboard replaces
+(sort + limit, count_documents) with the leaderboard's refresh costs.
+
+    python benchmarks/leaderboard_benchmark.py --users 10000000
+    python benchmarks/leaderboard_benchmark.py --users 10000000 --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import bisect
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from leaderboard import Leaderboard, Leaderboards, value_bucket  # noqa: E402
+
+
+def synthetic_balances(count, seed):
+    # Most goblins have a few plunders, a few have very many: a heavy-tailed number of 100-gold plunders
+    rng = random.Random(seed)
+    return [int(rng.paretovariate(1.2)) * 100 for _ in range(count)]
+
+
+def timed(function, repeat):
+    """
+    Returns the median and 99th percentile latency of function in microseconds.
+    """
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1e6)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99)]
+
+
+def benchmark_in_memory(balances, seed):
+    print(f"In memory, {len(balances):,} users")
+    rng = random.Random(seed)
+    board = Leaderboard("balance")
+
+    started = time.perf_counter()
+    histogram = {}
+    for balance in balances:
+        bucket = value_bucket(balance)
+        count, lowest, highest = histogram.get(bucket, (0, balance, balance))
+        histogram[bucket] = (count + 1, min(lowest, balance), max(highest, balance))
+    board.load_histogram(histogram)
+    print(f"  histogram: {len(histogram)} buckets, built in {time.perf_counter() - started:.1f}s")
+
+    ranked = sorted(((balance, user_id) for user_id, balance in enumerate(balances, start=1)), reverse=True)
+    board.load_top([(user_id, balance) for balance, user_id in ranked[:board.size]])
+
+    median, p99 = timed(lambda: board.top(), 10000)
+    print(f"  top(10):   median {median:.1f}us, p99 {p99:.1f}us")
+
+    user_ids = [rng.randrange(1, len(balances) + 1) for _ in range(10000)]
+    calls = iter(user_ids)
+    median, p99 = timed(lambda: board.rank(user_id := next(calls), balances[user_id - 1]), len(user_ids))
+    print(f"  rank():    median {median:.1f}us, p99 {p99:.1f}us")
+
+    calls = iter(user_ids)
+    median, p99 = timed(lambda: board.observe(user_id := next(calls), balances[user_id - 1] + 100), len(user_ids))
+    print(f"  observe(): median {median:.1f}us, p99 {p99:.1f}us")
+
+    # Exact rank = 1 + users with a strictly higher balance
+    ascending = sorted(balances)
+    errors = []
+    for user_id in user_ids[:2000]:
+        balance = balances[user_id - 1]
+        exact = len(ascending) - bisect.bisect_right(ascending, balance) + 1
+        approximate, _ = board.rank(-user_id, balance)
+        errors.append(abs(approximate - exact) / len(balances))
+    errors.sort()
+    print(f"  rank error as a share of all users: median {statistics.median(errors):.4%}, "
+          f"p99 {errors[int(len(errors) * 0.99)]:.4%}, max {errors[-1]:.4%}")
+
+
+def benchmark_mongo(balances, mongo_uri, database, seed):
+    from pymongo import InsertOne
+    from db import UsersDb
+    from runtime import run_blocking
+
+    print(f"MongoDB {mongo_uri}/{database}, {len(balances):,} users")
+    rng = random.Random(seed)
+    users_db = UsersDb(mongo_uri, database, None, None, None)
+    collection = users_db.db["users"]
+
+    if collection.estimated_document_count() != len(balances):
+        collection.drop()
+        started = time.perf_counter()
+        for start in range(0, len(balances), 10000):
+            collection.bulk_write([
+                InsertOne({"_id": user_id, "balance": balance, "amount_of_referrals": balance // 5000})
+                for user_id, balance in enumerate(balances[start:start + 10000], start=start + 1)
+            ], ordered=False)
+        print(f"  inserted in {time.perf_counter() - started:.0f}s")
+
+    started = time.perf_counter()
+    run_blocking(users_db.ensure_indexes())
+    print(f"  indexes ready in {time.perf_counter() - started:.0f}s")
+
+    median, p99 = timed(lambda: list(collection.find({}, {"balance": 1}).sort("balance", -1).limit(10)), 200)
+    print(f"  per request sort+limit(10):       median {median / 1000:.2f}ms, p99 {p99 / 1000:.2f}ms")
+
+    values = [balances[rng.randrange(len(balances))] for _ in range(200)]
+    calls = iter(values)
+    median, p99 = timed(lambda: collection.count_documents({"balance": {"$gt": next(calls)}}), len(values))
+    print(f"  per request count_documents rank: median {median / 1000:.2f}ms, p99 {p99 / 1000:.2f}ms")
+
+    leaderboards = Leaderboards(users_db)
+    started = time.perf_counter()
+    run_blocking(leaderboards.refresh_top())
+    print(f"  leaderboard top refresh (both metrics): {(time.perf_counter() - started) * 1000:.1f}ms")
+    started = time.perf_counter()
+    run_blocking(leaderboards.rebuild_histograms())
+    print(f"  leaderboard histogram rebuild (both metrics): {time.perf_counter() - started:.1f}s")
+
+    calls = iter(values)
+    median, p99 = timed(lambda: leaderboards["balance"].rank(-1, next(calls)), len(values))
+    print(f"  leaderboard rank():               median {median:.1f}us, p99 {p99:.1f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mongo-uri", help="Also benchmark against this MongoDB; uses a scratch database.")
+    parser.add_argument("--database", default="leaderboard_benchmark")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    balances = synthetic_balances(args.users, args.seed)
+    print(f"Generated {args.users:,} balances in {time.perf_counter() - started:.0f}s")
+
+    benchmark_in_memory(balances, args.seed)
+    if args.mongo_uri:
+        benchmark_mongo(balances, args.mongo_uri, args.database, args.seed)
+
+
+if __name__ == "__main__":
+    main()
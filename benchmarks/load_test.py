@@ -0,0 +1,520 @@
+"""
+End-to-end load test: replays synthetic update streams through the bot's handlers.
+
+The handlers run exactly as in the threaded runtime (TeleBot + pymongo + run_blocking), against a fake Bot API
+server in a separate process and either a local mongod (--mongo-uri) or mongomock. Three phases are replayed:
+
+    signup  /start for every user, most of them through the invite link of an earlier user
+    menu    taps on every menu button and inline button, in every user's language
+    claims  bursts of claim_gold callbacks, each user tapping several times at once
+
+For every phase it reports throughput, and for every handler p50/p95/p99 latency, Mongo operations and Bot API
+calls per update. Results are stored as JSON under benchmarks/results, named after the commit, and --compare
+prints the difference to an earlier result.
+
+    python benchmarks/load_test.py --users 2000 --concurrency 16
+    python benchmarks/load_test.py --mongo-uri mongodb://localhost:27017 --compare benchmarks/results/<file>.json
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Handlers open images by relative path
+os.chdir(ROOT)
+
+import telebot  # noqa: E402
+from telebot import apihelper  # noqa: E402
+
+import db as users_db_module  # noqa: E402
+from handlers import register_handlers  # noqa: E402
+from jobs import JobScheduler  # noqa: E402
+from leaderboard import Leaderboards  # noqa: E402
+from localization import CATALOGS  # noqa: E402
+from media import MediaRegistry  # noqa: E402
+from membership import MembershipChecker  # noqa: E402
+from router import MENU_BUTTONS, route_callback  # noqa: E402
+from runtime import Blocking, BlockingCollection, Runtime, ThreadedTasks, run_blocking  # noqa: E402
+from throttle import UserThrottle  # noqa: E402
+
+BOT_TOKEN = "123456:LOAD-TEST"
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+# Inline buttons users tap in the menu phase, besides their language in the language picker
+MENU_CALLBACKS = ("top_balance", "top_amount_of_referrals", "reminders_off", "reminders_on", "initiation")
+
+# Share of signups that come through an invite link
+REFERRAL_SHARE = 0.8
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """
+    Answers Bot API requests with minimal valid results, after an optional delay standing in for Telegram.
+    """
+
+    # Keep-alive, so the bot's threads reuse their connections like they do with Telegram
+    protocol_version = "HTTP/1.1"
+    latency = 0
+    message_ids = itertools.count(1)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        body = json.dumps({"ok": True, "result": self._result(method, params)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _result(self, method, params):
+        chat_id = int(params.get("chat_id", 0))
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Load test", "username": "load_test_bot"}
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False,
+                                                 "first_name": "Goblin"}}
+        if method.startswith(("send", "edit")):
+            message = {"message_id": next(self.message_ids), "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "private"}}
+            if method == "sendPhoto":
+                message["photo"] = [{"file_id": "load-test-photo", "file_unique_id": "load-test-photo",
+                                     "width": 512, "height": 512}]
+            return message
+        return True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections of concurrent workers, which then retry after a second
+    request_queue_size = 1024
+
+
+def serve_fake_api(port, latency, ready):
+    FakeBotApi.latency = latency
+    server = FakeBotApiServer(("127.0.0.1", port), FakeBotApi)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+
+class OperationCounter:
+    """
+    Counts calls made through the Counting proxies, in total and on the current thread.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self):
+        with self._lock:
+            self.total += 1
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    @property
+    def on_this_thread(self):
+        return getattr(self._local, "count", 0)
+
+
+class Counting:
+    """
+    Proxies a pymongo collection or a Blocking bot, counting every method call. With a lock, calls are also
+    serialized, for targets that aren't thread-safe.
+    """
+
+    def __init__(self, target, counter, lock=None):
+        self._target = target
+        self._counter = counter
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._counter.add()
+            if self._lock is None:
+                return attribute(*args, **kwargs)
+            with self._lock:
+                result = attribute(*args, **kwargs)
+            return LockedCursor(result, self._lock) if name in BlockingCollection.CURSOR_METHODS else result
+
+        return call
+
+
+class LockedCursor:
+    """
+    A cursor of a Counting proxy with a lock: chained calls go to the cursor, which is read in one go under the
+    lock when iteration starts.
+    """
+
+    def __init__(self, cursor, lock):
+        self._cursor = cursor
+        self._lock = lock
+        self._documents = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._documents is None:
+            with self._lock:
+                self._documents = iter(list(self._cursor))
+        return next(self._documents)
+
+
+class AdmitAll:
+    """
+    Stands in for UserThrottle without --throttle, so the claims phase still hits the database concurrently.
+    """
+
+    def admit(self, user_id, action, key=None, now=None):
+        return True
+
+    def done(self, user_id, action, key=None):
+        pass
+
+    def cooldown(self, user_id, action, now=None):
+        return None
+
+    def set_cooldown(self, user_id, action, ready_at, answer):
+        pass
+
+    def forget_cooldowns(self, user_id):
+        pass
+
+
+def create_indexes_with_options(collection):
+    """
+    mongomock's create_indexes drops partialFilterExpression, which ensure_indexes then rejects; its
+    create_index keeps every option, so the IndexModels are created one at a time instead.
+    """
+    def create_indexes(indexes, session=None):
+        return [collection.create_index(list(index.document["key"].items()), session=session,
+                                        **{option: value for option, value in index.document.items()
+                                           if option != "key"})
+                for index in indexes]
+
+    collection.create_indexes = create_indexes
+    return collection
+
+
+def create_users_db(mongo_uri, database, mongo_ops):
+    lock = None
+    if mongo_uri:
+        users_db = users_db_module.UsersDb(mongo_uri, database, None, None, None)
+        users_db.client.drop_database(database)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Without --mongo-uri the load test needs mongomock: pip install mongomock")
+        with mock.patch.object(users_db_module, "MongoClient", mongomock.MongoClient):
+            users_db = users_db_module.UsersDb("mongodb://localhost", database, None, None, None)
+        # mongomock is not thread-safe
+        lock = threading.Lock()
+
+    for attribute in ("users_collection", "media_collection", "broadcasts_collection", "jobs_collection",
+                      "migrations_collection", "state_collection"):
+        collection = getattr(users_db, attribute)._target
+        if not mongo_uri:
+            collection = create_indexes_with_options(collection)
+        setattr(users_db, attribute, BlockingCollection(Counting(collection, mongo_ops, lock)))
+
+    run_blocking(users_db.ensure_indexes())
+    # The system document the handlers read quests and settings from
+    users_db.db["users"].insert_one({"_id": 0, "quest_types": []})
+    return users_db
+
+
+def message_update(update_id, user_id, language_code, text):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Goblin", "language_code": language_code},
+        **({"entities": [{"type": "bot_command", "offset": 0, "length": 6}]} if text.startswith("/start") else {}),
+    }}
+
+
+def callback_update(update_id, user_id, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": str(user_id), "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Goblin"},
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}},
+    }}
+
+
+class LoadTest:
+    def __init__(self, bot, users_db, mongo_ops, api_calls, concurrency, seed):
+        self.bot = bot
+        self.users_db = users_db
+        self.mongo_ops = mongo_ops
+        self.api_calls = api_calls
+        self.concurrency = concurrency
+        self.rng = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.languages = {}  # user_id -> language_code
+        self.samples = {}  # handler -> [(latency, mongo ops, api calls)]
+        self.phases = {}
+
+    def replay(self, phase, updates):
+        """
+        Processes (handler, update) pairs on concurrency threads and records per-handler latencies and counts.
+        """
+        work = queue.Queue()
+        for item in updates:
+            work.put(item)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    handler, update = work.get_nowait()
+                except queue.Empty:
+                    return
+                update = telebot.types.Update.de_json(update)
+                mongo_ops, api_calls = self.mongo_ops.on_this_thread, self.api_calls.on_this_thread
+                started = time.perf_counter()
+                self.bot.process_new_updates([update])
+                latency = time.perf_counter() - started
+                sample = (latency, self.mongo_ops.on_this_thread - mongo_ops, self.api_calls.on_this_thread - api_calls)
+                with lock:
+                    self.samples.setdefault(handler, []).append(sample)
+
+        count = work.qsize()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+
+        self.phases[phase] = {"updates": count, "seconds": round(seconds, 3),
+                              "updates_per_second": round(count / seconds, 1)}
+        print(f"  {phase}: {count} updates in {seconds:.1f}s, {count / seconds:.0f}/s")
+
+    def signup(self, users):
+        # Users join in waves; everyone invited by a referral link was invited by someone of an earlier wave
+        language_codes = CATALOGS.language_codes
+        user_ids = list(range(1, users + 1))
+        wave_start, wave_size = 0, max(1, users // 20)
+        joined = []
+
+        while wave_start < users:
+            wave = user_ids[wave_start:wave_start + wave_size]
+            # Read past the counting proxy, so the harness's own queries don't show up in the results
+            codes = {user["_id"]: user["referral_code"]
+                     for user in self.users_db.db["users"].find({"_id": {"$in": joined}}, {"referral_code": 1})}
+
+            updates = []
+            for user_id in wave:
+                self.languages[user_id] = self.rng.choice(language_codes)
+                text = "/start"
+                handler = "start"
+                if codes and self.rng.random() < REFERRAL_SHARE:
+                    text = f"/start {codes[self.rng.choice(joined)]}"
+                    handler = "start (referral)"
+                updates.append((handler, message_update(next(self.update_ids), user_id, self.languages[user_id],
+                                                        text)))
+            self.replay(f"signup wave {len(wave)} users", updates)
+
+            joined.extend(wave)
+            wave_start += wave_size
+            wave_size *= 2
+
+    def menu(self, taps):
+        # Every button in every language comes up, cycling through them in a random order
+        combinations = [(button_key, language_code) for button_key in MENU_BUTTONS
+                        for language_code in CATALOGS.language_codes]
+        combinations += [(data, None) for data in MENU_CALLBACKS]
+        users_by_language = {}
+        for user_id, language_code in self.languages.items():
+            users_by_language.setdefault(language_code, []).append(user_id)
+
+        updates = []
+        while len(updates) < taps:
+            self.rng.shuffle(combinations)
+            for key, language_code in combinations:
+                if language_code is None:
+                    user_id = self.rng.choice(list(self.languages))
+                    updates.append((route_callback(key), callback_update(next(self.update_ids), user_id, key)))
+                elif users_by_language.get(language_code):
+                    user_id = self.rng.choice(users_by_language[language_code])
+                    label = CATALOGS.catalog(language_code).label(key)
+                    updates.append((key, message_update(next(self.update_ids), user_id, language_code, label)))
+            # The language picker, choosing the language the user already has
+            for user_id in self.rng.sample(list(self.languages), min(len(self.languages), 5)):
+                updates.append(("language", callback_update(next(self.update_ids), user_id,
+                                                            self.languages[user_id])))
+        self.replay("menu", updates[:taps])
+
+    def claims(self, bursts, burst_users, taps_per_user):
+        updates = []
+        for _ in range(bursts):
+            for user_id in self.rng.sample(list(self.languages), min(burst_users, len(self.languages))):
+                updates.extend(("claim_gold", callback_update(next(self.update_ids), user_id, "claim_gold"))
+                               for _ in range(taps_per_user))
+        self.replay("claims", updates)
+
+    def report(self):
+        handlers = {}
+        for handler, samples in sorted(self.samples.items()):
+            latencies = sorted(latency for latency, _, _ in samples)
+            handlers[handler] = {
+                "count": len(samples),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "mongo_ops_per_update": round(sum(ops for _, ops, _ in samples) / len(samples), 2),
+                "api_calls_per_update": round(sum(calls for _, _, calls in samples) / len(samples), 2),
+            }
+        updates = sum(handler["count"] for handler in handlers.values())
+        return {"phases": self.phases, "handlers": handlers,
+                "mongo_ops_per_update": round(self.mongo_ops.total / updates, 2) if updates else 0}
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))]
+
+
+def print_report(result, baseline=None):
+    base_handlers = (baseline or {}).get("handlers", {})
+    print(f"\n{'handler':<22}{'count':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mongo/upd':>11}{'api/upd':>9}"
+          + ("   p95 vs baseline" if baseline else ""))
+    for name, handler in result["handlers"].items():
+        line = (f"{name:<22}{handler['count']:>7}{handler['p50_ms']:>9.2f}{handler['p95_ms']:>9.2f}"
+                f"{handler['p99_ms']:>9.2f}{handler['mongo_ops_per_update']:>11.2f}"
+                f"{handler['api_calls_per_update']:>9.2f}")
+        if name in base_handlers and base_handlers[name]["p95_ms"]:
+            line += f"   {handler['p95_ms'] / base_handlers[name]['p95_ms'] - 1:+.0%}"
+        print(line)
+
+    print(f"\nMongo operations per update: {result['mongo_ops_per_update']}")
+    for phase, stats in result["phases"].items():
+        line = f"{phase}: {stats['updates_per_second']} updates/s"
+        base_phase = (baseline or {}).get("phases", {}).get(phase)
+        if base_phase:
+            line += f" ({stats['updates_per_second'] / base_phase['updates_per_second'] - 1:+.0%} vs baseline)"
+        print(line)
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--menu-taps", type=int, default=5000)
+    parser.add_argument("--claim-bursts", type=int, default=5)
+    parser.add_argument("--burst-users", type=int, default=200)
+    parser.add_argument("--taps-per-user", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=16, help="Updates processed at once, like the "
+                        "TeleBot worker threads.")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="Delay of every fake Bot API call.")
+    parser.add_argument("--rate-limits", action="store_true", help="Send through the outbound scheduler with "
+                        "Telegram's limits; off by default, so the bot itself is measured.")
+    parser.add_argument("--throttle", action="store_true", help="Put the per-user throttle in front of the "
+                        "handlers; off by default, so every tap of a claim burst reaches them.")
+    parser.add_argument("--metrics", action="store_true", help="Install the metrics instrumentation, as "
+                        "METRICS_PORT does, to measure its overhead.")
+    parser.add_argument("--mongo-uri", help="A local mongod; its database is dropped first. Default: mongomock.")
+    parser.add_argument("--database", default="load_test")
+    parser.add_argument("--port", type=int, default=8081, help="Port of the fake Bot API server.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Where to store the result. Default: benchmarks/results/<time>-<commit>.json")
+    parser.add_argument("--compare", help="An earlier result to compare with.")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_fake_api, args=(args.port, args.api_latency_ms / 1000, ready),
+                                     daemon=True)
+    server.start()
+    ready.wait()
+    apihelper.API_URL = f"http://127.0.0.1:{args.port}/bot{{0}}/{{1}}"
+
+    mongo_ops, api_calls = OperationCounter(), OperationCounter()
+    users_db = create_users_db(args.mongo_uri, args.database, mongo_ops)
+
+    bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+    api = Blocking(bot)
+    if args.metrics:
+        from handlers import COMMAND_HANDLERS, TEXT_HANDLERS, CALLBACK_HANDLERS
+        from metrics import InstrumentedBot, instrument_db, instrument_handlers
+        instrument_handlers(COMMAND_HANDLERS, TEXT_HANDLERS, CALLBACK_HANDLERS)
+        instrument_db(users_db)
+        api = InstrumentedBot(api)
+    api = Counting(api, api_calls)
+    if args.rate_limits:
+        from outbound import RateLimitedBot, ThreadedSendScheduler
+        api = RateLimitedBot(api, ThreadedSendScheduler())
+    tasks = ThreadedTasks()
+    rt = Runtime(bot=api, db=users_db, media=MediaRegistry(users_db, api, BOT_TOKEN), tasks=tasks,
+                 membership=MembershipChecker(api, tasks, "-100123"), jobs=JobScheduler(users_db, tasks),
+                 leaderboards=Leaderboards(users_db), throttle=UserThrottle() if args.throttle else AdmitAll())
+    register_handlers(bot, rt, run_blocking)
+
+    print(f"Replaying against {args.mongo_uri or 'mongomock'}, {args.concurrency} concurrent updates")
+    load_test = LoadTest(bot, users_db, mongo_ops, api_calls, args.concurrency, args.seed)
+    load_test.signup(args.users)
+    load_test.menu(args.menu_taps)
+    load_test.claims(args.claim_bursts, args.burst_users, args.taps_per_user)
+    server.terminate()
+
+    result = {"commit": current_commit(), "time": datetime.now().isoformat(timespec="seconds"),
+              "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+              **load_test.report()}
+    if args.mongo_uri:
+        result["config"]["mongo_uri"] = "local mongod"
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nBaseline: {baseline['commit']} ({baseline['time']})")
+    print_report(result, baseline)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{result['time'].replace(':', '')}-{result['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(result, output_file, indent=2)
+    print(f"\nStored {output}")
+
+
+if __name__ == "__main__":
+    main()
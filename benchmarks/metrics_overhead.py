@@ -0,0 +1,68 @@
+"""
+Measures what the metrics instrumentation adds per call, and per update of a typical handler.
+
+    python benchmarks/metrics_overhead.py
+
+For the end-to-end difference, compare two load test runs:
+    python benchmarks/load_test.py --output /tmp/plain.json
+    python benchmarks/load_test.py --metrics --compare /tmp/plain.json
+"""
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import REGISTRY, Histogram, InstrumentedBot, Registry, _timed, DB_ERRORS  # noqa: E402
+from runtime import Blocking, run_blocking  # noqa: E402
+
+CALLS = 200000
+
+# Calls per update, from the load test: one handler, ~2.4 UsersDb calls and ~1.5 Bot API calls
+HANDLERS_PER_UPDATE = 1
+DB_CALLS_PER_UPDATE = 2.4
+API_CALLS_PER_UPDATE = 1.5
+
+
+class Target:
+    def send_message(self, chat_id, text):
+        return None
+
+
+async def get_user_data(user_id):
+    return None
+
+
+def per_call_us(statement):
+    return min(timeit.repeat(statement, number=CALLS, repeat=5)) / CALLS * 1e6
+
+
+def main():
+    histogram = Histogram("benchmark_seconds", "Benchmark.", ("method",), registry=Registry())
+    observe = per_call_us(lambda: histogram.observe(0.003, "get_user_data"))
+
+    timed = _timed(get_user_data, histogram, DB_ERRORS, "get_user_data")
+    plain_call = per_call_us(lambda: run_blocking(get_user_data(1)))
+    timed_call = per_call_us(lambda: run_blocking(timed(1)))
+
+    plain_bot, instrumented_bot = Blocking(Target()), InstrumentedBot(Blocking(Target()))
+    plain_api = per_call_us(lambda: run_blocking(plain_bot.send_message(1, "x")))
+    instrumented_api = per_call_us(lambda: run_blocking(instrumented_bot.send_message(1, "x")))
+
+    started = time.perf_counter()
+    REGISTRY.render()
+    render = (time.perf_counter() - started) * 1e3
+
+    wrapped = timed_call - plain_call
+    per_update = (HANDLERS_PER_UPDATE + DB_CALLS_PER_UPDATE) * wrapped + API_CALLS_PER_UPDATE * (
+        instrumented_api - plain_api)
+    print(f"Histogram.observe:            {observe:.2f}us")
+    print(f"Timed coroutine (handler/db): +{wrapped:.2f}us per call ({plain_call:.2f}us -> {timed_call:.2f}us)")
+    print(f"InstrumentedBot call:         +{instrumented_api - plain_api:.2f}us per call")
+    print(f"Per update (estimated):       +{per_update:.1f}us")
+    print(f"Rendering /metrics:           {render:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares migrating the users collection with one update_one per document, as the one-off scripts did, with the
+MigrationRunner's batched bulk_writes, unthrottled and throttled.
+
+Every run starts from N fresh legacy users (UUID referral codes, datetime twitter clicks) and runs the
+migrations in migrations.py. It reports users per second, Mongo operations per user and, for the runner, the
+latency of live reads before and during the migration.
+
+    python benchmarks/migration_benchmark.py --users 20000
+    python benchmarks/migration_benchmark.py --users 1000000 --mongo-uri mongodb://localhost:27017 --rate 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_test import OperationCounter, create_users_db  # noqa: E402
+from migrations import MIGRATIONS, MigrationRunner  # noqa: E402
+from runtime import ThreadedTasks, run_blocking  # noqa: E402
+
+
+def seed_legacy_users(users_db, count, seed):
+    rng = random.Random(seed)
+    now = datetime.now()
+    users = users_db.db["users"]
+    for start in range(1, count + 1, 10000):
+        users.insert_many([{
+            "_id": user_id,
+            "balance": rng.randrange(10000),
+            "referral_code": str(uuid.UUID(int=rng.getrandbits(128))),
+            "amount_of_referrals": 0,
+            "gold_per_pillage": 100,
+            "user_language": "en",
+            "last_time_twitter_link_clicked": now - timedelta(minutes=rng.randrange(10000))
+            if rng.random() < 0.5 else None,
+        } for user_id in range(start, min(count + 1, start + 10000))])
+
+
+def migrate_one_by_one(users_db):
+    """
+    What the one-off scripts did: read every user, write each one that needs a change on its own.
+    """
+    users = users_db.users_collection
+    for migration in MIGRATIONS:
+        for user_data in run_blocking(users.find({"_id": {"$gt": 0}, **migration.query},
+                                                 migration.projection).to_list(None)):
+            request = migration.update(user_data)
+            if request is not None:
+                # A bulk_write of one request is one round trip, like update_one
+                run_blocking(users.bulk_write([request]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=5000, help="Users per second of the throttled run.")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--mongo-uri", help="A local mongod; its database is dropped first. Default: mongomock.")
+    parser.add_argument("--database", default="migration_benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{args.users:,} legacy users, {len(MIGRATIONS)} migrations, {args.mongo_uri or 'mongomock'}")
+    for name, rate in (("update_one per user", None), ("runner, unthrottled", float("inf")),
+                       (f"runner, {args.rate:.0f} users/s", args.rate)):
+        mongo_ops = OperationCounter()
+        users_db = create_users_db(args.mongo_uri, args.database, mongo_ops)
+        seed_legacy_users(users_db, args.users, args.seed)
+        operations_before = mongo_ops.total
+
+        if rate is None:
+            started = time.perf_counter()
+            migrate_one_by_one(users_db)
+            seconds = time.perf_counter() - started
+            reports = []
+        else:
+            reports = run_blocking(MigrationRunner(users_db, ThreadedTasks(), rate=rate,
+                                                   batch_size=args.batch_size).run())
+            # Without the baseline latency measurement before every migration
+            seconds = sum(report.seconds for report in reports)
+
+        operations = mongo_ops.total - operations_before
+        print(f"  {name}: {seconds:.1f}s, {len(MIGRATIONS) * args.users / seconds:.0f} users/s over all "
+              f"migrations, {operations / args.users:.3f} Mongo operations per user")
+        for report in reports:
+            print(f"    {report.summary()}")
+
+
+if __name__ == "__main__":
+    main()
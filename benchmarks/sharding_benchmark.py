@@ -0,0 +1,133 @@
+"""
+Measures how update throughput scales with the number of shard worker processes, and checks that every chat's
+updates are still handled in order, also across adding and removing a worker mid-stream.
+
+Each update costs --work-ms of CPU in the worker, holding the GIL like the handlers' Python code does, so one
+process tops out at about 1000 / work-ms updates per second and more processes should add to that up to the
+number of cores.
+
+    python benchmarks/sharding_benchmark.py --workers 1 2 4 8
+"""
+import argparse
+import functools
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import multiprocessing  # noqa: E402
+import telebot  # noqa: E402
+
+from sharding import ShardedDispatcher  # noqa: E402
+
+
+class SyntheticWorker:
+    """
+    Burns work_ms of CPU per update and logs when it handled which update of which chat.
+    """
+
+    def __init__(self, work_ms, results, name, worker_count):
+        self.work = work_ms / 1000
+        self.results = results
+        self.log = []  # (chat_id, sequence, started, finished); time.monotonic is the same clock in every process
+
+    def process(self, update):
+        started = time.monotonic()
+        end = time.perf_counter() + self.work
+        while time.perf_counter() < end:
+            pass
+        self.log.append((update.message.chat.id, int(update.message.text), started, time.monotonic()))
+
+    def set_worker_count(self, worker_count):
+        pass
+
+    def close(self):
+        self.results.put(self.log)
+
+
+def count_out_of_order(log):
+    """
+    Counts updates that started before an earlier update of their chat, on any worker, had finished.
+    """
+    by_chat = {}
+    for chat_id, sequence, started, finished in log:
+        by_chat.setdefault(chat_id, []).append((sequence, started, finished))
+
+    out_of_order = 0
+    for entries in by_chat.values():
+        entries.sort()
+        for (_, _, previous_finished), (_, started, _) in zip(entries, entries[1:]):
+            if started < previous_finished:
+                out_of_order += 1
+    return out_of_order
+
+
+def make_updates(count, chats):
+    sequences = {}
+    updates = []
+    for update_id in range(count):
+        chat_id = update_id % chats + 1
+        sequences[chat_id] = sequences.get(chat_id, -1) + 1
+        updates.append(telebot.types.Update.de_json({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "text": str(sequences[chat_id]),
+            "chat": {"id": chat_id, "type": "private"}}}))
+    return updates
+
+
+def run(workers, updates, work_ms, rebalance):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    log = []
+    # A worker only exits once its log is through the pipe, so the logs are read while the workers are joined
+    collector = threading.Thread(target=lambda: [log.extend(results.get()) for _ in range(workers + rebalance)])
+    collector.start()
+    dispatcher = ShardedDispatcher(functools.partial(SyntheticWorker, work_ms, results), workers, context)
+    # Waits until every worker is up, so process start-up isn't measured
+    dispatcher.drain()
+
+    started = time.perf_counter()
+    if rebalance:
+        third = len(updates) // 3
+        dispatcher.process_new_updates(updates[:third])
+        dispatcher.add_worker()
+        dispatcher.process_new_updates(updates[third:2 * third])
+        dispatcher.remove_worker(dispatcher.worker_names[0])
+        dispatcher.process_new_updates(updates[2 * third:])
+    else:
+        dispatcher.process_new_updates(updates)
+    dispatcher.drain()
+    seconds = time.perf_counter() - started
+    dispatcher.stop()
+    collector.join()
+    return seconds, len(log), count_out_of_order(log)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--work-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    updates = make_updates(args.updates, args.chats)
+    print(f"{args.updates} updates over {args.chats} chats, {args.work_ms}ms of CPU each, {os.cpu_count()} cores")
+
+    baseline = None
+    for workers in sorted(set(args.workers)):
+        seconds, processed, out_of_order = run(workers, updates, args.work_ms, rebalance=False)
+        throughput = processed / seconds
+        baseline = baseline or throughput
+        print(f"  {workers:>2} workers: {throughput:8.0f} updates/s  x{throughput / baseline:.2f}  "
+              f"out of order: {out_of_order}")
+
+    workers = max(2, min(args.workers))
+    seconds, processed, out_of_order = run(workers, updates, args.work_ms, rebalance=True)
+    print(f"  {workers} workers, +1 and -1 mid-stream: {processed / seconds:.0f} updates/s, "
+          f"processed {processed}/{args.updates}, out of order: {out_of_order}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compares reading user documents as dicts with reading them as projected User records.
+
+Synthetic documents look like production ones: every field create_user writes, referrer paths of invited
+users, gang counters and the plunder reminder bucket. For a full document, the User.FIELDS projection and the
+one-field projection the helpers now ask for (user_language), it reports the BSON size on the wire, the time to
+decode it (bson.decode, as pymongo does, plus building the record) and the memory each decoded user keeps
+alive.
+
+    python benchmarks/user_model_benchmark.py --users 100000
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bson  # noqa: E402
+
+from models import User  # noqa: E402
+
+
+def synthetic_documents(count, seed):
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1)
+    documents = []
+    for user_id in range(1, count + 1):
+        invited = user_id > 10 and rng.random() < 0.7
+        document = {
+            "_id": 10 ** 9 + user_id,
+            "balance": int(rng.paretovariate(1.2)) * 100,
+            "referral_code": "".join(rng.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=8)),
+            "amount_of_referrals": int(rng.paretovariate(2)) - 1,
+            "gold_per_pillage": 100,
+            "last_time_pillage_claimed": now.timestamp() - rng.uniform(0, 86400),
+            "last_time_daily_quest_completed": now - timedelta(hours=rng.uniform(0, 72)) if rng.random() < 0.5
+            else None,
+            "user_language": rng.choice(("en", "ru")),
+            "subscribe_channel_quest_time": None,
+            "start_another_bot_quest_time": None,
+            "last_time_twitter_link_clicked": now.timestamp() - rng.uniform(0, 3 * 86400) if rng.random() < 0.5
+            else None,
+            "gang_level_2": rng.randrange(5),
+            "gang_total": rng.randrange(20),
+            "plunder_ready_bucket": rng.randrange(10 ** 7),
+        }
+        if invited:
+            path = [10 ** 9 + rng.randrange(1, user_id) for _ in range(rng.randrange(1, 12))]
+            document["referrer_id"] = path[0]
+            document["referrer_path"] = path
+        documents.append(document)
+    return documents
+
+
+def project(document, fields):
+    return {"_id": document["_id"], **{field: document[field] for field in fields if field in document}}
+
+
+def per_user_us(function, items, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - started)
+    return best / len(items) * 1e6
+
+
+def retained_bytes(build, items):
+    gc.collect()
+    tracemalloc.start()
+    kept = [build(item) for item in items]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / len(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    documents = synthetic_documents(args.users, args.seed)
+    print(f"{args.users:,} synthetic users")
+    print(f"{'read':<34}{'bytes/doc':>10}{'decode us':>11}{'kept bytes':>12}")
+
+    variants = [
+        ("full document as dict", None, False),
+        ("User.FIELDS as dict", User.FIELDS, False),
+        ("User.FIELDS as User", User.FIELDS, True),
+        ("user_language as dict", ("user_language",), False),
+        ("user_language as User", ("user_language",), True),
+    ]
+    for name, fields, as_record in variants:
+        encoded = [bson.encode(document if fields is None else project(document, fields)) for document in documents]
+        if as_record:
+            decode = lambda raw, fields=fields: User.from_document(bson.decode(raw), fields)
+        else:
+            decode = bson.decode
+        wire = sum(map(len, encoded)) / len(encoded)
+        print(f"{name:<34}{wire:>10.0f}{per_user_us(decode, encoded):>11.2f}{retained_bytes(decode, encoded):>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
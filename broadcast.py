@@ -0,0 +1,152 @@
+import logging
+import os
+import socket
+import sys
+from localization import CATALOGS
+from outbound import BULK
+from runtime import ApiTelegramException
+from utils import render_message
+
+
+logger = logging.getLogger(__name__)
+
+# Users read, messaged and checkpointed at once
+BROADCAST_BATCH_SIZE = 500
+
+# How long a replica owns a broadcast without checkpointing before another one may take it over
+LEASE_SECONDS = 600
+
+# Seconds between looks for a new broadcast when there is none
+POLL_INTERVAL = 30
+
+
+def classify_delivery_error(error):
+    """
+    Maps a failed send to the delivery_status stored on the user.
+
+    Returns:
+        "blocked" or "deactivated" for users that can't be reached until they come back, "failed" otherwise.
+    """
+    description = str(error.description).lower()
+
+    if error.error_code == 403 and "blocked" in description:
+        return "blocked"
+    if error.error_code == 403 and "deactivated" in description:
+        return "deactivated"
+    if error.error_code == 400 and "chat not found" in description:
+        return "deactivated"
+    return "failed"
+
+
+def validate_broadcast(message_key, message_kwargs):
+    """
+    Renders a broadcast in every language, so a message that doesn't exist or needs other placeholders than
+    message_kwargs is rejected when it is queued instead of failing for every recipient.
+
+    Raises:
+        ValueError: If the message can't be rendered in one of the languages.
+    """
+    if message_key not in CATALOGS.default:
+        raise ValueError(f"Unknown message key {message_key!r}.")
+
+    for language_code in CATALOGS.language_codes:
+        try:
+            render_message(language_code, message_key, **message_kwargs)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"{message_key} can't be rendered in {language_code} with "
+                             f"{sorted(message_kwargs)}: {e!r}") from e
+
+
+async def queue_broadcast(db, message_key, message_kwargs):
+    """
+    Validates a broadcast and queues it for run_broadcasts.
+
+    Returns:
+        The id of the broadcast.
+    """
+    validate_broadcast(message_key, message_kwargs)
+    return await db.create_broadcast(message_key, message_kwargs)
+
+
+async def _deliver(bot, broadcast, recipient):
+    try:
+        text = render_message(recipient.get("user_language", "en"), broadcast["message_key"],
+                              **broadcast["message_kwargs"])
+        await bot.send_message(recipient["_id"], text, parse_mode="HTML")
+        return None
+    except ApiTelegramException as e:
+        return classify_delivery_error(e)
+    except Exception:
+        # Fails this recipient only; raising would abort the batch, and the retried broadcast would fail again
+        logger.exception("Sending broadcast %s to user %s failed", broadcast["_id"], recipient["_id"])
+        return "failed"
+
+
+async def run_broadcast(rt, broadcast, owner):
+    """
+    Sends a broadcast to every reachable user, resuming after the last checkpoint.
+
+    Users are read in _id order, one batch at a time, so memory stays flat however many users there are.
+    Sends go through the BULK lane of the outbound scheduler, i.e. as fast as the rate limits allow without
+    delaying interactive replies. A batch is checkpointed once it is sent; a crash in the middle of a batch
+    sends that batch again, so delivery is at least once.
+    """
+    bot = rt.bot.with_priority(BULK)
+    last_user_id = broadcast["last_user_id"]
+
+    while True:
+        recipients = await rt.db.get_broadcast_recipients(last_user_id, BROADCAST_BATCH_SIZE)
+        if not recipients:
+            break
+
+        results = await rt.tasks.gather(*[_deliver(bot, broadcast, recipient) for recipient in recipients])
+        delivery_statuses = {recipient["_id"]: status
+                             for recipient, status in zip(recipients, results) if status is not None}
+        last_user_id = recipients[-1]["_id"]
+
+        if not await rt.db.record_broadcast_batch(broadcast["_id"], owner, last_user_id,
+                                                  len(recipients) - len(delivery_statuses), delivery_statuses,
+                                                  LEASE_SECONDS):
+            logger.warning("Broadcast %s was taken over by another replica, stopping", broadcast["_id"])
+            return
+
+    await rt.db.finish_broadcast(broadcast["_id"], owner)
+    logger.info("Broadcast %s finished", broadcast["_id"])
+
+
+async def run_broadcasts(rt):
+    """
+    Background job that picks up pending broadcasts, and broadcasts left behind by a stopped replica, one at a time.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    while True:
+        broadcast = await rt.db.acquire_broadcast(owner, LEASE_SECONDS)
+        if broadcast is None:
+            await rt.tasks.sleep(POLL_INTERVAL)
+            continue
+
+        logger.info("Sending broadcast %s (%s) from user %s", broadcast["_id"], broadcast["message_key"],
+                    broadcast["last_user_id"])
+        try:
+            await run_broadcast(rt, broadcast, owner)
+        except Exception:
+            # The lease runs out and the broadcast resumes from its last checkpoint
+            logger.exception("Broadcast %s failed", broadcast["_id"])
+            await rt.tasks.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    # Queues a broadcast for the running bot: python broadcast.py <message_key> [name=value ...]
+    from main import create_users_db
+    from runtime import run_blocking
+
+    if len(sys.argv) < 2 or any("=" not in argument for argument in sys.argv[2:]):
+        sys.exit("Usage: python broadcast.py <message_key from languages.py> [name=value ...]")
+
+    message_kwargs = dict(argument.split("=", 1) for argument in sys.argv[2:])
+    try:
+        broadcast_id = run_blocking(queue_broadcast(create_users_db("pymongo"), sys.argv[1], message_kwargs))
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f"Queued broadcast {broadcast_id}")
@@ -15,5 +15,34 @@ MONGO_USERNAME = os.getenv('MONGO_USERNAME')
 MONGO_PASSWORD = os.getenv('MONGO_PASSWORD')
 MONGO_AUTH_SOURCE = os.getenv('MONGO_AUTH_SOURCE')
 
+# "threaded" (TeleBot + pymongo) or "asyncio" (AsyncTeleBot + motor)
+RUNTIME_MODE = os.getenv('RUNTIME_MODE', 'threaded')
 
+# Worker processes that share the updates by chat id (threaded runtime); 0 runs everything in one process
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '0'))
 
+# "polling" (development) or "webhook"
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'polling')
+# Public URL registered with setWebhook; leave empty if the webhook is registered elsewhere
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+
+# Seconds between flushes of buffered non-critical user fields (language, quest times); 0 writes them immediately
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', '0'))
+# Users with buffered updates that trigger a flush before the interval is up
+WRITE_BEHIND_MAX_USERS = int(os.getenv('WRITE_BEHIND_MAX_USERS', '1000'))
+
+# Port of the Prometheus /metrics endpoint and the sampling profiler controls; 0 disables metrics entirely.
+# Only loopback by default: set METRICS_HOST=0.0.0.0 for a scraper on another host, and keep the port off the
+# public internet. The profiler controls answer loopback clients only either way
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+
+# Per-user throttle overrides, "action=rate/burst/collapse_window" comma separated (e.g. "claim_gold=0.5/3/2");
+# actions are menu button keys, callback actions and "start"
+THROTTLE_LIMITS = os.getenv('THROTTLE_LIMITS', '')
+# Users the throttle remembers before evicting the least recently active
+THROTTLE_MAX_USERS = int(os.getenv('THROTTLE_MAX_USERS', '100000'))
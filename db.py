@@ -1,18 +1,273 @@
-import uuid
-from pymongo import MongoClient
+import asyncio
+import secrets
+import string
+import threading
+import time
+from datetime import datetime
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING, IndexModel, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import logging
+from models import User
+from runtime import BlockingCollection, BlockingLock
+
+
+# Every field the handlers and utils helpers read from a user document
+USER_PROJECTION = dict.fromkeys(User.FIELDS, 1)
+
+# Fields update_user_data may buffer in the write-behind layer: losing a few seconds of them in a crash is harmless
+WRITE_BEHIND_FIELDS = frozenset({
+    "user_language",
+    "last_time_twitter_link_clicked",
+    "last_time_daily_quest_completed",
+    "subscribe_channel_quest_time",
+    "start_another_bot_quest_time",
+})
+
+# delivery_status values of users that broadcasts skip until they /start the bot again
+UNREACHABLE_STATUSES = ["blocked", "deactivated"]
+
+
+REFERRAL_CODE_ALPHABET = string.digits + string.ascii_letters
+# 62^8 ≈ 2.2e14 codes, so collisions (handled on insert anyway) stay rare for any realistic user count
+REFERRAL_CODE_LENGTH = 8
+REFERRAL_CODE_ATTEMPTS = 5
+
+USERS_INDEXES = [
+    # The system document (_id: 0) has no referral code, so only string codes take part in the unique index
+    IndexModel([("referral_code", ASCENDING)], name="referral_code_unique", unique=True,
+               partialFilterExpression={"referral_code": {"$type": "string"}}),
+    # UUID codes replaced by the compact_referral_codes migration, kept so old invite links keep working
+    IndexModel([("legacy_referral_code", ASCENDING)], name="legacy_referral_code", sparse=True),
+    # Only users waiting for a plunder reminder have the field, so the index holds just them
+    IndexModel([("plunder_ready_bucket", ASCENDING)], name="plunder_ready_bucket", sparse=True),
+    # Leaderboard tops are read off these in index order
+    IndexModel([("balance", DESCENDING)], name="balance_desc"),
+    IndexModel([("amount_of_referrals", DESCENDING)], name="amount_of_referrals_desc"),
+    # Users who joined through an invite link, by who invited them
+    IndexModel([("referrer_id", ASCENDING)], name="referrer_id", sparse=True),
+]
+
+# Referral levels counted in gang_total; also the length limit of a user's referrer_path
+GANG_MAX_DEPTH = 32
+
+# Seconds the system document (_id: 0) is served from memory before it is read again
+COMMON_DATA_TTL = 10
+
+# Width of the plunder_ready_bucket time buckets: a reminder goes out at most this long after the cooldown ends
+PLUNDER_REMINDER_BUCKET_SECONDS = 60
+
+# Index options ensure_indexes verifies, as they change which documents an index holds or keeps unique;
+# the booleans default to False when absent
+VERIFIED_INDEX_OPTIONS = {"unique": False, "sparse": False, "partialFilterExpression": None,
+                          "expireAfterSeconds": None}
+
+JOBS_INDEXES = [
+    # Due pending jobs and running jobs with an expired lease are found by the scheduler's poll
+    IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+    IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease_until"),
+]
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces $set updates of WRITE_BEHIND_FIELDS per user and writes them with one bulk_write.
+
+    Buffered values are flushed when max_users users have pending updates, every flush_interval seconds (see
+    run) and on close. Flushes are serialized, and UsersDb flushes a user's buffered values before writing to
+    that user directly, so writes to one user always reach the database in the order they were made.
+    """
+
+    def __init__(self, collection, flush_lock, max_users=1000, flush_interval=2.0):
+        self.collection = collection
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self._pending = {}  # user_id -> {field: value}
+        self._in_flight = {}  # the batch being written by the current flush
+        # Only held for dict operations, never across an await, so it works in both runtimes
+        self._buffer_lock = threading.Lock()
+        # Held across the bulk_write; a BlockingLock or an asyncio.Lock depending on the driver
+        self._flush_lock = flush_lock
+
+    def accepts(self, update_data):
+        return update_data.keys() <= WRITE_BEHIND_FIELDS
+
+    def pending_users(self):
+        return len(self._pending)
+
+    def has_pending(self, user_id):
+        return user_id in self._pending or user_id in self._in_flight
+
+    def pending(self, user_id):
+        """
+        Returns the values buffered for a user that may not be in the database yet, newest winning.
+        """
+        with self._buffer_lock:
+            return {**self._in_flight.get(user_id, {}), **self._pending.get(user_id, {})}
+
+    async def write(self, user_id, update_data):
+        with self._buffer_lock:
+            self._pending.setdefault(user_id, {}).update(update_data)
+            full = len(self._pending) >= self.max_users
+
+        if full:
+            await self.flush()
+
+    async def flush(self, user_id=None):
+        """
+        Writes the buffered values, of all users or of one user, and waits for a flush already in progress.
+        """
+        if user_id is not None and not self.has_pending(user_id):
+            return
+
+        async with self._flush_lock:
+            with self._buffer_lock:
+                if user_id is None:
+                    self._in_flight, self._pending = self._pending, {}
+                elif user_id in self._pending:
+                    self._in_flight = {user_id: self._pending.pop(user_id)}
+
+            if not self._in_flight:
+                return
+
+            try:
+                await self.collection.bulk_write([UpdateOne({"_id": buffered_user_id}, {"$set": update_data})
+                                                  for buffered_user_id, update_data in self._in_flight.items()],
+                                                 ordered=False)
+            except Exception:
+                # $set is idempotent, so the whole batch goes back under anything buffered since
+                with self._buffer_lock:
+                    for buffered_user_id, update_data in self._in_flight.items():
+                        self._pending[buffered_user_id] = {**update_data, **self._pending.get(buffered_user_id, {})}
+                raise
+            finally:
+                with self._buffer_lock:
+                    self._in_flight = {}
+
+    async def run(self, tasks):
+        """
+        Background job that flushes the buffer every flush_interval seconds.
+        """
+        while True:
+            await tasks.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Write-behind flush failed, retrying in %ss.", self.flush_interval)
 
 
 class UsersDb:
-    def __init__(self, mongo_uri, mongo_database, username, password, authSource):
-        self.client = MongoClient(mongo_uri, username=username, password=password, authSource=authSource)
+    """
+    Data access for the users collection.
+
+    All methods are coroutines. With driver="motor" they run on asyncio; with the default "pymongo" driver the
+    collections are wrapped in BlockingCollection, so the same methods run on a plain thread via run_blocking.
+    """
+
+    def __init__(self, mongo_uri, mongo_database, username, password, authSource, driver="pymongo",
+                 write_behind_interval=0, write_behind_max_users=1000):
+        if driver == "motor":
+            # Only needed by the asyncio runtime
+            from motor.motor_asyncio import AsyncIOMotorClient
+
+            self.client = AsyncIOMotorClient(mongo_uri, username=username, password=password, authSource=authSource)
+            collection = lambda name: self.db[name]
+        else:
+            self.client = MongoClient(mongo_uri, username=username, password=password, authSource=authSource)
+            collection = lambda name: BlockingCollection(self.db[name])
+
         self.db = self.client[mongo_database]
-        self.users_collection = self.db["users"]
+        self.users_collection = collection("users")
+        self.media_collection = collection("media")
+        self.broadcasts_collection = collection("broadcasts")
+        self.jobs_collection = collection("jobs")
+        self.migrations_collection = collection("migrations")
+        self.state_collection = collection("state")
 
-    def user_exists(self, user_id):
-        return self.users_collection.find_one({"_id": user_id}) is not None
+        # Called as listener(user_id, {field: new value}) after balance and referral count changes
+        self._change_listeners = []
 
-    def create_user(self, user_id, user_language='en'):
+        # The cached system document and the time.monotonic() until which it is served without a check
+        self._common_data = None
+        self._common_data_expires = 0
+
+        # Disabled (every update_user_data is written immediately) unless an interval is given
+        self.write_behind = None
+        if write_behind_interval:
+            self.write_behind = WriteBehindBuffer(self.users_collection,
+                                                  asyncio.Lock() if driver == "motor" else BlockingLock(),
+                                                  write_behind_max_users, write_behind_interval)
+
+    async def close(self):
+        """
+        Flushes the write-behind buffer and closes the connection.
+        """
+        if self.write_behind:
+            await self.write_behind.flush()
+        self.client.close()
+
+    def add_change_listener(self, listener):
+        self._change_listeners.append(listener)
+
+    def _notify(self, user_id, changes):
+        for listener in self._change_listeners:
+            listener(user_id, changes)
+
+    async def user_exists(self, user_id):
+        return await self.users_collection.find_one({"_id": user_id}, {"_id": 1}) is not None
+
+    async def ensure_indexes(self):
+        """
+        Creates the indexes the users and jobs queries rely on and verifies that the existing ones match.
+
+        Raises:
+            RuntimeError: If an index with the same name exists with different keys or options.
+        """
+        for collection, indexes in ((self.users_collection, USERS_INDEXES), (self.jobs_collection, JOBS_INDEXES)):
+            await collection.create_indexes(indexes)
+
+            existing_indexes = await collection.index_information()
+            for index in indexes:
+                expected = index.document
+                existing = existing_indexes.get(expected["name"])
+
+                if existing is None or list(existing["key"]) != list(expected["key"].items()):
+                    raise RuntimeError(f"Index {expected['name']} on {collection.name} does not match its "
+                                       f"definition: {existing}")
+                for option, default in VERIFIED_INDEX_OPTIONS.items():
+                    if existing.get(option, default) != expected.get(option, default):
+                        raise RuntimeError(f"Index {expected['name']} on {collection.name} has {option} "
+                                           f"{existing.get(option, default)!r} instead of "
+                                           f"{expected.get(option, default)!r}; drop it to have it rebuilt")
+
+    async def create_user(self, user_id, user_language='en', referrer_id=None):
+        """
+        Inserts a new user. With a referrer_id, the user is linked into the referrer's gang: the new user stores
+        referrer_id and referrer_path (the referrer and their own ancestors, nearest first), and the gang sizes
+        of everyone on that path are incremented.
+        """
+        referrer_path = []
+        if referrer_id is not None:
+            referrer = await self.users_collection.find_one({"_id": referrer_id}, {"referrer_path": 1})
+            if referrer is not None:
+                referrer_path = [referrer_id] + referrer.get("referrer_path", [])[:GANG_MAX_DEPTH - 1]
+
+        for _ in range(REFERRAL_CODE_ATTEMPTS):
+            try:
+                user_data = await self._insert_user(user_id, user_language, referrer_path)
+                break
+            except DuplicateKeyError as e:
+                # A taken referral code is retried with a new one, anything else (e.g. the _id) is a real error
+                if "referral_code" not in (e.details or {}).get("keyPattern", {}):
+                    raise
+                logging.warning("Referral code collision for user %s, retrying.", user_id)
+        else:
+            raise RuntimeError(f"Could not generate a unique referral code for user {user_id}.")
+
+        if referrer_path:
+            await self._add_to_gangs(referrer_path)
+        return user_data
+
+    async def _insert_user(self, user_id, user_language, referrer_path):
         user_data = {
             "_id": user_id,
             "balance": 0,
@@ -25,35 +280,564 @@ class UsersDb:
             "subscribe_channel_quest_time": None,
             "start_another_bot_quest_time": None,
             "last_time_twitter_link_clicked": None,
+            # A new user's gang is known to be empty, so signups below it can count it from the start
+            "gang_level_2": 0,
+            "gang_total": 0,
         }
-        self.users_collection.insert_one(user_data)
+        if referrer_path:
+            user_data["referrer_id"] = referrer_path[0]
+            user_data["referrer_path"] = referrer_path
+        await self.users_collection.insert_one(user_data)
+        return user_data
+
+    async def _add_to_gangs(self, referrer_path):
+        # The referrer's own count is amount_of_referrals, bumped by increase_referrals_number. Counters that were
+        # never built are left to rebuild_gang_stats: starting them at 1 would drop everyone counted before
+        counted = {"gang_total": {"$exists": True}}
+        requests = [UpdateOne({"_id": referrer_path[0], **counted}, {"$inc": {"gang_total": 1}})]
+        if len(referrer_path) > 1:
+            requests.append(UpdateOne({"_id": referrer_path[1], **counted},
+                                      {"$inc": {"gang_level_2": 1, "gang_total": 1}}))
+        if len(referrer_path) > 2:
+            requests.append(UpdateMany({"_id": {"$in": referrer_path[2:]}, **counted},
+                                       {"$inc": {"gang_total": 1}}))
+        await self.users_collection.bulk_write(requests, ordered=False)
+
+    def find_referral_tree(self, batch_size=1000):
+        """
+        Streams the users that are part of a gang: everyone with a referrer, with referrals or with stored gang
+        sizes. Returns an async cursor of {_id, referrer_id, amount_of_referrals, gang_level_2, gang_total}.
+        """
+        return self.users_collection.find(
+            {"$or": [{"referrer_id": {"$exists": True}}, {"amount_of_referrals": {"$gt": 0}},
+                     {"gang_total": {"$gt": 0}}]},
+            {"referrer_id": 1, "amount_of_referrals": 1, "gang_level_2": 1, "gang_total": 1},
+            batch_size=batch_size,
+        )
+
+    async def set_gang_stats(self, changes):
+        """
+        Writes recomputed gang sizes, each only if the user's stored sizes are still the ones it was computed
+        against; a user whose gang grew in the meantime keeps the incremented values until the next rebuild.
+
+        Args:
+            changes: A list of (user_id, stored {gang_level_2, gang_total}, new {gang_level_2, gang_total}).
+
+        Returns:
+            The number of users updated.
+        """
+        if not changes:
+            return 0
+
+        requests = [UpdateOne({"_id": user_id, **{field: stored.get(field) for field in new}}, {"$set": new})
+                    for user_id, stored, new in changes]
+        result = await self.users_collection.bulk_write(requests, ordered=False)
+        return result.modified_count
 
     @staticmethod
     def generate_referral_code():
-        # Replace with your referral logic (consider MongoDB for uniqueness)
-        unique_id = str(uuid.uuid4())  # Example using UUID
-        referral_code = unique_id
-        return referral_code
+        # Uniqueness is enforced by the referral_code_unique index, see create_user
+        return "".join(secrets.choice(REFERRAL_CODE_ALPHABET) for _ in range(REFERRAL_CODE_LENGTH))
+
+    async def find_user_id_by_referral_code(self, referral_code):
+        user_data = await self.users_collection.find_one({"referral_code": referral_code}, {"_id": 1})
+        if user_data is None and len(referral_code) > REFERRAL_CODE_LENGTH:
+            # Invite links created before the switch to compact codes
+            user_data = await self.users_collection.find_one({"legacy_referral_code": referral_code}, {"_id": 1})
+        return user_data["_id"] if user_data else None
+
+    async def get_user(self, user_id, fields=User.FIELDS):
+        """
+        Reads a user as a User record, fetching only the given fields.
+
+        Args:
+            user_id: The ID of the user.
+            fields: A tuple of the User.FIELDS to read; every other field of the record is left unset.
+
+        Returns:
+            The User, or None if the user does not exist.
+        """
+        user_data = await self.users_collection.find_one({"_id": user_id}, dict.fromkeys(fields, 1))
+        if user_data is None:
+            return None
+
+        if self.write_behind and self.write_behind.has_pending(user_id):
+            # Reads see buffered writes as if they were already stored
+            user_data.update(self.write_behind.pending(user_id))
+        return User.from_document(user_data, fields)
+
+    async def update_user_data(self, user_id, update_data):
+        if self.write_behind:
+            if self.write_behind.accepts(update_data):
+                await self.write_behind.write(user_id, update_data)
+                return
+            await self.write_behind.flush(user_id)
+
+        await self.users_collection.update_one({"_id": user_id}, {"$set": update_data})
+
+    async def increase_balance(self, user_id, amount):
+        user_data = await self.users_collection.find_one_and_update({"_id": user_id}, {"$inc": {"balance": amount}},
+                                                                    projection={"balance": 1},
+                                                                    return_document=ReturnDocument.AFTER)
+        if not user_data:
+            return None
+
+        self._notify(user_id, {"balance": user_data["balance"]})
+        return user_data["balance"]
+
+    async def claim_pillage(self, user_id, claim_time, cooldown_seconds, daily_quest_cutoff):
+        """
+        Claims pillage gold in one round trip, if the cooldown has passed.
+
+        The cooldown check, the daily quest multiplier, the balance increment and the new claim time are all
+        evaluated by the server inside a single update, so concurrent claims cannot both succeed or lose gold.
+        When the cooldown has not passed the document is left unchanged.
 
-    def get_user_data(self, user_id):
-        user_data = self.users_collection.find_one({"_id": user_id})
-        return user_data if user_data else {}
+        Args:
+            user_id: The ID of the user claiming.
+            claim_time: The current timestamp, stored as the new last_time_pillage_claimed.
+            cooldown_seconds: The time that must pass between two claims.
+            daily_quest_cutoff: Daily quests completed at or before this datetime double the gold.
 
-    def update_user_data(self, user_id, update_data):
-        self.users_collection.update_one({"_id": user_id}, {"$set": update_data})
+        Returns:
+            The User (all fields) after the update, or None if the user does not exist.
+            The claim succeeded if its last_time_pillage_claimed equals claim_time.
+        """
+        cooldown_passed = {"$lte": [{"$ifNull": ["$last_time_pillage_claimed", 0]}, claim_time - cooldown_seconds]}
+        daily_quest_completed = {"$ne": [{"$ifNull": ["$last_time_daily_quest_completed", None]}, None]}
+        multiplier = {
+            "$cond": [{"$and": [daily_quest_completed,
+                                {"$lte": ["$last_time_daily_quest_completed", daily_quest_cutoff]}]}, 2, 1]
+        }
+        gold = {"$multiply": [{"$ifNull": ["$gold_per_pillage", 0]}, multiplier]}
+        # A successful claim files the user under the bucket their next plunder becomes ready in, unless opted out
+        ready_bucket = int((claim_time + cooldown_seconds) // PLUNDER_REMINDER_BUCKET_SECONDS)
+        reminded = {"$ne": [{"$ifNull": ["$plunder_reminders", True]}, False]}
+
+        if self.write_behind:
+            # The multiplier reads last_time_daily_quest_completed, which may still be buffered
+            await self.write_behind.flush(user_id)
+
+        # Pipeline updates cannot use $inc, but $add inside a single-document update is just as atomic
+        user_data = await self.users_collection.find_one_and_update(
+            {"_id": user_id},
+            [{"$set": {
+                "balance": {"$cond": [cooldown_passed, {"$add": [{"$ifNull": ["$balance", 0]}, gold]}, "$balance"]},
+                "last_time_pillage_claimed": {"$cond": [cooldown_passed, claim_time, "$last_time_pillage_claimed"]},
+                "plunder_ready_bucket": {"$cond": [{"$and": [cooldown_passed, reminded]}, ready_bucket,
+                                                   "$plunder_ready_bucket"]},
+            }}],
+            projection=USER_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        if user_data is None:
+            return None
+
+        user = User.from_document(user_data)
+        if user.last_time_pillage_claimed == claim_time:
+            self._notify(user_id, {"balance": user.balance})
+        return user
 
-    def increase_referrals_number(self, user_id):
-        # Find the user document
-        user = self.users_collection.find_one({"_id": user_id})
+    async def increase_referrals_number(self, user_id):
+        # Increment the amount_of_referrals field by 1, if the user exists
+        user = await self.users_collection.find_one_and_update({"_id": user_id}, {"$inc": {"amount_of_referrals": 1}},
+                                                               projection={"amount_of_referrals": 1},
+                                                               return_document=ReturnDocument.AFTER)
         if user:
-            # Increment the amount_of_referrals field by 1
-            self.users_collection.update_one({"_id": user_id}, {"$inc": {"amount_of_referrals": 1}})
+            self._notify(user_id, {"amount_of_referrals": user["amount_of_referrals"]})
         else:
             logging.error("User not found.")
 
-    def get_common_data(self):
-        system_config = self.users_collection.find_one({"_id": 0})
-        return system_config
+    async def get_top_users(self, field, limit):
+        """
+        Returns the limit users with the highest value of field as a list of (user_id, value), read off the
+        field's descending index.
+        """
+        cursor = self.users_collection.find({"_id": {"$ne": 0}}, {field: 1}).sort(field, DESCENDING).limit(limit)
+        return [(user["_id"], user.get(field) or 0) for user in await cursor.to_list(limit)]
+
+    async def get_value_histogram(self, field, buckets_per_decade):
+        """
+        Counts users by floor(log10(value + 1) * buckets_per_decade), in one aggregation over all users.
+
+        Returns:
+            A dict of {bucket: (number of users, lowest value, highest value)}.
+        """
+        value = {"$max": [{"$ifNull": [f"${field}", 0]}, 0]}
+        cursor = self.users_collection.aggregate([
+            {"$match": {"_id": {"$ne": 0}}},
+            {"$group": {"_id": {"$floor": {"$multiply": [{"$log10": {"$add": [value, 1]}}, buckets_per_decade]}},
+                        "count": {"$sum": 1}, "min": {"$min": value}, "max": {"$max": value}}},
+        ])
+        return {int(bucket["_id"]): (bucket["count"], bucket["min"], bucket["max"]) async for bucket in cursor}
+
+    async def get_common_data(self):
+        """
+        Returns the system document (_id: 0), from memory for COMMON_DATA_TTL seconds at a time.
+
+        The document is edited by hand, so an expired copy is re-read in full. It is only replaced when the
+        contents changed, so caches keyed on its identity (compile_quest_table) stay warm. The returned
+        document is shared; don't modify it.
+        """
+        if self._common_data is not None and time.monotonic() < self._common_data_expires:
+            return self._common_data
+
+        system_config = await self.users_collection.find_one({"_id": 0})
+        if system_config is not None and system_config != self._common_data:
+            self._common_data = system_config
+        self._common_data_expires = time.monotonic() + COMMON_DATA_TTL
+        return self._common_data
+
+    async def update_common_data(self, update_data):
+        await self.users_collection.update_one({"_id": 0}, {"$set": update_data}, upsert=True)
+        # This process sees its own change right away, other processes within COMMON_DATA_TTL
+        self._common_data_expires = 0
+
+    async def create_broadcast(self, message_key, message_kwargs):
+        result = await self.broadcasts_collection.insert_one({
+            "message_key": message_key,
+            "message_kwargs": message_kwargs,
+            "status": "pending",
+            "last_user_id": 0,
+            "sent": 0,
+            "failed": 0,
+            "owner": None,
+            "lease_until": 0,
+            "created_at": datetime.now(),
+        })
+        return result.inserted_id
+
+    async def acquire_broadcast(self, owner, lease_seconds):
+        """
+        Takes the oldest unfinished broadcast whose lease is free or has expired (its owner crashed).
+
+        Returns:
+            The broadcast document, or None if there is nothing to send.
+        """
+        now = time.time()
+        return await self.broadcasts_collection.find_one_and_update(
+            {"status": {"$in": ["pending", "running"]}, "lease_until": {"$lt": now}},
+            {"$set": {"status": "running", "owner": owner, "lease_until": now + lease_seconds}},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def get_broadcast_recipients(self, after_user_id, batch_size):
+        # Ranges over the _id index, so every batch is one bounded query wherever the broadcast resumes
+        cursor = self.users_collection.find(
+            {"_id": {"$gt": after_user_id}, "delivery_status": {"$nin": UNREACHABLE_STATUSES}},
+            {"user_language": 1},
+        ).sort("_id", ASCENDING).limit(batch_size)
+        return await cursor.to_list(batch_size)
+
+    async def record_broadcast_batch(self, broadcast_id, owner, last_user_id, sent, delivery_statuses,
+                                     lease_seconds):
+        """
+        Checkpoints a sent batch and renews the lease.
+
+        Args:
+            broadcast_id: The broadcast the batch belongs to.
+            owner: The owner that acquired the broadcast.
+            last_user_id: The last user of the batch; the broadcast resumes after it.
+            sent: The number of users the message reached.
+            delivery_statuses: A dict of {user_id: status} for users the message did not reach.
+            lease_seconds: How long the lease is extended by.
+
+        Returns:
+            False if another owner took the broadcast over, in which case the caller must stop.
+        """
+        await self.set_delivery_statuses(delivery_statuses)
+
+        result = await self.broadcasts_collection.update_one(
+            {"_id": broadcast_id, "owner": owner},
+            {"$set": {"last_user_id": last_user_id, "lease_until": time.time() + lease_seconds},
+             "$inc": {"sent": sent, "failed": len(delivery_statuses)}},
+        )
+        return result.matched_count == 1
+
+    async def finish_broadcast(self, broadcast_id, owner):
+        await self.broadcasts_collection.update_one(
+            {"_id": broadcast_id, "owner": owner},
+            {"$set": {"status": "done", "lease_until": 0, "finished_at": datetime.now()}},
+        )
+
+    async def set_delivery_statuses(self, delivery_statuses):
+        """
+        Records why messages did not reach users, from a dict of {user_id: status}.
+        """
+        if delivery_statuses:
+            now = datetime.now()
+            await self.users_collection.bulk_write([
+                UpdateOne({"_id": user_id}, {"$set": {"delivery_status": status, "delivery_status_at": now}})
+                for user_id, status in delivery_statuses.items()
+            ], ordered=False)
+
+    async def find_users_after(self, after_user_id, query, projection, batch_size):
+        """
+        Returns the next batch_size users after after_user_id in _id order that match query, for jobs that
+        stream the collection and checkpoint the last _id they handled.
+        """
+        cursor = self.users_collection.find({"_id": {"$gt": after_user_id}, **query},
+                                            projection).sort("_id", ASCENDING).limit(batch_size)
+        return await cursor.to_list(batch_size)
+
+    async def bulk_update_users(self, requests):
+        """
+        Writes a batch of UpdateOne/UpdateMany requests in one unordered bulk_write.
+
+        Returns:
+            The number of users modified.
+        """
+        if not requests:
+            return 0
+        result = await self.users_collection.bulk_write(requests, ordered=False)
+        return result.modified_count
+
+    async def get_migrations(self):
+        cursor = self.migrations_collection.find({}).sort("_id", ASCENDING)
+        return await cursor.to_list(None)
+
+    async def acquire_migration(self, version, name, owner, lease_seconds):
+        """
+        Takes the lease of a migration, creating its checkpoint on the first run.
+
+        Returns:
+            The checkpoint document, with the last_id to resume after, or None if the migration is done or
+            another runner holds an unexpired lease.
+        """
+        now = time.time()
+        try:
+            return await self.migrations_collection.find_one_and_update(
+                {"_id": version, "status": {"$ne": "done"}, "lease_until": {"$lt": now}},
+                {"$set": {"status": "running", "owner": owner, "lease_until": now + lease_seconds},
+                 "$setOnInsert": {"name": name, "last_id": 0, "processed": 0, "modified": 0,
+                                  "started_at": datetime.now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # The checkpoint exists but didn't match: done, or leased to someone else
+            return None
+
+    async def record_migration_batch(self, version, owner, last_id, processed, modified, lease_seconds):
+        """
+        Checkpoints a migrated batch and renews the lease.
+
+        Returns:
+            False if another runner took the migration over, in which case the caller must stop.
+        """
+        result = await self.migrations_collection.update_one(
+            {"_id": version, "owner": owner},
+            {"$set": {"last_id": last_id, "lease_until": time.time() + lease_seconds},
+             "$inc": {"processed": processed, "modified": modified}},
+        )
+        return result.matched_count == 1
+
+    async def release_migration(self, version, owner):
+        # A stopped run lets the next one resume right away instead of waiting for the lease to run out
+        await self.migrations_collection.update_one({"_id": version, "owner": owner}, {"$set": {"lease_until": 0}})
+
+    async def finish_migration(self, version, owner):
+        await self.migrations_collection.update_one(
+            {"_id": version, "owner": owner},
+            {"$set": {"status": "done", "lease_until": 0, "finished_at": datetime.now()}},
+        )
+
+    async def get_rank_histogram(self, metric):
+        """
+        Returns:
+            The histogram of metric the last set_rank_histogram stored, as {bucket: (count, lowest, highest)},
+            or None if none was stored yet.
+        """
+        state = await self.state_collection.find_one({"_id": f"rank_histogram:{metric}"})
+        if state is None:
+            return None
+        return {bucket: (count, lowest, highest) for bucket, count, lowest, highest in state["buckets"]}
+
+    async def set_rank_histogram(self, metric, bucket_counts):
+        # Stored as a list, BSON keys must be strings
+        await self.state_collection.replace_one(
+            {"_id": f"rank_histogram:{metric}"},
+            {"buckets": [[bucket, *values] for bucket, values in sorted(bucket_counts.items())],
+             "built_at": datetime.now()},
+            upsert=True,
+        )
+
+    async def get_polling_offset(self):
+        """
+        Returns:
+            The update_id of the last update polling handed over, or None if none was committed yet.
+        """
+        state = await self.state_collection.find_one({"_id": "polling"})
+        return state["update_id"] if state else None
+
+    async def commit_polling_offset(self, update_id):
+        # $max, so a late commit of an older batch never moves the offset back
+        await self.state_collection.update_one({"_id": "polling"}, {"$max": {"update_id": update_id}}, upsert=True)
+
+    async def clear_delivery_status(self, user_id):
+        await self.users_collection.update_one({"_id": user_id}, {"$unset": {"delivery_status": "",
+                                                                             "delivery_status_at": ""}})
+
+    async def take_due_plunder_reminders(self, due_bucket, limit):
+        """
+        Takes up to limit users whose plunder is ready by due_bucket off the reminder index.
+
+        Users are taken with one update_many tagged with a random batch id, so replicas polling the same bucket
+        never remind the same user twice. Every query runs on the plunder_ready_bucket or _id index, so the cost
+        follows the number of due users.
+
+        Returns:
+            The taken users, with their user_language.
+        """
+        cursor = self.users_collection.find({"plunder_ready_bucket": {"$lte": due_bucket}}, {"_id": 1}).limit(limit)
+        user_ids = [user["_id"] for user in await cursor.to_list(limit)]
+        if not user_ids:
+            return []
+
+        batch_id = secrets.token_hex(8)
+        await self.users_collection.update_many(
+            {"_id": {"$in": user_ids}, "plunder_ready_bucket": {"$lte": due_bucket}},
+            {"$unset": {"plunder_ready_bucket": ""}, "$set": {"plunder_reminder_batch": batch_id}},
+        )
+        cursor = self.users_collection.find({"_id": {"$in": user_ids}, "plunder_reminder_batch": batch_id},
+                                            {"user_language": 1})
+        return await cursor.to_list(limit)
+
+    async def set_plunder_reminders(self, user_id, enabled):
+        if enabled:
+            # The next claim files the user again
+            await self.users_collection.update_one({"_id": user_id}, {"$set": {"plunder_reminders": True}})
+        else:
+            await self.users_collection.update_one({"_id": user_id}, {"$set": {"plunder_reminders": False},
+                                                                     "$unset": {"plunder_ready_bucket": ""}})
+
+    async def insert_job(self, name, args, run_at):
+        result = await self.jobs_collection.insert_one({
+            "name": name,
+            "args": args,
+            "run_at": run_at,
+            "status": "pending",
+            "attempts": 0,
+            "lease_until": 0,
+        })
+        return result.inserted_id
+
+    async def get_due_job_ids(self, now, limit):
+        """
+        Returns the ids of pending jobs that are due and of running jobs whose owner stopped renewing the lease.
+        """
+        cursor = self.jobs_collection.find(
+            {"$or": [{"status": "pending", "run_at": {"$lte": now}},
+                     {"status": "running", "lease_until": {"$lt": now}}]},
+            {"_id": 1},
+        ).sort("run_at", ASCENDING).limit(limit)
+        return [job["_id"] for job in await cursor.to_list(limit)]
+
+    async def claim_job(self, job_id, owner, now, lease_seconds):
+        """
+        Marks a due job as running for owner.
+
+        Returns:
+            The job document, or None if it is not due or another owner claimed it first.
+        """
+        return await self.jobs_collection.find_one_and_update(
+            {"_id": job_id, "$or": [{"status": "pending", "run_at": {"$lte": now}},
+                                    {"status": "running", "lease_until": {"$lt": now}}]},
+            {"$set": {"status": "running", "owner": owner, "lease_until": now + lease_seconds},
+             "$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def complete_job(self, job_id):
+        await self.jobs_collection.delete_one({"_id": job_id})
+
+    async def release_job(self, job_id, run_at, error):
+        """
+        Puts a failed job back to be retried at run_at, or keeps it as failed if run_at is None.
+        """
+        if run_at is None:
+            update = {"$set": {"status": "failed", "error": error}}
+        else:
+            update = {"$set": {"status": "pending", "run_at": run_at, "error": error}}
+        await self.jobs_collection.update_one({"_id": job_id}, update)
+
+    async def get_media_file_id(self, media_key):
+        media = await self.media_collection.find_one({"_id": media_key}, {"file_id": 1})
+        return media["file_id"] if media else None
+
+    async def set_media_file_id(self, media_key, file_id, image_path):
+        await self.media_collection.update_one({"_id": media_key}, {"$set": {"file_id": file_id, "path": image_path}},
+                                               upsert=True)
+
+
+class UserContext:
+    """
+    Per-update view of one user's document.
+
+    The user is fetched once, as a User with every User.FIELDS field, the first time anything asks for it and
+    is then served from memory to the handler and every utils helper handling the same update, whichever
+    fields they ask for: one read of all of them beats one read per helper. Writes go to the database and are
+    mirrored into the cached record, so later reads in the update never see stale data. Calls about other
+    users (e.g. the referrer on /start) go straight to UsersDb, with the fields the caller asked for.
+    """
+
+    def __init__(self, db, user_id):
+        self.db = db
+        self.user_id = user_id
+        self._user = None
+        self._loaded = False
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    async def get_user(self, user_id, fields=User.FIELDS):
+        if user_id != self.user_id:
+            return await self.db.get_user(user_id, fields)
+        if not self._loaded:
+            self._user = await self.db.get_user(user_id)
+            self._loaded = True
+        return self._user
+
+    def _cache(self, user):
+        self._user = user
+        self._loaded = True
+
+    async def user_exists(self, user_id):
+        if user_id != self.user_id:
+            return await self.db.user_exists(user_id)
+        return await self.get_user(user_id) is not None
+
+    async def create_user(self, user_id, user_language='en', referrer_id=None):
+        user_data = await self.db.create_user(user_id, user_language, referrer_id)
+        if user_id == self.user_id:
+            self._cache(User.from_document(user_data))
+        return user_data
+
+    async def update_user_data(self, user_id, update_data):
+        await self.db.update_user_data(user_id, update_data)
+        if user_id == self.user_id and self._user is not None:
+            self._user.apply(update_data)
+
+    async def increase_balance(self, user_id, amount):
+        new_balance = await self.db.increase_balance(user_id, amount)
+        if user_id == self.user_id and self._user is not None and new_balance is not None:
+            self._user.balance = new_balance
+        return new_balance
+
+    async def claim_pillage(self, user_id, claim_time, cooldown_seconds, daily_quest_cutoff):
+        user = await self.db.claim_pillage(user_id, claim_time, cooldown_seconds, daily_quest_cutoff)
+        if user_id == self.user_id and user is not None:
+            # The update returns every field, so it doubles as this update's load
+            self._cache(user)
+        return user
+
+    async def increase_referrals_number(self, user_id):
+        await self.db.increase_referrals_number(user_id)
+        if user_id == self.user_id and self._user is not None:
+            self._user.amount_of_referrals += 1
 
-    def update_common_data(self, update_data):
-        self.users_collection.update_one({"_id": 0}, {"$set": update_data}, upsert=True)
+    async def clear_delivery_status(self, user_id):
+        await self.db.clear_delivery_status(user_id)
+        if user_id == self.user_id and self._user is not None:
+            self._user.delivery_status = None
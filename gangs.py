@@ -0,0 +1,106 @@
+import logging
+import sys
+from db import GANG_MAX_DEPTH
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between full rebuilds; signups keep the sizes current in between, rebuilds only repair drift
+GANG_STATS_REBUILD_INTERVAL = 24 * 60 * 60
+
+# Users written per bulk_write
+GANG_STATS_BATCH_SIZE = 1000
+
+
+def compute_gang_stats(members):
+    """
+    Computes gang sizes from the referral links.
+
+    A user's level 1 is amount_of_referrals, which also counts referrals made before referrer_id was recorded.
+    Level 2 is the sum of level 1 over the user's linked referrals, and the total adds up level 1 of everyone in
+    the gang down to GANG_MAX_DEPTH levels, the same sums create_user increments one signup at a time.
+
+    Args:
+        members: Dicts of {_id, referrer_id, amount_of_referrals}, as streamed by UsersDb.find_referral_tree.
+
+    Returns:
+        A dict of {user_id: {"gang_level_2": ..., "gang_total": ...}} for every user with a non-empty gang.
+    """
+    referrers = {}
+    recruits = {}
+
+    for member in members:
+        if member.get("referrer_id") is not None:
+            referrers[member["_id"]] = member["referrer_id"]
+        if member.get("amount_of_referrals"):
+            recruits[member["_id"]] = member["amount_of_referrals"]
+
+    stats = {}
+    for user_id, count in recruits.items():
+        # count is level 1 of user_id, level 2 of its referrer and deeper in the gangs above that
+        ancestor, depth = user_id, 1
+        while ancestor is not None and depth <= GANG_MAX_DEPTH:
+            ancestor_stats = stats.setdefault(ancestor, {"gang_level_2": 0, "gang_total": 0})
+            ancestor_stats["gang_total"] += count
+            if depth == 2:
+                ancestor_stats["gang_level_2"] += count
+            ancestor, depth = referrers.get(ancestor), depth + 1
+
+    return stats
+
+
+async def rebuild_gang_stats(db, batch_size=GANG_STATS_BATCH_SIZE):
+    """
+    Recomputes gang_level_2 and gang_total of every user in one streaming pass over the referral links and
+    writes the ones that differ from what is stored, batch_size at a time.
+
+    Returns:
+        The number of users updated.
+    """
+    members = []
+    stored = {}
+    async for member in db.find_referral_tree(batch_size):
+        members.append({"_id": member["_id"], "referrer_id": member.get("referrer_id"),
+                        "amount_of_referrals": member.get("amount_of_referrals")})
+        if member.get("gang_total") is not None or member.get("gang_level_2") is not None:
+            stored[member["_id"]] = {"gang_level_2": member.get("gang_level_2"),
+                                     "gang_total": member.get("gang_total")}
+
+    stats = compute_gang_stats(members)
+    empty = {"gang_level_2": 0, "gang_total": 0}
+    missing = {"gang_level_2": None, "gang_total": None}
+
+    changes = [(user_id, stored.get(user_id, missing), stats.get(user_id, empty))
+               for user_id in stats.keys() | stored.keys()
+               if stored.get(user_id, missing) != stats.get(user_id, empty)]
+
+    updated = 0
+    for start in range(0, len(changes), batch_size):
+        updated += await db.set_gang_stats(changes[start:start + batch_size])
+
+    logger.info("Rebuilt gang sizes of %s users, %s updated", len(stats), updated)
+    return updated
+
+
+async def run_gang_stats(rt):
+    """
+    Background job that rebuilds the gang sizes at startup and then every GANG_STATS_REBUILD_INTERVAL seconds.
+    The first rebuild backfills the users whose sizes were never counted; until then signups leave them alone.
+    """
+    while True:
+        try:
+            await rebuild_gang_stats(rt.db)
+        except Exception:
+            logger.exception("Rebuilding gang sizes failed")
+        await rt.tasks.sleep(GANG_STATS_REBUILD_INTERVAL)
+
+
+if __name__ == "__main__":
+    # Backfills the gang sizes: python gangs.py
+    from main import create_users_db
+    from runtime import run_blocking
+
+    if len(sys.argv) != 1:
+        sys.exit("Usage: python gangs.py")
+
+    print(f"Updated gang sizes of {run_blocking(rebuild_gang_stats(create_users_db('pymongo')))} users")
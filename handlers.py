@@ -0,0 +1,537 @@
+import telebot
+from utils import *
+from db import UserContext
+from keyboards import KEYBOARDS
+from localization import CATALOGS
+from router import route_text, route_callback
+import config
+
+
+async def get_keyboards(db, user_id):
+    return KEYBOARDS.get(await get_user_language(db, user_id))
+
+
+async def generate_main_keyboard(db, user_id):
+    return (await get_keyboards(db, user_id)).main
+
+
+async def start(rt, db, message):
+    user_id = message.chat.id
+
+    if not await db.user_exists(user_id):
+        user_language = message.from_user.language_code
+
+        master_id = None
+        deeplink_args = message.text.split(" ")[1:]
+        if len(deeplink_args) == 1:
+            # Resolved first, so the new user is created linked to whoever invited them
+            master_id = await find_user_by_referral_code(db, deeplink_args[0])
+
+        if user_language == 'ru':
+            await db.create_user(user_id, user_language, referrer_id=master_id)
+        else:
+            await db.create_user(user_id, referrer_id=master_id)
+
+        try:
+            if len(deeplink_args) == 1:
+                await increase_referral_number(db, master_id)
+
+                await get_referral_reward(db, master_id)
+
+        except IndexError:
+            # Unexpected error, handle gracefully
+            await rt.bot.reply_to(message, "An error occurred processing your request.")
+
+        new_user_message = await get_message_text(db=db, message_key='new_user_message', user_id=user_id)
+
+        keyboard = (await get_keyboards(db, user_id)).initiation
+
+        image_path = 'webp_images/welcome.webp'
+
+        try:
+            # Send both text and image in a single message
+            await rt.media.send_photo(message.chat.id, image_path, caption=new_user_message, reply_markup=keyboard,
+                                      parse_mode='HTML')
+        except FileNotFoundError:
+            # Handle the case where the image file is not found
+            await rt.bot.reply_to(message, "Error: Image not found.")
+
+    else:
+        user = await db.get_user(user_id, ("delivery_status",))
+        if user.delivery_status:
+            # The user is back, so broadcasts can reach them again
+            await db.clear_delivery_status(user_id)
+
+        if not message.text:
+            keyboard = await generate_main_keyboard(db, user_id=user_id)
+            await rt.bot.reply_to(message, text="", reply_markup=keyboard)
+
+        else:
+            keyboard = await generate_main_keyboard(db, user_id=user_id)
+
+            welcome_message = await get_message_text(db=db, message_key='welcome_message', user_id=user_id)
+
+            image_path = 'webp_images/main.webp'
+
+            try:
+                # Send both text and image in a single message
+                await rt.media.send_photo(message.chat.id, image_path, caption=welcome_message, reply_markup=keyboard,
+                                          parse_mode='HTML')
+            except FileNotFoundError:
+                # Handle the case where the image file is not found
+                await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+async def handle_initiation(rt, db, call):
+    message = call.message
+    user_id = message.chat.id
+    is_initiated = await rt.membership.is_member(user_id)
+
+    if is_initiated:
+
+        keyboard = await generate_main_keyboard(db, user_id=user_id)
+
+        welcome_message = await get_message_text(db=db, message_key='welcome_message', user_id=user_id)
+
+        image_path = 'webp_images/main.webp'
+
+        try:
+            await rt.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+
+            # Send both text and image in a single message
+            await rt.media.send_photo(message.chat.id, image_path, caption=welcome_message, reply_markup=keyboard,
+                                      parse_mode='HTML')
+        except FileNotFoundError:
+            # Handle the case where the image file is not found
+            await rt.bot.reply_to(message, "Error: Image not found.")
+
+    else:
+        initiation_failed_message = await get_message_text(db=db, message_key='initiation_failed_message',
+                                                           user_id=user_id)
+        await rt.bot.send_message(user_id, initiation_failed_message)
+
+
+async def handle_pillage(rt, db, message):
+    user_id = message.chat.id
+    keyboard = (await get_keyboards(db, user_id)).claim
+
+    pillage_message = await get_message_text(db=db, user_id=user_id, message_key='pillage_info_message')
+
+    # Specify the path to the image you want to send
+    image_path = 'webp_images/pillage.webp'
+
+    try:
+        # Send both text and image in a single message
+        await rt.media.send_photo(message.chat.id, image_path, caption=pillage_message, reply_markup=keyboard,
+                                  parse_mode='HTML')
+    except FileNotFoundError:
+        # Handle the case where the image file is not found
+        await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+async def claim_gold_callback(rt, db, call):
+    await rt.bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+
+    user_id = call.message.chat.id
+    cached = rt.throttle.cooldown(user_id, "claim_gold")
+    if cached is not None:
+        # Still cooling down: the claim would fail, and the answer only needs what the last one returned
+        last_claim_time, user_language = cached
+        unsuccessful_claim_message = render_message(user_language, 'pillage_failure_message',
+                                                    reward_time=format_reward_time(last_claim_time))
+        try:
+            await rt.media.send_photo(call.message.chat.id, 'webp_images/claim_unsuccessful.webp',
+                                      caption=unsuccessful_claim_message)
+        except FileNotFoundError:
+            await rt.bot.reply_to(call.message, "Error: Image not found.")
+        return
+
+    claimed, last_claim_time = await claim_gold(db=db, user_id=user_id)
+    reward_time = format_reward_time(last_claim_time)
+    if last_claim_time is not None:
+        # claim_pillage loaded the user's document into the UserContext, so the language costs no read
+        rt.throttle.set_cooldown(user_id, "claim_gold", last_claim_time + PILLAGE_COOLDOWN.total_seconds(),
+                                 (last_claim_time, await get_user_language(db, user_id)))
+
+    if claimed:
+        successful_claim_message = await get_message_text(db=db, user_id=user_id, message_key='pillage_success_message',
+                                                          reward_time=reward_time)
+
+        # Specify the path to the image you want to send
+        image_path = 'webp_images/claim_successful.webp'
+
+        try:
+            # Send both text and image in a single message
+            await rt.media.send_photo(call.message.chat.id, image_path, caption=successful_claim_message)
+        except FileNotFoundError:
+            # Handle the case where the image file is not found
+            await rt.bot.reply_to(call.message, "Error: Image not found.")
+    else:
+        unsuccessful_claim_message = await get_message_text(db=db, user_id=user_id,
+                                                            message_key='pillage_failure_message',
+                                                            reward_time=reward_time)
+
+        # Specify the path to the image you want to send
+        image_path = 'webp_images/claim_unsuccessful.webp'
+
+        try:
+            # Send both text and image in a single message
+            await rt.media.send_photo(call.message.chat.id, image_path, caption=unsuccessful_claim_message)
+        except FileNotFoundError:
+            # Handle the case where the image file is not found
+            await rt.bot.reply_to(call.message, "Error: Image not found.")
+
+
+async def plunder_reminders_callback(rt, db, call):
+    user_id = call.message.chat.id
+    enabled = call.data == "reminders_on"
+
+    await db.set_plunder_reminders(user_id, enabled)
+
+    if enabled:
+        message = await get_message_text(db=db, user_id=user_id, message_key='plunder_reminders_on_message')
+        await rt.bot.send_message(user_id, message)
+    else:
+        message = await get_message_text(db=db, user_id=user_id, message_key='plunder_reminders_off_message')
+        await rt.bot.send_message(user_id, message, reply_markup=(await get_keyboards(db, user_id)).reminders_on)
+
+
+async def handle_balance(rt, db, message):
+    user_id = message.chat.id
+    user_balance = await get_user_balance(db, user_id)
+
+    balance_message = await get_message_text(db=db, user_id=user_id, message_key='current_balance_message',
+                                             user_balance=user_balance)
+
+    # Specify the path to the image you want to send
+    image_path = 'webp_images/balance.webp'
+
+    try:
+        # Send both text and image in a single message
+        await rt.media.send_photo(message.chat.id, image_path, caption=balance_message)
+    except FileNotFoundError:
+        # Handle the case where the image file is not found
+        await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+async def handle_squad(rt, db, message):
+    user_id = message.chat.id
+    user = await db.get_user(user_id, ("referral_code", "amount_of_referrals", "gang_level_2", "gang_total"))
+    referral_code = user.referral_code
+    amount_of_referrals = user.amount_of_referrals
+
+    squad_message = await get_message_text(
+        db=db,
+        user_id=user_id,
+        message_key='referrals_info_message',
+        referral_code=referral_code,
+        amount_of_referrals=amount_of_referrals,
+        # Materialized by create_user and gangs.py; users whose gang was never counted show level 1 until the
+        # rebuild at startup counts them
+        gang_level_2=user.gang_level_2,
+        gang_total=amount_of_referrals if user.gang_total is None else user.gang_total,
+        base_url=config.REFERRAL_BASE_URL,
+    )
+
+    keyboard = (await get_keyboards(db, user_id)).invite
+
+    # Specify the path to the image you want to send
+    image_path = 'webp_images/squad.webp'
+
+    try:
+        # Send both text and image in a single message
+        await rt.media.send_photo(message.chat.id, image_path, caption=squad_message, reply_markup=keyboard,
+                                  parse_mode="HTML")
+    except FileNotFoundError:
+        # Handle the case where the image file is not found
+        await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+async def handle_quests(rt, db, message):
+    user_id = message.chat.id
+
+    # # Create a keyboard with language options
+    # keyboard = telebot.types.InlineKeyboardMarkup()
+    # active_quests = get_active_quests(db, user_id)
+    #
+    # if active_quests:
+    #
+    #     for quest in active_quests:
+    #         quest_code = quest
+    #         keyboard.add(telebot.types.InlineKeyboardButton(text=get_button_name(db, user_id, quest_code),
+    #                                                         callback_data=quest_code))
+    #
+    #     quest_list_message = get_message_text(db=db, user_id=user_id, message_key='quests_list_message')
+    #
+    # else:
+    quest_list_message = await get_message_text(db=db, user_id=user_id, message_key='quests_list_empty_message')
+
+    image_path = 'webp_images/quests.webp'
+
+    try:
+        # Send both text and image in a single message
+        await rt.media.send_photo(message.chat.id, image_path, caption=quest_list_message)
+        # await rt.media.send_photo(message.chat.id, image_path, caption=quest_list_message,
+        #                           reply_markup=keyboard)
+    except FileNotFoundError:
+        # Handle the case where the image file is not found
+        await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+# @bot.callback_query_handler(func=lambda call: call.data in get_active_quests(db, call.message.chat.id))
+# def quest_buttons_callback(call):
+#     bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+#
+#     user_id = call.message.chat.id
+#
+#     if call.data == 'daily_quest_button':
+#         link_button_key = 'link_daily_quest_button'
+#         link_callback_data = 'link_to_twitter'
+#         check_callback_data = 'check_daily_quest'
+#         quest_code = 'daily_quest_message'
+#         url = get_latest_tweet_url(users_db)
+#     elif call.data == 'start_another_bot_button':
+#         link_button_key = 'link_bot_quest_button'
+#         link_callback_data = 'link_to_bot'
+#         check_callback_data = 'check_another_bot_quest'
+#         quest_code = 'start_another_bot_quest_message'
+#         url = get_latest_tweet_url(users_db)
+#     else:
+#         link_button_key = 'link_subscribe_quest_button'
+#         link_callback_data = 'link_to_channel'
+#         check_callback_data = 'check_subscribe_tg_channel_quest'
+#         quest_code = 'subscribe_tg_channel_quest_message'
+#         url = get_latest_tweet_url(users_db)
+#
+#     link_button = telebot.types.InlineKeyboardButton(get_button_name(db, user_id, link_button_key),
+#                                                      callback_data=link_callback_data, url=url)
+#     check_button = telebot.types.InlineKeyboardButton(get_button_name(db, user_id, "check_quest_button"),
+#                                                       callback_data=check_callback_data)
+#
+#     keyboard = telebot.types.InlineKeyboardMarkup().add(link_button, check_button)
+#
+#     message = get_message_text(db, user_id, quest_code)
+#
+#     image_path = 'webp_images/language.webp'
+#
+#     try:
+#         # Open the image file
+#         with open(image_path, 'rb') as image_file:
+#             # Send both text and image in a single message
+#             bot.send_photo(call.message.chat.id, photo=image_file, caption=message,
+#                            reply_markup=keyboard)
+#     except FileNotFoundError:
+#         # Handle the case where the image file is not found
+#         bot.reply_to(call.message, "Error: Image not found.")
+#
+#     twitter_link_clicked(db, user_id)
+
+
+async def handle_link_buttons(rt, db, call):
+    user_id = call.message.chat.id
+    link_type = call.data.replace('link_', '')
+    if link_type == 'to_twitter':
+        await rt.jobs.schedule("record_twitter_click", delay=TWITTER_CLICK_DELAY.total_seconds(), user_id=user_id)
+
+    elif link_type == 'bot_quest_button':
+        pass
+
+    elif link_type == 'subscribe_quest_button':
+        pass
+
+
+async def handle_check_buttons(rt, db, call):
+    user_id = call.message.chat.id
+    check_type = call.data.replace('check_', '')
+
+    if check_type == 'daily_quest':
+        await rt.jobs.schedule("verify_daily_quest", user_id=user_id, message_id=call.message.message_id)
+
+    elif check_type == 'another_bot_quest':
+        pass
+
+    elif check_type == 'subscribe_tg_channel_quest':
+        pass
+
+
+LEADERBOARD_TITLES = {
+    "balance": "leaderboard_balance_title",
+    "amount_of_referrals": "leaderboard_referrals_title",
+}
+
+
+async def send_leaderboard(rt, db, user_id, metric):
+    leaderboard = rt.leaderboards[metric]
+    user_value = getattr(await db.get_user(user_id, (metric,)), metric, None) or 0
+    rank, exact = leaderboard.rank(user_id, user_value)
+
+    lines = [await get_message_text(db=db, user_id=user_id, message_key=LEADERBOARD_TITLES[metric]), ""]
+    for position, (top_user_id, value) in enumerate(leaderboard.top(), start=1):
+        message_key = 'leaderboard_own_entry' if top_user_id == user_id else 'leaderboard_entry'
+        lines.append(await get_message_text(db=db, user_id=user_id, message_key=message_key, position=position,
+                                            value=value))
+
+    rank_message_key = 'leaderboard_rank_message' if exact else 'leaderboard_approximate_rank_message'
+    lines += ["", await get_message_text(db=db, user_id=user_id, message_key=rank_message_key, rank=rank)]
+
+    await rt.bot.send_message(user_id, "\n".join(lines), parse_mode='HTML',
+                              reply_markup=(await get_keyboards(db, user_id)).leaderboard)
+
+
+async def handle_leaderboard(rt, db, message):
+    await send_leaderboard(rt, db, message.chat.id, "balance")
+
+
+async def leaderboard_callback(rt, db, call):
+    await rt.bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+    await send_leaderboard(rt, db, call.message.chat.id, call.data.replace('top_', '', 1))
+
+
+async def language_handler(rt, db, message):
+    user_id = message.chat.id
+
+    # Keyboard with language options
+    keyboard = KEYBOARDS.language_picker
+
+    language_choose_message = await get_message_text(db=db, user_id=user_id, message_key='language_choose_message')
+
+    # Specify the path to the image you want to send
+    image_path = 'webp_images/language.webp'
+
+    try:
+        # Send both text and image in a single message
+        await rt.media.send_photo(message.chat.id, image_path, caption=language_choose_message, reply_markup=keyboard)
+    except FileNotFoundError:
+        # Handle the case where the image file is not found
+        await rt.bot.reply_to(message, "Error: Image not found.")
+
+
+async def language_buttons_callback(rt, db, call):
+    await rt.bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+    user_id = call.message.chat.id
+    language_code = call.data
+
+    try:
+        # Update user's language in the database
+        await change_user_language(db, user_id, language_code)
+        # Cached cooldown answers are in the old language
+        rt.throttle.forget_cooldowns(user_id)
+
+        keyboard = await generate_main_keyboard(db, user_id=user_id)
+
+        # Send confirmation message
+        await rt.bot.send_message(
+            user_id,
+            await get_message_text(db=db, user_id=user_id, message_key='language_switched_message'),
+            reply_markup=keyboard)
+
+    except ValueError as ex:
+        # Handle invalid language code
+        await rt.bot.send_message(user_id, str(ex))
+
+
+async def record_twitter_click(rt, user_id):
+    await twitter_link_clicked(rt.db, user_id)
+
+
+async def verify_daily_quest(rt, user_id, message_id):
+    db = UserContext(rt.db, user_id)
+
+    if await mark_daily_quest_completed(db, user_id):
+        message = await get_message_text(db, user_id, 'daily_quest_completed_message')
+        await rt.bot.send_message(user_id, message)
+        await rt.bot.delete_message(chat_id=user_id, message_id=message_id)
+    else:
+        message = await get_message_text(db, user_id, 'daily_quest_failed_message')
+        await rt.bot.send_message(user_id, message)
+
+
+COMMAND_HANDLERS = {
+    "start": start,
+}
+
+TEXT_HANDLERS = {
+    "pillage_button": handle_pillage,
+    "referrals_button": handle_squad,
+    "balance_button": handle_balance,
+    "quests_button": handle_quests,
+    "language_button": language_handler,
+    "leaderboard_button": handle_leaderboard,
+}
+
+CALLBACK_HANDLERS = {
+    "initiation": handle_initiation,
+    "claim_gold": claim_gold_callback,
+    "reminders": plunder_reminders_callback,
+    "leaderboard": leaderboard_callback,
+    "link": handle_link_buttons,
+    "check": handle_check_buttons,
+    "language": language_buttons_callback,
+}
+
+
+# Delayed jobs scheduled with rt.jobs.schedule, by name
+JOB_HANDLERS = {
+    "record_twitter_click": record_twitter_click,
+    "verify_daily_quest": verify_daily_quest,
+}
+
+
+async def dispatch_start(rt, message):
+    user_id = message.chat.id
+    # Repeated /start taps with the same deep link are collapsed, another link is a new tap
+    if not rt.throttle.admit(user_id, "start", message.text):
+        return
+    try:
+        await COMMAND_HANDLERS["start"](rt, UserContext(rt.db, user_id), message)
+    finally:
+        rt.throttle.done(user_id, "start", message.text)
+
+
+async def dispatch_menu_button(rt, message):
+    user_id = message.chat.id
+    db = UserContext(rt.db, user_id)
+    button_key = route_text(message.text)
+
+    if button_key is None:
+        # Possibly a label of a locale this process hasn't loaded yet; loading the user's locale indexes it
+        CATALOGS.catalog(await get_user_language(db, user_id))
+        button_key = route_text(message.text)
+        if button_key is None:
+            return
+
+    if not rt.throttle.admit(user_id, button_key):
+        return
+    try:
+        await TEXT_HANDLERS[button_key](rt, db, message)
+    finally:
+        rt.throttle.done(user_id, button_key)
+
+
+async def dispatch_callback(rt, call):
+    user_id = call.message.chat.id
+    action = route_callback(call.data)
+    if not rt.throttle.admit(user_id, action, call.data):
+        return
+    try:
+        await CALLBACK_HANDLERS[action](rt, UserContext(rt.db, user_id), call)
+    finally:
+        rt.throttle.done(user_id, action, call.data)
+
+
+def register_handlers(bot, rt, run):
+    """
+    Registers the shared handlers on a TeleBot or an AsyncTeleBot.
+
+    Args:
+        bot: The TeleBot or AsyncTeleBot receiving updates.
+        rt: The Runtime the handlers use for outgoing calls.
+        run: Turns a handler coroutine into what the bot expects a handler to return: run_blocking for TeleBot,
+            the coroutine itself for AsyncTeleBot.
+    """
+    bot.register_message_handler(lambda message: run(dispatch_start(rt, message)), commands=['start'])
+    bot.register_message_handler(lambda message: run(dispatch_menu_button(rt, message)),
+                                 func=lambda message: route_text(message.text) is not None
+                                 or (CATALOGS.has_unloaded_languages and message.text is not None))
+    bot.register_callback_query_handler(lambda call: run(dispatch_callback(rt, call)),
+                                        func=lambda call: route_callback(call.data) is not None)
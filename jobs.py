@@ -0,0 +1,101 @@
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Resolution of the in-memory timer: due jobs start at most this late
+TICK_SECONDS = 0.5
+# Seconds between polls of the jobs collection for jobs scheduled by other replicas or before a restart
+POLL_INTERVAL = 5
+# Due jobs claimed per poll
+POLL_BATCH_SIZE = 100
+
+# A running job whose owner hasn't finished it within the lease is run again elsewhere
+LEASE_SECONDS = 60
+# Attempts before a failing job is kept as failed, and the delay before each retry
+MAX_ATTEMPTS = 5
+RETRY_DELAY_SECONDS = 30
+
+
+class JobScheduler:
+    """
+    Runs "call job X with these arguments at time T" without holding a worker thread until T.
+
+    Jobs are stored in the jobs collection, so they survive restarts and any replica can run them. Jobs scheduled
+    by this process also go into an in-memory heap and start within TICK_SECONDS of their time; the rest are
+    found by polling the collection every POLL_INTERVAL seconds. A job is claimed atomically before it runs and
+    deleted when it succeeds, so it runs once, or again after a crash (at least once). Jobs run on the
+    scheduler's own tasks executor, not on the bot's worker threads.
+    """
+
+    def __init__(self, db, tasks):
+        self.db = db
+        self.tasks = tasks
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._timers = []  # heap of (run_at, job_id)
+        # Handlers push from worker threads in the threaded runtime; never held across an await
+        self._timers_lock = threading.Lock()
+
+    async def schedule(self, name, delay=0, **args):
+        """
+        Stores a job and returns its id.
+
+        Args:
+            name: The key of the job function in the handlers passed to run.
+            delay: Seconds from now until the job is due.
+            **args: Keyword arguments for the job function; must be storable in MongoDB.
+        """
+        run_at = time.time() + delay
+        job_id = await self.db.insert_job(name, args, run_at)
+        with self._timers_lock:
+            heapq.heappush(self._timers, (run_at, job_id))
+        return job_id
+
+    async def run(self, rt, handlers):
+        """
+        Background job that starts due jobs. handlers maps job names to coroutine functions
+        handler(rt, **args).
+        """
+        next_poll = 0
+
+        while True:
+            now = time.time()
+
+            due_job_ids = []
+            with self._timers_lock:
+                while self._timers and self._timers[0][0] <= now:
+                    due_job_ids.append(heapq.heappop(self._timers)[1])
+
+            if now >= next_poll:
+                next_poll = now + POLL_INTERVAL
+                try:
+                    due_job_ids.extend(await self.db.get_due_job_ids(now, POLL_BATCH_SIZE))
+                except Exception:
+                    logger.exception("Polling for due jobs failed")
+
+            for job_id in dict.fromkeys(due_job_ids):
+                try:
+                    job = await self.db.claim_job(job_id, self.owner, now, LEASE_SECONDS)
+                except Exception:
+                    logger.exception("Claiming job %s failed", job_id)
+                    continue
+                if job is not None:
+                    self.tasks.submit(self._execute(rt, handlers, job))
+
+            await self.tasks.sleep(TICK_SECONDS)
+
+    async def _execute(self, rt, handlers, job):
+        try:
+            await handlers[job["name"]](rt, **job["args"])
+        except Exception as e:
+            retry_at = time.time() + RETRY_DELAY_SECONDS if job["attempts"] < MAX_ATTEMPTS else None
+            logger.exception("Job %s (%s) failed on attempt %s", job["_id"], job["name"], job["attempts"])
+            await self.db.release_job(job["_id"], retry_at, repr(e))
+            return
+
+        await self.db.complete_job(job["_id"])
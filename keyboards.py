@@ -0,0 +1,84 @@
+import telebot
+from localization import CATALOGS
+import config
+
+
+class LanguageKeyboards:
+    """
+    The keyboards of one language, serialized to the JSON reply_markup the Bot API takes.
+
+    Handlers pass these strings as reply_markup directly; TeleBot sends strings as they are.
+    """
+
+    __slots__ = ("catalog", "main", "initiation", "claim", "invite", "plunder_ready", "reminders_on",
+                 "leaderboard")
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+        main = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+        main.add(telebot.types.KeyboardButton(catalog.label("pillage_button")),
+                 telebot.types.KeyboardButton(catalog.label("referrals_button")))
+        main.add(telebot.types.KeyboardButton(catalog.label("balance_button")),
+                 telebot.types.KeyboardButton(catalog.label("quests_button")))
+        main.add(telebot.types.KeyboardButton(catalog.label("leaderboard_button")),
+                 telebot.types.KeyboardButton(catalog.label("language_button")))
+        self.main = main.to_json()
+
+        self.initiation = _inline_button(catalog.label("initiation_button"), callback_data="initiation")
+        self.claim = _inline_button(catalog.label("claim_button"), callback_data="claim_gold")
+        self.invite = _inline_button(catalog.label("invite_button"), callback_data="invite", url=config.INVITE_URL)
+
+        plunder_ready = telebot.types.InlineKeyboardMarkup()
+        plunder_ready.add(telebot.types.InlineKeyboardButton(catalog.label("claim_button"), callback_data="claim_gold"))
+        plunder_ready.add(telebot.types.InlineKeyboardButton(catalog.label("plunder_reminders_off_button"),
+                                                             callback_data="reminders_off"))
+        self.plunder_ready = plunder_ready.to_json()
+        leaderboard = telebot.types.InlineKeyboardMarkup()
+        leaderboard.row(telebot.types.InlineKeyboardButton(catalog.label("leaderboard_balance_button"),
+                                                           callback_data="top_balance"),
+                        telebot.types.InlineKeyboardButton(catalog.label("leaderboard_referrals_button"),
+                                                           callback_data="top_amount_of_referrals"))
+        self.leaderboard = leaderboard.to_json()
+        self.reminders_on = _inline_button(catalog.label("plunder_reminders_on_button"), callback_data="reminders_on")
+
+
+def _inline_button(text, **kwargs):
+    return telebot.types.InlineKeyboardMarkup().add(telebot.types.InlineKeyboardButton(text, **kwargs)).to_json()
+
+
+class KeyboardCache:
+    """
+    Builds the keyboards of a language once, from its compiled catalog, and rebuilds them only when the
+    catalog object changes.
+    """
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self._keyboards = {}  # language_code -> LanguageKeyboards
+        self._language_picker = None
+
+    def get(self, language_code):
+        catalog = self.catalogs.catalog(language_code)
+        keyboards = self._keyboards.get(catalog.language_code)
+
+        if keyboards is None or keyboards.catalog is not catalog:
+            keyboards = self._keyboards[catalog.language_code] = LanguageKeyboards(catalog)
+        return keyboards
+
+    @property
+    def language_picker(self):
+        """
+        The inline keyboard listing every language; the same for all users. The language list is fixed when the
+        catalogs are created, so it is built once.
+        """
+        if self._language_picker is None:
+            keyboard = telebot.types.InlineKeyboardMarkup()
+            for language_code in self.catalogs.language_codes:
+                keyboard.add(telebot.types.InlineKeyboardButton(text=self.catalogs.language_name(language_code),
+                                                                callback_data=language_code))
+            self._language_picker = keyboard.to_json()
+        return self._language_picker
+
+
+KEYBOARDS = KeyboardCache(CATALOGS)
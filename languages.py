@@ -6,12 +6,21 @@ LANGUAGES = {
         "pillage_info_message": "☠️ Click Plunder to claim the gold for yourself. \n\n🕓 Plunder time: 4 hours. \n💰 Gold per plunder: 100 #Gold.",
         "pillage_success_message": "✅ Gold is yours! \n\nYou'll return home in 4 hours and can go plundering again.",
         "pillage_failure_message": "⏳ You head home with a heavy sack on your shoulders. \n\nNext plunder in: {reward_time}",
+        "plunder_ready_message": "🧌 Your goblins are back from the mine! \n\n☠️ Time to plunder again.",
+        "plunder_reminders_off_message": "🔕 You won't get plunder reminders anymore.",
+        "plunder_reminders_on_message": "🔔 Plunder reminders are on again.",
+        "leaderboard_balance_title": "🏆 <b>Top goblins by gold</b>",
+        "leaderboard_referrals_title": "🏆 <b>Top goblins by gang size</b>",
+        "leaderboard_entry": "{position}. 🧌 {value}",
+        "leaderboard_own_entry": "{position}. 🧌 {value} ← you",
+        "leaderboard_rank_message": "Your place: {rank}",
+        "leaderboard_approximate_rank_message": "Your place: about {rank}",
         "current_balance_message": "💰 You have {user_balance} #Gold. \n\nTo earn more, invite friends to the gang and plunder the mine! \n\n1 friend = 500 #Gold. \n1 plunder = 100 #Gold.",
         "twitter_link_message": "https://twitter.com/{TWITTER_USERNAME}/status/latest",
         "invalid_button_message": "No such button!",
         "language_choose_message": "Choose language:",
         "language_switched_message": "Language selected",
-        "referrals_info_message": "👥 <b>You have {amount_of_referrals} goblins in your gang!</b> \n\n💰 Invite more friends and get more gold. \n\nYour referral link: \n\n<code>{base_url}{referral_code}</code>",
+        "referrals_info_message": "👥 <b>You have {amount_of_referrals} goblins in your gang!</b> \n\n🧌 Recruited by them: {gang_level_2} \n⚔️ Whole gang: {gang_total} \n\n💰 Invite more friends and get more gold. \n\nYour referral link: \n\n<code>{base_url}{referral_code}</code>",
         # "quests_list_message": "🧭 Complete quests to earn more gold!",
         "quests_list_message": "🧭 Coming soon!",
         "quests_list_empty_message": "🧭 Coming soon!",
@@ -35,6 +44,11 @@ LANGUAGES = {
         "link_subscribe_quest_button": "Subscribe",
         "initiation_button": "Begin journey",
         "invite_button": "Invite friends",
+        "plunder_reminders_off_button": "🔕 Don't remind me",
+        "plunder_reminders_on_button": "🔔 Remind me again",
+        "leaderboard_button": "🏆 Top",
+        "leaderboard_balance_button": "💰 By gold",
+        "leaderboard_referrals_button": "👥 By gang",
     },
     "ru": {
         "new_user_message": "🤚  <b>Привет, странник!</b> \n\n🧌 Ты попал в мир гоблинов. \nДобывай золото, меняй на токены, зови друзей и строй гоблинскую банду. \n\n👇 Чтобы начать добычу, подпишись на канал @Angry_goblin",
@@ -43,12 +57,21 @@ LANGUAGES = {
         "pillage_info_message": "☠️Нажми Ограбить, чтобы забрать золото себе. \n\n🕓 Время грабежа: 4 часа. \n💰 Золото за грабёж: 100 #Gold.",
         "pillage_success_message": "✅ Золото у тебя! \n\nЧерез 4 часа ты вернешься домой и сможешь снова отправиться на грабеж.",
         "pillage_failure_message": "⏳Ты идёшь домой с тяжелым мешком за плечами. \n\nСледующий грабеж через: {reward_time}",
+        "plunder_ready_message": "🧌 Твои гоблины вернулись из шахты! \n\n☠️ Пора снова на грабёж.",
+        "plunder_reminders_off_message": "🔕 Напоминания о грабеже отключены.",
+        "plunder_reminders_on_message": "🔔 Напоминания о грабеже снова включены.",
+        "leaderboard_balance_title": "🏆 <b>Топ гоблинов по золоту</b>",
+        "leaderboard_referrals_title": "🏆 <b>Топ гоблинов по размеру банды</b>",
+        "leaderboard_entry": "{position}. 🧌 {value}",
+        "leaderboard_own_entry": "{position}. 🧌 {value} ← ты",
+        "leaderboard_rank_message": "Твоё место: {rank}",
+        "leaderboard_approximate_rank_message": "Твоё место: примерно {rank}",
         "current_balance_message": "💰 У тебя {user_balance} #Gold. \n\nЧтобы заработать больше, приглашай друзей в банду и грабь рудник! \n\n1 друг = 500 #Gold. \n1 грабеж 100 #Gold. ",
         "twitter_link_message": "https://twitter.com/{TWITTER_USERNAME}/status/latest",
         "invalid_button_message": "Нет такой кнопки!",
         "language_choose_message": "Выберите язык:",
         "language_switched_message": "Язык выбран",
-        "referrals_info_message": "👥 <b>В твоей банде {amount_of_referrals} гоблинов!</b> \n\n💰 Зови больше друзей и получай больше золота. \n\nТвоя реферальная ссылка: \n\n<code>{base_url}{referral_code}</code>",
+        "referrals_info_message": "👥 <b>В твоей банде {amount_of_referrals} гоблинов!</b> \n\n🧌 Их новобранцы: {gang_level_2} \n⚔️ Вся банда: {gang_total} \n\n💰 Зови больше друзей и получай больше золота. \n\nТвоя реферальная ссылка: \n\n<code>{base_url}{referral_code}</code>",
         "quests_list_message": "🧭 Выполняй квесты, чтобы получать больше золота!",
         "quests_list_empty_message": "🧭 В разработке",
         "daily_quest_message": "Сделай репост последнего нашего твита и удвой всё золото с грабежей!",
@@ -71,5 +94,10 @@ LANGUAGES = {
         "link_subscribe_quest_button": "Подписаться",
         "invite_button": "Пригласить друзей",
         "initiation_button": "Начать путешествие",
+        "plunder_reminders_off_button": "🔕 Не напоминать",
+        "plunder_reminders_on_button": "🔔 Напоминать снова",
+        "leaderboard_button": "🏆 Топ",
+        "leaderboard_balance_button": "💰 По золоту",
+        "leaderboard_referrals_button": "👥 По банде",
     }
 }
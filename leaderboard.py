@@ -0,0 +1,207 @@
+import bisect
+import logging
+import math
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Users whose rank is exact; the leaderboard view shows the first LEADERBOARD_SIZE of them
+TOP_SIZE = 100
+LEADERBOARD_SIZE = 10
+
+# Seconds between reloads of the top from the indexes, which bring in changes made by other replicas
+TOP_REFRESH_INTERVAL = 60
+# Seconds between rebuilds of the rank histograms, one aggregation over all users each
+HISTOGRAM_REBUILD_INTERVAL = 10 * 60
+
+# Histogram buckets per factor of 10 in value; a bucket spans ~2.3% of its values
+BUCKETS_PER_DECADE = 100
+
+# The metrics a leaderboard can be ranked by
+METRICS = ("balance", "amount_of_referrals")
+
+
+def value_bucket(value):
+    return math.floor(math.log10(max(value, 0) + 1) * BUCKETS_PER_DECADE)
+
+
+class Leaderboard:
+    """
+    The top TOP_SIZE users by one metric, and approximate ranks for everybody else.
+
+    The top is loaded from the metric's descending index and then kept up to date from every change UsersDb
+    reports in this process; a periodic reload picks up changes made elsewhere. Ranks below the top come from
+    a histogram of the metric over all users, rebuilt periodically: the number of users in higher buckets plus
+    an interpolated share of the user's own bucket. All reads are served from memory: the top in O(1), a rank
+    in O(log TOP_SIZE) or O(log buckets).
+    """
+
+    def __init__(self, metric, size=TOP_SIZE):
+        self.metric = metric
+        self.size = size
+        self._top = []  # [(-value, user_id)], best first
+        self._top_values = {}  # user_id -> value, for users in _top
+        # Set when a user may have dropped out of the top, which only a reload can tell
+        self._stale = False
+        self._buckets = []  # bucket numbers, ascending
+        self._counts_above = []  # users in buckets above each bucket
+        self._bucket_counts = []
+        self._bucket_ranges = []  # (lowest value, highest value) in each bucket
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def load_top(self, users):
+        """
+        Replaces the top with users, a list of (user_id, value) sorted best first.
+        """
+        with self._lock:
+            # Sorted again, as the order of ties is up to the database and observe() bisects on user_id too
+            self._top = sorted((-value, user_id) for user_id, value in users[:self.size])
+            self._top_values = {user_id: value for user_id, value in users[:self.size]}
+            self._stale = False
+
+    def load_histogram(self, bucket_counts):
+        """
+        Replaces the rank histogram with bucket_counts, a dict of {value_bucket: (number of users, lowest
+        value, highest value)}.
+        """
+        buckets = sorted(bucket_counts)
+        counts = [bucket_counts[bucket][0] for bucket in buckets]
+        ranges = [bucket_counts[bucket][1:] for bucket in buckets]
+
+        counts_above = [0] * len(buckets)
+        above = 0
+        for index in range(len(buckets) - 1, -1, -1):
+            counts_above[index] = above
+            above += counts[index]
+
+        with self._lock:
+            self._buckets, self._bucket_counts, self._bucket_ranges = buckets, counts, ranges
+            self._counts_above, self._total = counts_above, above
+
+    def observe(self, user_id, value):
+        """
+        Records a user's new value. Called by UsersDb after every change of the metric.
+        """
+        with self._lock:
+            old_value = self._top_values.get(user_id)
+            if old_value == value:
+                return
+
+            full = len(self._top) >= self.size
+            if old_value is None and full and (-value, user_id) >= self._top[-1]:
+                # Not good enough for the top
+                return
+
+            if old_value is not None:
+                del self._top[bisect.bisect_left(self._top, (-old_value, user_id))]
+                if value < old_value and full:
+                    # Someone outside the top may now be ahead of this user
+                    self._stale = True
+
+            bisect.insort(self._top, (-value, user_id))
+            self._top_values[user_id] = value
+            if len(self._top) > self.size:
+                _, dropped_user_id = self._top.pop()
+                del self._top_values[dropped_user_id]
+
+    @property
+    def stale(self):
+        return self._stale
+
+    def top(self, count=LEADERBOARD_SIZE):
+        """
+        Returns the best count users as a list of (user_id, value).
+        """
+        return [(user_id, -negated_value) for negated_value, user_id in self._top[:count]]
+
+    def rank(self, user_id, value):
+        """
+        Returns (rank, exact): the 1-based rank of a user with the given value, and whether it is exact.
+        """
+        with self._lock:
+            if user_id in self._top_values:
+                return bisect.bisect_left(self._top, (-self._top_values[user_id], user_id)) + 1, True
+
+            bucket = value_bucket(value)
+            index = bisect.bisect_left(self._buckets, bucket)
+            if index == len(self._buckets):
+                # Above every bucket of the last rebuild
+                return len(self._top) + 1, False
+
+            above = self._counts_above[index]
+            if self._buckets[index] == bucket:
+                # Assume the users of the bucket are spread evenly between its lowest and highest value; a
+                # bucket of a single value (say, everybody's first plunder) is all ties
+                lowest, highest = self._bucket_ranges[index]
+                share_above = (highest - value) / (highest - lowest + 1) if highest > lowest else 0
+                above += round(self._bucket_counts[index] * min(max(share_above, 0), 1))
+
+            # Never claim a better rank than the exact top allows
+            return max(above + 1, len(self._top) + 1), False
+
+
+class Leaderboards:
+    """
+    A Leaderboard per metric, fed by UsersDb and refreshed in the background by run().
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.boards = {metric: Leaderboard(metric) for metric in METRICS}
+        db.add_change_listener(self.observe)
+
+    def __getitem__(self, metric):
+        return self.boards[metric]
+
+    def observe(self, user_id, changes):
+        for metric, value in changes.items():
+            board = self.boards.get(metric)
+            if board is not None and value is not None:
+                board.observe(user_id, value)
+
+    async def refresh_top(self):
+        for metric, board in self.boards.items():
+            board.load_top(await self.db.get_top_users(metric, board.size))
+
+    async def rebuild_histograms(self):
+        for metric, board in self.boards.items():
+            started = time.monotonic()
+            bucket_counts = await self.db.get_value_histogram(metric, BUCKETS_PER_DECADE)
+            board.load_histogram(bucket_counts)
+            # Processes that don't build the histograms themselves load this copy
+            await self.db.set_rank_histogram(metric, bucket_counts)
+            logger.info("Rebuilt the %s rank histogram in %.1fs", metric, time.monotonic() - started)
+
+    async def load_histograms(self):
+        for metric, board in self.boards.items():
+            bucket_counts = await self.db.get_rank_histogram(metric)
+            if bucket_counts is not None:
+                board.load_histogram(bucket_counts)
+
+    async def run(self, tasks, build_histograms=True):
+        """
+        Background job that reloads the tops every TOP_REFRESH_INTERVAL seconds (sooner when one went stale)
+        and rebuilds the histograms every HISTOGRAM_REBUILD_INTERVAL seconds. Without build_histograms, it loads
+        the histograms another process stored every TOP_REFRESH_INTERVAL seconds instead of aggregating them.
+        """
+        next_top_refresh = next_histogram_rebuild = 0
+
+        while True:
+            now = time.monotonic()
+            try:
+                if now >= next_top_refresh or any(board.stale for board in self.boards.values()):
+                    await self.refresh_top()
+                    next_top_refresh = now + TOP_REFRESH_INTERVAL
+                if now >= next_histogram_rebuild:
+                    if build_histograms:
+                        await self.rebuild_histograms()
+                        next_histogram_rebuild = now + HISTOGRAM_REBUILD_INTERVAL
+                    else:
+                        await self.load_histograms()
+                        next_histogram_rebuild = now + TOP_REFRESH_INTERVAL
+            except Exception:
+                logger.exception("Refreshing the leaderboards failed")
+            await tasks.sleep(1)
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import threading
+from string import Formatter
+from types import MappingProxyType
+from languages import LANGUAGES
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANGUAGE = "en"
+
+# Extra locales, one <language_code>.json file of {key: text} each, compiled the first time they are used
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+
+# The keyword arguments callers pass when rendering these messages; every translation may only use these names
+MESSAGE_PLACEHOLDERS = {
+    "pillage_failure_message": {"reward_time"},
+    "current_balance_message": {"user_balance"},
+    "twitter_link_message": {"TWITTER_USERNAME"},
+    "referrals_info_message": {"amount_of_referrals", "gang_level_2", "gang_total", "base_url", "referral_code"},
+    "leaderboard_entry": {"position", "value"},
+    "leaderboard_own_entry": {"position", "value"},
+    "leaderboard_rank_message": {"rank"},
+    "leaderboard_approximate_rank_message": {"rank"},
+}
+
+
+class Template:
+    """
+    A catalog text parsed once. Plain {name} placeholders are rendered by joining the pre-split parts; texts
+    with format specs, conversions or attribute access fall back to str.format.
+    """
+
+    __slots__ = ("text", "fields", "_parts", "_constant")
+
+    def __init__(self, text):
+        self.text = text
+        parts = []
+        simple = True
+
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            if field_name is not None and (format_spec or conversion or not field_name.isidentifier()):
+                simple = False
+            parts.append((literal, field_name))
+
+        self.fields = frozenset(field_name for _, field_name in parts if field_name is not None)
+        self._parts = tuple(parts) if simple else None
+        # What str.format returns for texts without placeholders ({{ and }} unescaped)
+        self._constant = "".join(literal for literal, _ in parts) if not self.fields else None
+
+    def render(self, kwargs):
+        if self._constant is not None:
+            return self._constant
+        if self._parts is None:
+            return self.text.format(**kwargs)
+        return "".join(literal if field_name is None else literal + format(kwargs[field_name])
+                       for literal, field_name in self._parts)
+
+
+class Catalog:
+    """
+    The immutable compiled texts of one language, with the default language's texts filling its gaps.
+    """
+
+    __slots__ = ("language_code", "_templates")
+
+    def __init__(self, language_code, templates):
+        self.language_code = language_code
+        self._templates = MappingProxyType(templates)
+
+    def __contains__(self, key):
+        return key in self._templates
+
+    def render(self, message_key, **kwargs):
+        return self._templates[message_key].render(kwargs)
+
+    def label(self, key):
+        """
+        Returns a text as is, e.g. a button label, or the key itself if no language has it.
+        """
+        template = self._templates.get(key)
+        return template.text if template is not None else key
+
+    def labels(self, keys):
+        return {key: self._templates[key].text for key in keys if key in self._templates}
+
+
+def compile_templates(language_code, texts):
+    """
+    Parses the texts of one language and checks their placeholders against MESSAGE_PLACEHOLDERS.
+
+    Raises:
+        ValueError: If a text uses a placeholder its callers don't pass.
+    """
+    templates = {}
+
+    for key, text in texts.items():
+        template = Template(text)
+        expected = MESSAGE_PLACEHOLDERS.get(key, set())
+
+        unknown = {field_name.split(".")[0].split("[")[0] for field_name in template.fields} - expected
+        if unknown:
+            raise ValueError(f"{language_code}.{key} uses placeholders {sorted(unknown)} its callers don't pass.")
+        if template.fields != expected:
+            logger.warning("%s.%s leaves out placeholders %s", language_code, key, sorted(expected - template.fields))
+
+        templates[key] = template
+
+    return templates
+
+
+class Localization:
+    """
+    All catalogs, by language code. The languages in languages.py are compiled at startup; files in
+    locales_dir are only listed, and compiled when a user of that language first needs them.
+    """
+
+    def __init__(self, languages, locales_dir=LOCALES_DIR, default_language=DEFAULT_LANGUAGE):
+        self.locales_dir = locales_dir
+        self.default_language = default_language
+        default_templates = compile_templates(default_language, languages[default_language])
+        self.default = Catalog(default_language, default_templates)
+
+        self._catalogs = {language_code: Catalog(language_code, {**default_templates,
+                                                                  **compile_templates(language_code, texts)})
+                          for language_code, texts in languages.items() if language_code != default_language}
+        self._catalogs[default_language] = self.default
+
+        self._builtin_languages = list(languages)
+        self._lazy_languages = []
+        if os.path.isdir(locales_dir):
+            self._lazy_languages = sorted(file_name[:-len(".json")] for file_name in os.listdir(locales_dir)
+                                          if file_name.endswith(".json")
+                                          and file_name[:-len(".json")] not in self._catalogs)
+
+        # Shown in the language picker; names of locale files are read without compiling them
+        self._language_names = {language_code: texts.get("language_name", language_code)
+                                for language_code, texts in languages.items()}
+        self._load_listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def language_codes(self):
+        return self._builtin_languages + self._lazy_languages
+
+    @property
+    def has_unloaded_languages(self):
+        return any(language_code not in self._catalogs for language_code in self._lazy_languages)
+
+    def add_load_listener(self, listener):
+        """
+        Calls listener(catalog) for every catalog compiled from now on, e.g. to index its button labels.
+        """
+        self._load_listeners.append(listener)
+
+    def catalog(self, language_code):
+        """
+        Returns the catalog of a language, or the default one for unknown languages.
+        """
+        catalog = self._catalogs.get(language_code)
+        if catalog is not None:
+            return catalog
+        if language_code not in self._lazy_languages:
+            return self.default
+
+        with self._lock:
+            catalog = self._catalogs.get(language_code)
+            if catalog is None:
+                templates = compile_templates(language_code, self._read_locale(language_code))
+                catalog = Catalog(language_code, {**self.default._templates, **templates})
+                for listener in self._load_listeners:
+                    listener(catalog)
+                self._catalogs[language_code] = catalog
+                logger.info("Loaded locale %s", language_code)
+        return catalog
+
+    def language_name(self, language_code):
+        if language_code not in self._language_names:
+            self._language_names[language_code] = self._read_locale(language_code).get("language_name",
+                                                                                        language_code)
+        return self._language_names[language_code]
+
+    def _read_locale(self, language_code):
+        with open(os.path.join(self.locales_dir, f"{language_code}.json"), encoding="utf-8") as locale_file:
+            return json.load(locale_file)
+
+
+CATALOGS = Localization(LANGUAGES)
@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import os
+from runtime import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+
+class MediaRegistry:
+    """
+    Sends images from webp_images by Telegram file_id instead of uploading the bytes on every send.
+
+    The first send of a file uploads it and stores the file_id Telegram returns in the media collection,
+    keyed by the bot id and the SHA-256 of the file content. A changed file therefore gets a new key and is
+    uploaded again, and file_ids survive restarts and are shared between replicas of the same bot.
+    """
+
+    def __init__(self, db, bot, bot_token):
+        self.db = db
+        self.bot = bot
+        # file_ids are only valid for the bot that uploaded them; the id part of the token is enough
+        self.bot_id = bot_token.split(":")[0]
+        self._file_hashes = {}  # image_path -> (mtime_ns, size, sha256)
+        self._file_ids = {}  # media key -> file_id
+
+    def _content_hash(self, image_path):
+        # Raises FileNotFoundError like open() did, so callers keep their error handling
+        stat = os.stat(image_path)
+        cached = self._file_hashes.get(image_path)
+
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+
+        with open(image_path, 'rb') as image_file:
+            content_hash = hashlib.sha256(image_file.read()).hexdigest()
+
+        self._file_hashes[image_path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return content_hash
+
+    def _media_key(self, image_path):
+        return f"{self.bot_id}:{self._content_hash(image_path)}"
+
+    async def send_photo(self, chat_id, image_path, **kwargs):
+        """
+        Sends an image, by file_id when one is known and by upload otherwise.
+
+        Args:
+            chat_id: The chat to send the photo to.
+            image_path: The path of the image inside webp_images.
+            **kwargs: Extra arguments for bot.send_photo (caption, reply_markup, parse_mode, ...).
+
+        Returns:
+            The sent message.
+        """
+        media_key = self._media_key(image_path)
+        file_id = self._file_ids.get(media_key)
+
+        if file_id is None:
+            file_id = await self.db.get_media_file_id(media_key)
+
+        if file_id is not None:
+            try:
+                sent_message = await self.bot.send_photo(chat_id, photo=file_id, **kwargs)
+                self._file_ids[media_key] = file_id
+                return sent_message
+            except ApiTelegramException as e:
+                # Only a rejected file_id is worth a fresh upload; anything else would fail again
+                if e.error_code != 400 or "file" not in str(e.description).lower():
+                    raise
+                logger.warning("Stored file_id for %s was rejected (%s), uploading again", image_path, e.description)
+                self._file_ids.pop(media_key, None)
+
+        with open(image_path, 'rb') as image_file:
+            sent_message = await self.bot.send_photo(chat_id, photo=image_file, **kwargs)
+
+        file_id = sent_message.photo[-1].file_id
+        self._file_ids[media_key] = file_id
+        await self.db.set_media_file_id(media_key, file_id, image_path)
+
+        return sent_message
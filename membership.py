@@ -0,0 +1,126 @@
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+# get_chat_member statuses that count as being in the channel
+MEMBER_STATUSES = ("member", "administrator")
+
+# Members rarely leave, and the background re-verifier refreshes them before the entry expires
+POSITIVE_TTL = 6 * 60 * 60
+# Short: it only absorbs repeated taps, a user who has just joined must pass on the next one
+NEGATIVE_TTL = 5
+
+# get_chat_member calls per second the background re-verifier may spend
+REVERIFY_RATE = 2
+# Members are re-checked when less than this share of their TTL is left
+REVERIFY_AHEAD = 0.25
+
+
+class MembershipChecker:
+    """
+    Answers "is this user in the channel?" from a TTL cache in front of get_chat_member.
+
+    Positive and negative answers are cached with their own TTL. Concurrent checks of the same user share one
+    API call: the first caller makes it, the others await its result. run() re-checks cached members in the
+    background shortly before their entry expires, so taps of active members are answered from memory.
+    """
+
+    def __init__(self, bot, tasks, channel_id, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_entries=100000):
+        self.bot = bot
+        self.tasks = tasks
+        self.channel_id = channel_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> (is_member, expires_at), least recently checked first
+        self._reverify_queue = []  # heap of (reverify_at, user_id) for cached members
+        self._in_flight = {}  # user_id -> future of the running get_chat_member call
+        # Only held for dict operations, never across an await, so it works in both runtimes
+        self._lock = threading.Lock()
+
+    async def is_member(self, user_id):
+        """
+        Returns whether the user is a member of the channel, from the cache when the cached answer is fresh.
+        """
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+
+        return await self._check(user_id)
+
+    def forget(self, user_id):
+        """
+        Drops the cached answer for a user, e.g. when Telegram reports that they left the channel.
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    async def _check(self, user_id):
+        with self._lock:
+            future = self._in_flight.get(user_id)
+            leader = future is None
+            if leader:
+                future = self._in_flight[user_id] = self.tasks.create_future()
+
+        if not leader:
+            return await future
+
+        try:
+            status = (await self.bot.get_chat_member(self.channel_id, user_id)).status
+            is_member = status in MEMBER_STATUSES
+            self._store(user_id, is_member)
+            future.set_result(is_member)
+            return is_member
+        except BaseException as e:
+            future.set_exception(e)
+            # Marks the exception as retrieved, whether or not anyone else was waiting
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[user_id]
+
+    def _store(self, user_id, is_member):
+        now = time.monotonic()
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+
+        with self._lock:
+            self._entries[user_id] = (is_member, now + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            if is_member:
+                heapq.heappush(self._reverify_queue, (now + ttl * (1 - REVERIFY_AHEAD), user_id))
+
+    def _next_to_reverify(self, now):
+        with self._lock:
+            while self._reverify_queue and self._reverify_queue[0][0] <= now:
+                _, user_id = heapq.heappop(self._reverify_queue)
+                entry = self._entries.get(user_id)
+                # Skips users evicted, no longer members, expired already or checked again since the push
+                if entry is not None and entry[0] and now < entry[1] <= now + self.positive_ttl * REVERIFY_AHEAD:
+                    return user_id
+        return None
+
+    async def run(self, checks_per_second=REVERIFY_RATE):
+        """
+        Background job that re-checks cached members before their entry expires, at most checks_per_second.
+        Members who are due but don't fit in the budget simply expire and are checked on their next tap.
+        """
+        interval = 1 / checks_per_second
+
+        while True:
+            user_id = self._next_to_reverify(time.monotonic())
+            if user_id is not None:
+                try:
+                    await self._check(user_id)
+                except Exception:
+                    logger.exception("Re-verifying channel membership of user %s failed", user_id)
+            await self.tasks.sleep(interval)
@@ -0,0 +1,347 @@
+import bisect
+import functools
+import inspect
+import ipaddress
+import logging
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from runtime import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from a cached DB read to a slow Telegram call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Seconds between stack samples of the sampling profiler, unless the request asks for another interval
+PROFILER_INTERVAL = 0.01
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """
+    The metrics a process exposes, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_label_text(self.labelnames, labels)} {value}" for labels, value in values]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [count per bucket (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bound_label = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, bound_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Gauges:
+    """
+    Gauges read when the metrics are scraped, e.g. queue lengths, so they cost nothing in between.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelname, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelname = labelname
+        self._functions = {}  # label value -> function returning the current value
+        registry.register(self)
+
+    def track(self, label, function):
+        self._functions[label] = function
+
+    def samples(self):
+        lines = []
+        for label, function in list(self._functions.items()):
+            try:
+                lines.append(f"{self.name}{_label_text((self.labelname,), (label,))} {function()}")
+            except Exception:
+                logger.exception("Reading gauge %s{%s} failed", self.name, label)
+        return lines
+
+
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Time from dispatch to the end of an update's handler.",
+                            ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers that raised.", ("handler",))
+DB_LATENCY = Histogram("bot_db_seconds", "Latency of UsersDb calls.", ("method",))
+DB_ERRORS = Counter("bot_db_errors_total", "UsersDb calls that raised.", ("method",))
+API_LATENCY = Histogram("bot_api_seconds", "Latency of Bot API calls, excluding time queued for the rate limits.",
+                        ("method",))
+API_ERRORS = Counter("bot_api_errors_total", "Bot API calls that failed, by Telegram error code.",
+                     ("method", "code"))
+THROTTLED = Counter("bot_throttled_total", "Taps dropped by the per-user throttle, by action and reason.",
+                    ("action", "reason"))
+QUEUE_DEPTH = Gauges("bot_queue_depth", "Items waiting in the bot's queues.", "queue")
+
+
+def _timed(function, histogram, errors, label):
+    @functools.wraps(function)
+    async def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            errors.inc(label)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started, label)
+
+    return timed
+
+
+def instrument_handlers(*handler_tables):
+    """
+    Wraps the handlers in dicts of {key: handler coroutine function} in place, timing them under their key.
+    """
+    for table in handler_tables:
+        for key, handler in table.items():
+            table[key] = _timed(handler, HANDLER_LATENCY, HANDLER_ERRORS, key)
+
+
+def instrument_db(db):
+    """
+    Times every public coroutine method of a UsersDb, by replacing it on the instance.
+    """
+    for name, method in inspect.getmembers(db, inspect.iscoroutinefunction):
+        if not name.startswith("_"):
+            setattr(db, name, _timed(method, DB_LATENCY, DB_ERRORS, name))
+
+
+class InstrumentedBot:
+    """
+    Wraps the bot adapter (Blocking(TeleBot) or AsyncTeleBot) under RateLimitedBot, timing every API call and
+    counting failures by Telegram error code.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            except ApiTelegramException as e:
+                API_ERRORS.inc(name, str(e.error_code))
+                raise
+            except Exception:
+                API_ERRORS.inc(name, "network")
+                raise
+            finally:
+                API_LATENCY.observe(time.perf_counter() - started, name)
+
+        return call
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every interval seconds while running and counts them in the collapsed
+    format flamegraph.pl and speedscope read ("frame;frame;frame count"). Off until started, so it costs
+    nothing in normal operation; in the asyncio runtime the event loop thread's stack shows the running task.
+    """
+
+    def __init__(self):
+        self._stacks = StackCounter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=PROFILER_INTERVAL):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stacks = StackCounter()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="sampling-profiler",
+                                            daemon=True)
+            self._thread.start()
+        logger.info("Sampling profiler started, every %ss", interval)
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            logger.info("Sampling profiler stopped")
+
+    def collapsed(self):
+        stacks = self._stacks.copy()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def _run(self, interval):
+        own_id = threading.get_ident()
+        while not self._stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename.rsplit('/', 1)[-1]}:"
+                                  f"{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self._stacks[";".join(reversed(frames))] += 1
+
+
+PROFILER = SamplingProfiler()
+
+
+def is_loopback(host):
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    # A dual-stack server sees IPv4 clients as ::ffff:a.b.c.d
+    return (getattr(address, "ipv4_mapped", None) or address).is_loopback
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics serves the registry. The profiler is driven with POST /profiler/start?interval=0.01,
+    POST /profiler/stop and GET /profiler, which returns the stacks sampled so far. The profiler endpoints are
+    unauthenticated and only answer clients on the loopback interface.
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._reply(200, REGISTRY.render(), "text/plain; version=0.0.4")
+        elif path == "/profiler":
+            if not self._forbid_remote():
+                self._reply(200, PROFILER.collapsed(), "text/plain")
+        else:
+            self._reply(404, "Not found\n", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/profiler/") and self._forbid_remote():
+            return
+        if url.path == "/profiler/start":
+            interval = float(parse_qs(url.query).get("interval", [PROFILER_INTERVAL])[0])
+            PROFILER.start(interval)
+            self._reply(200, "Profiler running\n", "text/plain")
+        elif url.path == "/profiler/stop":
+            PROFILER.stop()
+            self._reply(200, PROFILER.collapsed(), "text/plain")
+        else:
+            self._reply(404, "Not found\n", "text/plain")
+
+    def _forbid_remote(self):
+        """
+        Answers 403 and returns True if the client is not on the loopback interface.
+        """
+        if is_loopback(self.client_address[0]):
+            return False
+        self._reply(403, "Forbidden\n", "text/plain")
+        return True
+
+    def _reply(self, status, text, content_type):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the application logs
+        pass
+
+
+def serve_metrics(host, port):
+    """
+    Serves /metrics and the profiler endpoints on a daemon thread, in either runtime.
+    """
+    http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=http_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics listening on %s:%s/metrics", host, port)
+    return http_server
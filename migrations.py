@@ -0,0 +1,307 @@
+import abc
+import logging
+import os
+import random
+import socket
+import sys
+import time
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db import REFERRAL_CODE_ATTEMPTS, REFERRAL_CODE_LENGTH, UsersDb
+
+
+logger = logging.getLogger(__name__)
+
+# Users read and written per bulk_write when the database keeps up
+MIGRATION_BATCH_SIZE = 1000
+# Batches are never cut below this many users
+MIGRATION_MIN_BATCH_SIZE = 50
+
+# Users scanned per second; the default leaves most of the database to live traffic
+MIGRATION_RATE = 2000
+
+# A batch write slower than this halves the batch size; faster ones grow it back by a quarter
+MIGRATION_LATENCY_TARGET = 0.1
+
+# How long a runner owns a migration without checkpointing before another one may take it over
+LEASE_SECONDS = 120
+
+# Seconds between the reads that measure live traffic latency, and how long they run before a migration starts
+PROBE_INTERVAL = 0.05
+PROBE_BASELINE_SECONDS = 2
+
+
+class Migration(abc.ABC):
+    """
+    A versioned change to every user document that needs one.
+
+    The runner streams the users matching query in _id order with projection, one batch at a time, and hands
+    each batch to apply(). Versions run in increasing order, each once.
+    """
+
+    version = None
+    name = None
+    query = {}
+    projection = {"_id": 1}
+
+    @abc.abstractmethod
+    def update(self, user_data):
+        """
+        Returns the UpdateOne that migrates one user, or None if the user needs no change. Filtering on the old
+        value keeps a concurrent write of the handlers from being overwritten.
+        """
+
+    async def apply(self, db, batch):
+        """
+        Migrates a batch of users and returns the number modified.
+        """
+        return await db.bulk_update_users([request for request in map(self.update, batch) if request is not None])
+
+
+class CompactReferralCodes(Migration):
+    """
+    Replaces the UUID referral codes of existing users with compact ones. The old code is kept in
+    legacy_referral_code, so links that were already shared keep working.
+    """
+
+    version = 1
+    name = "compact_referral_codes"
+    query = {"referral_code": {"$type": "string"}, "legacy_referral_code": {"$exists": False}}
+    projection = {"referral_code": 1}
+
+    def update(self, user_data):
+        if len(user_data["referral_code"]) <= REFERRAL_CODE_LENGTH:
+            return None
+        return UpdateOne({"_id": user_data["_id"], "referral_code": user_data["referral_code"]},
+                         {"$set": {"referral_code": UsersDb.generate_referral_code(),
+                                   "legacy_referral_code": user_data["referral_code"]}})
+
+    async def apply(self, db, batch):
+        pending = [user_data for user_data in batch if len(user_data["referral_code"]) > REFERRAL_CODE_LENGTH]
+        modified = 0
+
+        for _ in range(REFERRAL_CODE_ATTEMPTS):
+            if not pending:
+                return modified
+            requests = [self.update(user_data) for user_data in pending]
+            try:
+                return modified + await db.bulk_update_users(requests)
+            except BulkWriteError as e:
+                write_errors = e.details.get("writeErrors", [])
+                if any(error["code"] != 11000 for error in write_errors):
+                    raise
+                modified += e.details.get("nModified", 0)
+                # Only the users whose new code collided are retried
+                pending = [pending[error["index"]] for error in write_errors]
+
+        raise RuntimeError(f"Could not generate unique referral codes for {len(pending)} users.")
+
+
+class TwitterClickEpoch(Migration):
+    """
+    Stores last_time_twitter_link_clicked as a time.time() timestamp, like last_time_pillage_claimed, instead of
+    a datetime. The datetimes were written with datetime.now(), so they are read back as local times too.
+    """
+
+    version = 2
+    name = "twitter_click_epoch"
+    query = {"last_time_twitter_link_clicked": {"$type": "date"}}
+    projection = {"last_time_twitter_link_clicked": 1}
+
+    def update(self, user_data):
+        clicked = user_data["last_time_twitter_link_clicked"]
+        if not isinstance(clicked, datetime):
+            return None
+        return UpdateOne({"_id": user_data["_id"], "last_time_twitter_link_clicked": clicked},
+                         {"$set": {"last_time_twitter_link_clicked": clicked.timestamp()}})
+
+
+# Every migration, in version order
+MIGRATIONS = [
+    CompactReferralCodes(),
+    TwitterClickEpoch(),
+]
+
+
+def _percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class MigrationReport:
+    """
+    What one run of a migration did, and how live reads fared before and during it.
+    """
+
+    def __init__(self, migration):
+        self.migration = migration
+        self.processed = 0
+        self.modified = 0
+        self.seconds = 0
+        self.write_latencies = []  # seconds per batch bulk_write
+        self.live_before = []  # seconds per live read before the migration started
+        self.live_during = []  # seconds per live read while it ran
+        # Where the probe records its reads: live_before, live_during, or None once the run is over
+        self.probing = self.live_before
+
+    @property
+    def throughput(self):
+        return self.processed / self.seconds if self.seconds else 0
+
+    def summary(self):
+        ms = lambda seconds: f"{seconds * 1000:.1f}ms"
+        return (f"Migration {self.migration.version} ({self.migration.name}): {self.processed} users scanned, "
+                f"{self.modified} modified in {self.seconds:.1f}s, {self.throughput:.0f} users/s. "
+                f"Batch writes p50 {ms(_percentile(self.write_latencies, 0.5))}, "
+                f"p99 {ms(_percentile(self.write_latencies, 0.99))}. "
+                f"Live reads p50 {ms(_percentile(self.live_before, 0.5))} -> "
+                f"{ms(_percentile(self.live_during, 0.5))}, p99 {ms(_percentile(self.live_before, 0.99))} -> "
+                f"{ms(_percentile(self.live_during, 0.99))}")
+
+
+class MigrationRunner:
+    """
+    Runs the pending migrations, streaming the users by _id range with one bulk_write per batch.
+
+    Every batch is checkpointed with the last _id it covered, under a lease like broadcasts, so a stopped run
+    resumes where it left off and two runners never work on one migration. The runner paces itself to rate
+    users per second and halves its batches while writes take longer than latency_target, so it can run next
+    to the live bot. Meanwhile it times a read of a random user every PROBE_INTERVAL, like the handlers' reads,
+    and reports their latency before and during the migration.
+    """
+
+    def __init__(self, db, tasks, rate=MIGRATION_RATE, batch_size=MIGRATION_BATCH_SIZE,
+                 latency_target=MIGRATION_LATENCY_TARGET):
+        self.db = db
+        self.tasks = tasks
+        self.rate = rate
+        self.batch_size = batch_size
+        self.latency_target = latency_target
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    async def run(self, migrations=MIGRATIONS):
+        """
+        Runs every migration that isn't done yet, in version order.
+
+        Returns:
+            A MigrationReport per migration run.
+        """
+        done = {checkpoint["_id"] for checkpoint in await self.db.get_migrations()
+                if checkpoint.get("status") == "done"}
+        reports = []
+        for migration in sorted(migrations, key=lambda migration: migration.version):
+            if migration.version in done:
+                continue
+            report = await self.run_migration(migration)
+            if report is None:
+                # Later versions may depend on this one
+                logger.warning("Migration %s is running elsewhere, stopping", migration.version)
+                break
+            reports.append(report)
+        return reports
+
+    async def run_migration(self, migration):
+        """
+        Runs one migration to the end, resuming after its last checkpoint.
+
+        Returns:
+            The MigrationReport, or None if the migration is done or another runner holds it.
+        """
+        report = MigrationReport(migration)
+        try:
+            checkpoint = await self.db.acquire_migration(migration.version, migration.name, self.owner,
+                                                         LEASE_SECONDS)
+            if checkpoint is None:
+                return None
+
+            user_ids = [user["_id"] for user in await self.db.find_users_after(0, {}, {"_id": 1}, 1000)]
+            self.tasks.spawn(self._probe(report, user_ids), name="migration-probe")
+            await self.tasks.sleep(PROBE_BASELINE_SECONDS)
+            report.probing = report.live_during
+
+            logger.info("Running migration %s (%s) from user %s", migration.version, migration.name,
+                        checkpoint["last_id"])
+            await self._stream(migration, checkpoint["last_id"], report)
+        except BaseException:
+            # Also when acquiring itself failed after the write; only a lease this runner owns is released
+            await self.db.release_migration(migration.version, self.owner)
+            raise
+        finally:
+            report.probing = None
+
+        logger.info(report.summary())
+        return report
+
+    async def _stream(self, migration, last_id, report):
+        batch_size = self.batch_size
+        started = time.monotonic()
+
+        while True:
+            batch_started = time.monotonic()
+            batch = await self.db.find_users_after(last_id, migration.query, migration.projection, batch_size)
+            if not batch:
+                break
+
+            write_started = time.monotonic()
+            modified = await migration.apply(self.db, batch)
+            write_seconds = time.monotonic() - write_started
+            report.write_latencies.append(write_seconds)
+
+            last_id = batch[-1]["_id"]
+            report.processed += len(batch)
+            report.modified += modified
+            if not await self.db.record_migration_batch(migration.version, self.owner, last_id, len(batch),
+                                                        modified, LEASE_SECONDS):
+                raise RuntimeError(f"Migration {migration.version} was taken over by another runner.")
+
+            # Backs off while the database is slow, and recovers gradually once it keeps up again
+            if write_seconds > self.latency_target:
+                batch_size = max(MIGRATION_MIN_BATCH_SIZE, batch_size // 2)
+            else:
+                batch_size = min(self.batch_size, batch_size + max(1, batch_size // 4))
+
+            await self.tasks.sleep(max(0, len(batch) / self.rate - (time.monotonic() - batch_started)))
+
+        report.seconds = time.monotonic() - started
+        await self.db.finish_migration(migration.version, self.owner)
+
+    async def _probe(self, report, user_ids):
+        while user_ids and report.probing is not None:
+            latencies = report.probing
+            started = time.monotonic()
+            await self.db.get_user(random.choice(user_ids))
+            latencies.append(time.monotonic() - started)
+            await self.tasks.sleep(PROBE_INTERVAL)
+
+
+async def print_status(db):
+    checkpoints = {checkpoint["_id"]: checkpoint for checkpoint in await db.get_migrations()}
+    for migration in MIGRATIONS:
+        checkpoint = checkpoints.get(migration.version, {})
+        print(f"{migration.version:>3} {migration.name:<28} {checkpoint.get('status', 'pending'):<8} "
+              f"{checkpoint.get('processed', 0)} scanned, {checkpoint.get('modified', 0)} modified")
+
+
+if __name__ == "__main__":
+    # Runs the pending migrations next to the live bot: python migrations.py [--status] [--rate N] [--batch-size N]
+    import argparse
+    from main import create_users_db
+    from runtime import ThreadedTasks, run_blocking
+
+    parser = argparse.ArgumentParser(description="Runs the pending users collection migrations.")
+    parser.add_argument("--status", action="store_true", help="Only show which migrations have run.")
+    parser.add_argument("--rate", type=float, default=MIGRATION_RATE, help="Users scanned per second.")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    users_db = create_users_db("pymongo")
+    if args.status:
+        run_blocking(print_status(users_db))
+        sys.exit()
+
+    runner = MigrationRunner(users_db, ThreadedTasks(), rate=args.rate, batch_size=args.batch_size)
+    for migration_report in run_blocking(runner.run()):
+        print(migration_report.summary())
@@ -0,0 +1,93 @@
+import functools
+from datetime import datetime
+
+
+class User:
+    """
+    A user document as read by the handlers: one slot per field instead of a dict, so a record costs a fraction
+    of the memory of the decoded document and a misspelt field fails loudly.
+
+    Records are projected. Only the fields a read asked for are set, and reading any other raises
+    AttributeError. Fields the document lacks take the value of DEFAULTS, or None.
+    """
+
+    # Every field the handlers and utils helpers read from a user document
+    FIELDS = (
+        "balance",
+        "referral_code",
+        "amount_of_referrals",
+        "gold_per_pillage",
+        "last_time_pillage_claimed",
+        "last_time_daily_quest_completed",
+        "user_language",
+        "subscribe_channel_quest_time",
+        "start_another_bot_quest_time",
+        "last_time_twitter_link_clicked",
+        "delivery_status",
+        "gang_level_2",
+        "gang_total",
+    )
+
+    # Values of fields missing from the document, for those where "missing" has an obvious meaning
+    DEFAULTS = {
+        "balance": 0,
+        "amount_of_referrals": 0,
+        "gold_per_pillage": 0,
+        "user_language": "en",
+        "gang_level_2": 0,
+    }
+
+    __slots__ = ("user_id",) + FIELDS
+
+    # Annotations only, for readers and type checkers; slots can't have class-level defaults
+    user_id: int
+    balance: int
+    referral_code: str
+    amount_of_referrals: int
+    gold_per_pillage: int
+    last_time_pillage_claimed: float
+    last_time_daily_quest_completed: datetime
+    user_language: str
+    subscribe_channel_quest_time: datetime
+    start_another_bot_quest_time: datetime
+    last_time_twitter_link_clicked: float
+    delivery_status: str
+    gang_level_2: int
+    gang_total: int
+
+    @classmethod
+    def from_document(cls, document, fields=FIELDS):
+        """
+        Builds a record from a (projected) user document.
+
+        Args:
+            document: The document as returned by the driver, with _id.
+            fields: The fields the document was projected on; only these are set.
+        """
+        user = cls.__new__(cls)
+        user.user_id = document["_id"]
+        get = document.get
+        for field, default in _field_defaults(fields):
+            setattr(user, field, get(field, default))
+        return user
+
+    def apply(self, update_data):
+        """
+        Mirrors a $set of update_data into the record, for the fields it has.
+        """
+        for field, value in update_data.items():
+            if field in _FIELD_SET:
+                setattr(self, field, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__ if hasattr(self, field))
+        return f"User({fields})"
+
+
+_FIELD_SET = frozenset(User.FIELDS)
+
+
+@functools.lru_cache(maxsize=None)
+def _field_defaults(fields):
+    # Projections are a handful of constant tuples, so each is paired with its defaults once
+    return tuple((field, User.DEFAULTS.get(field)) for field in fields)
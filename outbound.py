@@ -0,0 +1,351 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from runtime import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+# Telegram's documented limits: about 30 messages per second overall and 1 per second in one chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+
+# TeleBot worker threads for the threaded runtime, where a handler holds its thread while acquire() waits. With
+# sends leaving at GLOBAL_RATE, a chat waits at most 1 / CHAT_RATE seconds for its turn, so about
+# GLOBAL_RATE / CHAT_RATE handlers can be parked at once; doubled so the others keep running meanwhile
+HANDLER_THREADS = 2 * int(GLOBAL_RATE / CHAT_RATE)
+
+# Times a send is retried after a 429 before the error reaches the caller
+MAX_RETRIES = 3
+
+# Bot API methods that are scheduled, and whether they count against the per-chat limit
+SCHEDULED_METHODS = {
+    "send_message": True,
+    "send_photo": True,
+    "reply_to": True,
+    "delete_message": False,
+}
+
+_IDLE, _READY, _WAITING = range(3)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_token(self, now):
+        self._refill(now)
+        # The epsilon absorbs float error, so a chat woken at its computed time is not put back to sleep
+        return 0 if self.tokens >= 1 - 1e-9 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendJob:
+    __slots__ = ("chat_id", "priority", "per_chat", "grant")
+
+    def __init__(self, chat_id, priority, per_chat, grant):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.per_chat = per_chat
+        # Event or future the scheduler sets when the job may go out
+        self.grant = grant
+
+
+class _ChatState:
+    __slots__ = ("chat_id", "jobs", "bucket", "state", "ready_at", "ready_priority", "paused_until")
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.jobs = []  # heap of (priority, seq, job)
+        self.bucket = bucket
+        self.state = _IDLE
+        self.ready_at = 0
+        self.ready_priority = None
+        self.paused_until = 0
+
+
+class SendQueue:
+    """
+    Decides which queued send may go out next. Not thread-safe; the schedulers below serialize access.
+
+    Every chat has a token bucket and a heap of its pending jobs, ordered by lane and then FIFO. Chats whose next
+    job may go now sit in a ready heap ordered by lane; chats waiting for their bucket (or a retry_after pause)
+    sit in a heap ordered by the time they become ready. A job leaves only when the global bucket has a token too,
+    so neither limit is ever exceeded and an interactive reply never waits behind bulk traffic.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, chat_burst=1, idle_chats_limit=10000,
+                 now=None):
+        now = time.monotonic() if now is None else now
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, 1, now)
+        self._chats = {}
+        self._ready = []  # heap of (priority, seq, chat_id)
+        self._waiting = []  # heap of (ready_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._idle_chats_limit = idle_chats_limit
+        self._sweep_at = idle_chats_limit
+        self._pending = 0
+
+    def __len__(self):
+        return self._pending
+
+    def _chat(self, chat_id, now):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _ChatState(chat_id, TokenBucket(self.chat_rate, self.chat_burst, now))
+        return chat
+
+    def push(self, job, now):
+        chat = self._chat(job.chat_id, now)
+        heapq.heappush(chat.jobs, (job.priority, next(self._seq), job))
+        self._pending += 1
+        self._schedule(chat, now)
+
+        if len(self._chats) > self._sweep_at:
+            self._sweep(now)
+
+    def set_global_rate(self, rate, now):
+        """
+        Changes the overall send rate, e.g. when the limit is shared by a different number of processes.
+        """
+        self.global_bucket._refill(now)
+        self.global_bucket.rate = rate
+
+    def pause_chat(self, chat_id, seconds, now):
+        """
+        Holds back every send to a chat for the given time, e.g. after a 429 with retry_after.
+        """
+        chat = self._chat(chat_id, now)
+        chat.paused_until = max(chat.paused_until, now + seconds)
+        if chat.state == _READY:
+            chat.state = _IDLE
+        self._schedule(chat, now)
+
+    def pop_ready(self, now):
+        """
+        Takes the next job that may be sent now.
+
+        Returns:
+            A tuple (job, wait): the job, or None and the time until one may become ready (None if the queue is
+            empty and only a push can change that).
+        """
+        while self._waiting and self._waiting[0][0] <= now:
+            ready_at, _, chat_id = heapq.heappop(self._waiting)
+            chat = self._chats.get(chat_id)
+            if chat is not None and chat.state == _WAITING and chat.ready_at == ready_at:
+                chat.state = _IDLE
+                self._schedule(chat, now)
+
+        if self._ready:
+            wait = self.global_bucket.time_until_token(now)
+            if wait > 0:
+                return None, wait
+
+        while self._ready:
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats.get(chat_id)
+            if chat is None or chat.state != _READY:
+                # Left over from a priority bump or a pause
+                continue
+
+            _, _, job = heapq.heappop(chat.jobs)
+            self._pending -= 1
+            self.global_bucket.take(now)
+            if job.per_chat:
+                chat.bucket.take(now)
+
+            chat.state = _IDLE
+            self._schedule(chat, now)
+            return job, None
+
+        return None, (self._waiting[0][0] - now if self._waiting else None)
+
+    def _schedule(self, chat, now):
+        if not chat.jobs:
+            chat.state = _IDLE
+            return
+
+        head_priority, _, head_job = chat.jobs[0]
+        ready_at = max(now, chat.paused_until)
+        if head_job.per_chat:
+            ready_at = max(ready_at, now + chat.bucket.time_until_token(now))
+
+        if ready_at <= now:
+            if chat.state != _READY or head_priority < chat.ready_priority:
+                chat.state = _READY
+                chat.ready_priority = head_priority
+                heapq.heappush(self._ready, (head_priority, next(self._seq), chat.chat_id))
+        elif chat.state != _WAITING or chat.ready_at != ready_at:
+            chat.state = _WAITING
+            chat.ready_at = ready_at
+            heapq.heappush(self._waiting, (ready_at, next(self._seq), chat.chat_id))
+
+    def _sweep(self, now):
+        # Chats with nothing queued and a full bucket behave exactly like chats we never saw
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if chat.state == _IDLE and chat.paused_until <= now and chat.bucket.is_full(now)]:
+            del self._chats[chat_id]
+        self._sweep_at = max(self._idle_chats_limit, 2 * len(self._chats))
+
+
+class ThreadedSendScheduler:
+    """
+    Drives a SendQueue for the threaded runtime. The calling worker thread blocks until its send may go out, so
+    the pool running the handlers needs HANDLER_THREADS threads, or a few busy chats park all of them.
+    """
+
+    def __init__(self, send_queue=None):
+        self.queue = SendQueue() if send_queue is None else send_queue
+        self.condition = threading.Condition()
+        threading.Thread(target=self._run, name="send-scheduler", daemon=True).start()
+
+    def _run(self):
+        with self.condition:
+            while True:
+                job, wait = self.queue.pop_ready(time.monotonic())
+                if job is not None:
+                    job.grant.set()
+                else:
+                    self.condition.wait(wait)
+
+    async def acquire(self, chat_id, priority, per_chat):
+        # Blocks instead of suspending, like the Blocking adapters it runs next to
+        job = SendJob(chat_id, priority, per_chat, threading.Event())
+        with self.condition:
+            self.queue.push(job, time.monotonic())
+            self.condition.notify()
+        job.grant.wait()
+
+    def pause_chat(self, chat_id, seconds):
+        with self.condition:
+            self.queue.pause_chat(chat_id, seconds, time.monotonic())
+            self.condition.notify()
+
+    def set_global_rate(self, rate):
+        with self.condition:
+            self.queue.set_global_rate(rate, time.monotonic())
+            self.condition.notify()
+
+
+class AsyncSendScheduler:
+    """
+    Drives a SendQueue for the asyncio runtime from a single dispatcher task.
+    """
+
+    def __init__(self, send_queue=None):
+        self.queue = SendQueue() if send_queue is None else send_queue
+        self.wakeup = None
+        self.dispatcher = None
+
+    def _ensure_dispatcher(self):
+        if self.dispatcher is None:
+            self.wakeup = asyncio.Event()
+            self.dispatcher = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            job, wait = self.queue.pop_ready(time.monotonic())
+            if job is not None:
+                if not job.grant.done():
+                    job.grant.set_result(None)
+                continue
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self, chat_id, priority, per_chat):
+        self._ensure_dispatcher()
+        job = SendJob(chat_id, priority, per_chat, asyncio.get_running_loop().create_future())
+        self.queue.push(job, time.monotonic())
+        self.wakeup.set()
+        await job.grant
+
+    def pause_chat(self, chat_id, seconds):
+        self.queue.pause_chat(chat_id, seconds, time.monotonic())
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
+def _file_positions(args, kwargs):
+    # Uploads (send_photo with an open file) are read to the end by every attempt
+    return [(value, value.tell()) for value in (*args, *kwargs.values())
+            if callable(getattr(value, "seekable", None)) and value.seekable()]
+
+
+def _chat_id(method_name, args, kwargs):
+    if method_name == "reply_to":
+        message = args[0] if args else kwargs["message"]
+        return message.chat.id
+    return args[0] if args else kwargs["chat_id"]
+
+
+class RateLimitedBot:
+    """
+    Wraps the bot handlers talk to, so sends wait for the scheduler and 429s are retried after retry_after.
+
+    Methods listed in SCHEDULED_METHODS are queued in this wrapper's priority lane; everything else is passed
+    straight through. Use with_priority(BULK) for broadcasts and other traffic that must not delay replies.
+    """
+
+    def __init__(self, bot, scheduler, priority=INTERACTIVE):
+        self.bot = bot
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def with_priority(self, priority):
+        return RateLimitedBot(self.bot, self.scheduler, priority)
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+        if name not in SCHEDULED_METHODS:
+            return method
+
+        per_chat = SCHEDULED_METHODS[name]
+
+        async def send(*args, **kwargs):
+            chat_id = _chat_id(name, args, kwargs)
+            files = _file_positions(args, kwargs)
+
+            for attempt in range(MAX_RETRIES + 1):
+                await self.scheduler.acquire(chat_id, self.priority, per_chat)
+                # A retry sends the whole file again, not what the failed attempt left unread
+                for file, position in files:
+                    file.seek(position)
+                try:
+                    return await method(*args, **kwargs)
+                except ApiTelegramException as e:
+                    if e.error_code != 429 or attempt == MAX_RETRIES:
+                        raise
+                    retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                    logger.warning("Telegram asked to retry %s to chat %s after %ss", name, chat_id, retry_after)
+                    self.scheduler.pause_chat(chat_id, retry_after)
+
+        return send
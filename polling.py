@@ -0,0 +1,184 @@
+import logging
+import time
+from router import route_callback, route_text
+
+
+logger = logging.getLogger(__name__)
+
+# The most updates getUpdates returns per call
+MAX_BATCH = 100
+
+# Seconds a getUpdates call waits for updates when there are none
+LONG_POLL_TIMEOUT = 20
+
+# Updates read ahead during catch-up before they are deduplicated, collapsed and dispatched, bounding memory
+CATCH_UP_MAX_UPDATES = 10000
+
+# Callback actions where only a user's last choice on a message counts, whatever the data of the earlier taps
+LAST_CHOICE_ACTIONS = frozenset({"language", "reminders"})
+
+
+def collapse_key(update):
+    """
+    Returns the key under which a later update of the backlog supersedes this one, or None if it must be kept.
+
+    Menu buttons only show something, so of several taps of the same button by one user only the last needs an
+    answer. Inline buttons act on their own message (claim_gold and the pickers delete it), so only taps on the
+    same message are collapsed: the one handled cleans up after them all, and taps on different messages are
+    all handled. Of the language and reminder buttons, only the last choice on a message counts. Commands and
+    other messages are never collapsed.
+    """
+    message = update.message
+    if message is not None:
+        button_key = route_text(message.text)
+        return None if button_key is None else ("text", message.chat.id, button_key)
+
+    call = update.callback_query
+    if call is not None and call.message is not None:
+        action = route_callback(call.data)
+        if action is None:
+            return None
+        return ("callback", call.message.chat.id, call.message.message_id,
+                action if action in LAST_CHOICE_ACTIONS else call.data)
+
+    return None
+
+
+def collapse_backlog(updates, committed_update_id=None):
+    """
+    Prepares a backlog for dispatch: drops updates at or before the committed update_id and repeated update_ids,
+    and keeps only the last update of every collapse_key, in the original order.
+
+    Returns:
+        A tuple (updates to dispatch, number of duplicates, number collapsed).
+    """
+    seen = set()
+    unique = []
+    for update in updates:
+        if update.update_id in seen or (committed_update_id is not None and update.update_id <= committed_update_id):
+            continue
+        seen.add(update.update_id)
+        unique.append(update)
+
+    superseded = set()
+    kept = []
+    for update in reversed(unique):
+        key = collapse_key(update)
+        if key is not None:
+            if key in superseded:
+                continue
+            superseded.add(key)
+        kept.append(update)
+    kept.reverse()
+
+    return kept, len(updates) - len(unique), len(unique) - len(kept)
+
+
+def threaded_get_updates(bot):
+    """
+    get_updates(offset, limit, timeout) for Poller on a Blocking(TeleBot).
+    """
+    # TeleBot's own timeout is the HTTP one; the long poll must end before it
+    return lambda offset, limit, timeout: bot.get_updates(offset=offset, limit=limit, timeout=timeout + 10,
+                                                          long_polling_timeout=timeout)
+
+
+def async_get_updates(bot):
+    """
+    get_updates(offset, limit, timeout) for Poller on an AsyncTeleBot.
+    """
+    return lambda offset, limit, timeout: bot.get_updates(offset=offset, limit=limit, timeout=timeout,
+                                                          request_timeout=timeout + 10)
+
+
+class Poller:
+    """
+    Long-polls getUpdates and commits the last dispatched update_id to the database, so a restarted bot resumes
+    right after it: Telegram drops everything before the offset, and nothing is handled twice.
+
+    On start it first catches up. The backlog that piled up during the restart is fetched in MAX_BATCH batches
+    without waiting, deduplicated, collapsed (ten Balance taps of one user become one, see collapse_key) and
+    dispatched at once, instead of being worked through one long poll at a time.
+    """
+
+    def __init__(self, get_updates, process, db, tasks):
+        """
+        Args:
+            get_updates: get_updates(offset, limit, timeout), see threaded_get_updates and async_get_updates.
+            process: Takes a list of updates and hands them over without waiting for the handlers, e.g.
+                TeleBot.process_new_updates or ShardedDispatcher.process_new_updates.
+            db: The UsersDb the offset is committed to.
+            tasks: ThreadedTasks or AsyncioTasks, for the pause after a failed call.
+        """
+        self.get_updates = get_updates
+        self.process = process
+        self.db = db
+        self.tasks = tasks
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    async def run(self):
+        committed = await self.db.get_polling_offset()
+        offset = None if committed is None else committed + 1
+        offset = await self.catch_up(offset, committed)
+
+        while not self._stopped:
+            try:
+                updates = await self.get_updates(offset, MAX_BATCH, LONG_POLL_TIMEOUT)
+            except Exception:
+                logger.exception("getUpdates failed, retrying")
+                await self.tasks.sleep(1)
+                continue
+
+            updates = [update for update in updates if offset is None or update.update_id >= offset]
+            if updates:
+                self.process(updates)
+                offset = updates[-1].update_id + 1
+                await self._commit(offset - 1)
+
+    async def catch_up(self, offset, committed):
+        """
+        Dispatches the backlog waiting at offset, CATCH_UP_MAX_UPDATES at a time, and returns the offset after it.
+        """
+        started = time.monotonic()
+        fetched = dispatched = 0
+
+        while not self._stopped:
+            backlog = []
+            try:
+                while len(backlog) < CATCH_UP_MAX_UPDATES:
+                    batch = await self.get_updates(offset, MAX_BATCH, 0)
+                    if not batch:
+                        break
+                    backlog.extend(batch)
+                    offset = batch[-1].update_id + 1
+                    if len(batch) < MAX_BATCH:
+                        break
+            except Exception:
+                # The long polling loop retries from the same offset
+                logger.exception("getUpdates failed while catching up")
+
+            if backlog:
+                updates, _, _ = collapse_backlog(backlog, committed)
+                self.process(updates)
+                committed = offset - 1
+                await self._commit(committed)
+                fetched += len(backlog)
+                dispatched += len(updates)
+
+            if len(backlog) < CATCH_UP_MAX_UPDATES:
+                break
+
+        if fetched:
+            logger.info("Caught up on %s updates in %.1fs, %s dispatched after deduplicating and collapsing",
+                        fetched, time.monotonic() - started, dispatched)
+        return offset
+
+    async def _commit(self, update_id):
+        try:
+            await self.db.commit_polling_offset(update_id)
+        except Exception:
+            # Telegram has the offset too; losing one commit only risks handling this batch again after a restart
+            logger.exception("Committing polling offset %s failed", update_id)
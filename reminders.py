@@ -0,0 +1,56 @@
+import logging
+import time
+from broadcast import classify_delivery_error
+from db import PLUNDER_REMINDER_BUCKET_SECONDS
+from keyboards import KEYBOARDS
+from outbound import BULK
+from runtime import ApiTelegramException
+from utils import render_message
+
+
+logger = logging.getLogger(__name__)
+
+# Users taken off the reminder index and messaged at once
+REMINDER_BATCH_SIZE = 500
+
+
+async def _remind(bot, recipient):
+    language_code = recipient.get("user_language", "en")
+    try:
+        await bot.send_message(recipient["_id"], render_message(language_code, "plunder_ready_message"),
+                               reply_markup=KEYBOARDS.get(language_code).plunder_ready)
+        return None
+    except ApiTelegramException as e:
+        return classify_delivery_error(e)
+
+
+async def run_plunder_reminders(rt):
+    """
+    Background job that tells users their plunder cooldown is over.
+
+    claim_pillage files every successful claim under the time bucket its cooldown ends in (plunder_ready_bucket).
+    Each tick takes only the users of the buckets that are due, in batches, and messages them in their language
+    through the BULK lane. Opted-out users are never filed, so they cost nothing.
+    """
+    bot = rt.bot.with_priority(BULK)
+
+    while True:
+        now = time.time()
+        due_bucket = int(now // PLUNDER_REMINDER_BUCKET_SECONDS) - 1
+
+        try:
+            recipients = await rt.db.take_due_plunder_reminders(due_bucket, REMINDER_BATCH_SIZE)
+            if recipients:
+                results = await rt.tasks.gather(*[_remind(bot, recipient) for recipient in recipients])
+                await rt.db.set_delivery_statuses({recipient["_id"]: status
+                                                   for recipient, status in zip(recipients, results)
+                                                   if status is not None})
+                logger.info("Sent %s plunder reminders", len(recipients))
+                if len(recipients) == REMINDER_BATCH_SIZE:
+                    # The due buckets have more users
+                    continue
+        except Exception:
+            logger.exception("Sending plunder reminders failed")
+
+        # Until the current bucket has fully passed
+        await rt.tasks.sleep(PLUNDER_REMINDER_BUCKET_SECONDS - now % PLUNDER_REMINDER_BUCKET_SECONDS)
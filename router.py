@@ -0,0 +1,98 @@
+from languages import LANGUAGES
+from localization import CATALOGS
+
+
+# Reply keyboard buttons that open a section of the bot
+MENU_BUTTONS = ("pillage_button", "referrals_button", "balance_button", "quests_button", "language_button",
+                "leaderboard_button")
+
+
+def build_button_index(languages, button_keys):
+    """
+    Maps every translated label of the given buttons to the button key it belongs to.
+
+    Args:
+        languages: The LANGUAGES catalog.
+        button_keys: The button keys to index.
+
+    Returns:
+        A dict of {label: button_key} covering all languages.
+
+    Raises:
+        ValueError: If one label is used by two different buttons, which would make routing ambiguous.
+    """
+    index = {}
+
+    for language_code, texts in languages.items():
+        for button_key in button_keys:
+            label = texts.get(button_key)
+            if label is None:
+                # get_button_name falls back to the English label, which is indexed already
+                continue
+
+            if index.get(label, button_key) != button_key:
+                raise ValueError(f"Button label {label!r} ({language_code}) is used by both "
+                                 f"{index[label]} and {button_key}.")
+            index[label] = button_key
+
+    return index
+
+
+BUTTON_INDEX = build_button_index(LANGUAGES, MENU_BUTTONS)
+
+
+def index_catalog_buttons(catalog):
+    """
+    Adds the menu button labels of a locale compiled after startup to BUTTON_INDEX.
+    """
+    labels = build_button_index({catalog.language_code: catalog.labels(MENU_BUTTONS)}, MENU_BUTTONS)
+    # Checked against the existing labels before any of them is added
+    for label, button_key in labels.items():
+        if BUTTON_INDEX.get(label, button_key) != button_key:
+            raise ValueError(f"Button label {label!r} ({catalog.language_code}) is used by both "
+                             f"{BUTTON_INDEX[label]} and {button_key}.")
+    BUTTON_INDEX.update(labels)
+
+
+CATALOGS.add_load_listener(index_catalog_buttons)
+
+# Exact callback_data values
+CALLBACK_ACTIONS = {
+    "claim_gold": "claim_gold",
+    "initiation": "initiation",
+    "reminders_off": "reminders",
+    "reminders_on": "reminders",
+    "top_balance": "leaderboard",
+    "top_amount_of_referrals": "leaderboard",
+    **{language_code: "language" for language_code in CATALOGS.language_codes},
+}
+
+# callback_data prefixes, matched on everything up to and including the first underscore
+CALLBACK_PREFIXES = {
+    "link_": "link",
+    "check_": "check",
+}
+
+
+def route_text(text):
+    """
+    Returns the menu button key for a message text, or None if the text is not a menu button label.
+    """
+    return BUTTON_INDEX.get(text)
+
+
+def route_callback(data):
+    """
+    Returns the action for a callback_data value, or None if no handler takes it.
+    """
+    if data is None:
+        return None
+
+    action = CALLBACK_ACTIONS.get(data)
+    if action is not None:
+        return action
+
+    prefix, separator, _ = data.partition("_")
+    if not separator:
+        return None
+    return CALLBACK_PREFIXES.get(prefix + separator)
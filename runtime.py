@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from telebot import apihelper
+
+try:
+    from telebot import asyncio_helper
+except ImportError:
+    # aiohttp is only installed for the asyncio runtime
+    asyncio_helper = None
+
+
+logger = logging.getLogger(__name__)
+
+# The threaded and the asyncio API helpers raise their own exception classes
+ApiTelegramException = (apihelper.ApiTelegramException,) + (
+    (asyncio_helper.ApiTelegramException,) if asyncio_helper is not None else ())
+
+
+class Runtime:
+    """
+    Everything a handler needs to talk to the outside world.
+
+    In the threaded runtime bot and db wrap blocking objects with Blocking; in the asyncio runtime they are
+    AsyncTeleBot and a UsersDb on the motor driver. Handlers await both the same way. tasks is ThreadedTasks or
+    AsyncioTasks, for code that needs concurrency, sleeps or background jobs. membership is the
+    MembershipChecker for the bot's channel, jobs the JobScheduler for work that runs later, leaderboards
+    the in-memory Leaderboards and throttle the UserThrottle in front of dispatch.
+    """
+
+    def __init__(self, bot, db, media, tasks, membership, jobs, leaderboards, throttle):
+        self.bot = bot
+        self.db = db
+        self.media = media
+        self.tasks = tasks
+        self.membership = membership
+        self.jobs = jobs
+        self.leaderboards = leaderboards
+        self.throttle = throttle
+
+
+class ThreadedTasks:
+    """
+    Concurrency primitives for the threaded runtime. Like the Blocking adapters they never suspend: gather runs
+    the coroutines on a thread pool and waits, sleep blocks the thread and spawn starts a daemon thread.
+    """
+
+    def __init__(self, max_workers=16):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gather")
+
+    async def gather(self, *coroutines):
+        futures = [self.executor.submit(run_blocking, coroutine) for coroutine in coroutines]
+        return [future.result() for future in futures]
+
+    async def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def create_future(self):
+        return BlockingFuture()
+
+    def submit(self, coroutine):
+        # Like spawn, but on the bounded pool instead of a thread of its own
+        self.executor.submit(_run_logged, run_blocking, coroutine)
+
+    def spawn(self, coroutine, name=None):
+        threading.Thread(target=_run_logged, args=(run_blocking, coroutine), name=name, daemon=True).start()
+
+
+class AsyncioTasks:
+    """
+    Concurrency primitives for the asyncio runtime, on the running event loop.
+    """
+
+    def __init__(self):
+        # Keeps spawned tasks referenced until they finish
+        self._tasks = set()
+
+    async def gather(self, *coroutines):
+        return await asyncio.gather(*coroutines)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def create_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    def submit(self, coroutine):
+        self.spawn(coroutine)
+
+    def spawn(self, coroutine, name=None):
+        task = asyncio.get_running_loop().create_task(_run_logged_async(coroutine), name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+def _run_logged(run, coroutine):
+    try:
+        run(coroutine)
+    except Exception:
+        logger.exception("Background job %s failed", coroutine.__qualname__)
+
+
+async def _run_logged_async(coroutine):
+    try:
+        await coroutine
+    except Exception:
+        logger.exception("Background job %s failed", coroutine.__qualname__)
+
+
+class Blocking:
+    """
+    Exposes the methods of a blocking object (TeleBot, a pymongo collection) as coroutines.
+
+    The coroutines call the method directly and never suspend, so code written against the asyncio APIs
+    can run on a plain thread through run_blocking.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+class BlockingCollection(Blocking):
+    """
+    A pymongo collection that behaves like a motor collection: queries are awaited, cursors are async iterators.
+    """
+
+    CURSOR_METHODS = ("find", "aggregate")
+
+    def __getattr__(self, name):
+        if name in self.CURSOR_METHODS:
+            method = getattr(self._target, name)
+            return lambda *args, **kwargs: BlockingCursor(method(*args, **kwargs))
+        return super().__getattr__(name)
+
+
+class BlockingCursor:
+    """
+    A pymongo cursor that behaves like a motor cursor. Chained calls (sort, limit, ...) return the cursor.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        method = getattr(self._cursor, name)
+
+        def chain(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+
+        return chain
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        if length is None:
+            return list(self._cursor)
+        return [document for _, document in zip(range(length), self._cursor)]
+
+
+class BlockingFuture(Future):
+    """
+    A concurrent.futures.Future that can be awaited by coroutines driven by run_blocking. Awaiting blocks the
+    thread until another thread sets the result.
+    """
+
+    def __await__(self):
+        return self.result()
+        yield  # Makes __await__ a generator that never suspends
+
+
+class BlockingLock:
+    """
+    A threading.Lock used with `async with`, for coroutines driven by run_blocking. Acquiring blocks the thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        self._lock.acquire()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
+
+def run_blocking(coroutine):
+    """
+    Runs a coroutine to completion on the calling thread, without an event loop.
+
+    Args:
+        coroutine: A coroutine that only awaits Blocking adapters (directly or through other coroutines).
+
+    Returns:
+        The coroutine's result.
+
+    Raises:
+        RuntimeError: If the coroutine really suspends, i.e. it awaited something that needs an event loop.
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+    coroutine.close()
+    raise RuntimeError("Coroutine suspended in the threaded runtime; it awaited something other than a Blocking "
+                       "adapter.")
@@ -0,0 +1,329 @@
+import bisect
+import collections
+import functools
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# Points per worker on the hash ring; more points spread the chats more evenly
+VIRTUAL_NODES = 64
+
+# The worker that also runs the background jobs over the whole database; it is never removed
+JOBS_WORKER = "worker-1"
+
+# Threads per worker process; the updates of one chat still run one at a time
+WORKER_THREADS = 16
+
+# Seconds between the supervisor's checks for dead workers and resize requests
+SUPERVISOR_INTERVAL = 1
+
+# Seconds to wait for worker acknowledgements before checking that the workers are still alive
+ACK_TIMEOUT = 5
+
+
+def stable_hash(key):
+    # hash() of a str differs between processes, and ints would map consecutive ids to neighbouring points
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+def chat_id_of(update):
+    """
+    Returns the chat an update belongs to, the key that keeps one user's updates on one worker.
+    """
+    callback_query = update.callback_query
+    if callback_query is not None:
+        # The handlers answer callbacks in the chat of the message the button is on
+        return callback_query.message.chat.id if callback_query.message else callback_query.from_user.id
+
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member",
+                 "chat_member", "chat_join_request"):
+        value = getattr(update, name, None)
+        if value is not None:
+            return value.chat.id
+
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        value = getattr(update, name, None)
+        if value is not None:
+            return value.from_user.id
+
+    # Updates of no particular chat (polls) may go anywhere
+    return update.update_id
+
+
+class HashRing:
+    """
+    Consistent hashing of chat ids onto workers: adding or removing a worker only moves the chats of the ring
+    segments it takes over or gives up, about 1/N of them, instead of reshuffling every chat.
+    """
+
+    def __init__(self, virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._hashes = []  # sorted points on the ring
+        self._nodes = []  # the node owning each point
+
+    @property
+    def nodes(self):
+        return set(self._nodes)
+
+    def add(self, node):
+        for index in range(self.virtual_nodes):
+            point = stable_hash(f"{node}#{index}")
+            position = bisect.bisect(self._hashes, point)
+            self._hashes.insert(position, point)
+            self._nodes.insert(position, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self._hashes, self._nodes) if owner != node]
+        self._hashes = [point for point, _ in kept]
+        self._nodes = [owner for _, owner in kept]
+
+    def node_for(self, key):
+        if not self._hashes:
+            raise LookupError("The hash ring has no nodes.")
+        return self._nodes[bisect.bisect(self._hashes, stable_hash(key)) % len(self._hashes)]
+
+
+class ChatOrderedExecutor:
+    """
+    Runs functions on a thread pool, those of one chat one at a time in the order they were submitted.
+
+    A chat with a running function gets a mailbox; functions submitted meanwhile wait in it, and the thread
+    that finishes one takes the next, so different chats run in parallel and one chat never does.
+    """
+
+    def __init__(self, max_workers=WORKER_THREADS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self._mailboxes = {}  # chat_id -> deque of functions waiting behind the running one
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, chat_id, function):
+        with self._lock:
+            self._pending += 1
+            mailbox = self._mailboxes.get(chat_id)
+            if mailbox is not None:
+                mailbox.append(function)
+                return
+            self._mailboxes[chat_id] = collections.deque()
+
+        self._executor.submit(self._run, chat_id, function)
+
+    def _run(self, chat_id, function):
+        while True:
+            try:
+                function()
+            except Exception:
+                logger.exception("Processing an update of chat %s failed", chat_id)
+
+            with self._lock:
+                self._pending -= 1
+                mailbox = self._mailboxes[chat_id]
+                if not mailbox:
+                    del self._mailboxes[chat_id]
+                    if not self._pending:
+                        self._idle.notify_all()
+                    return
+                function = mailbox.popleft()
+
+    def drain(self):
+        """
+        Waits until every submitted function has run.
+        """
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+
+def _worker_main(name, setup, worker_count, updates, acks):
+    """
+    The loop of a worker process. setup(name, worker_count) builds the worker in this process and returns an
+    object with process(update), set_worker_count(count) and close().
+    """
+    # Ctrl+C reaches the whole process group; the dispatcher decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker = setup(name, worker_count)
+    executor = ChatOrderedExecutor()
+    logger.info("Shard worker %s ready", name)
+
+    while True:
+        message = updates.get()
+        if message is None:
+            executor.drain()
+            worker.close()
+            return
+
+        kind, *payload = message
+        if kind == "update":
+            chat_id, update = payload
+            executor.submit(chat_id, functools.partial(worker.process, update))
+        elif kind == "barrier":
+            executor.drain()
+            acks.put((name, payload[0]))
+        elif kind == "worker_count":
+            worker.set_worker_count(payload[0])
+
+
+class ShardedDispatcher:
+    """
+    Spreads updates over worker processes by a consistent hash of their chat id.
+
+    All updates of a chat go to the same worker, which runs them one after another (ChatOrderedExecutor), so
+    one user's updates are handled in order while different users' run in parallel on all cores. Adding or
+    removing a worker first drains the workers, so a chat that moves has nothing left in flight on its old
+    worker. Workers that die are restarted under the same name and pick up the queue they left.
+
+    It takes updates like a TeleBot (process_new_updates), so it can stand behind WebhookServer or a
+    polling.Poller.
+    """
+
+    def __init__(self, setup, workers, context=None):
+        """
+        Args:
+            setup: A picklable callable, setup(name, worker_count), run in every worker process to build it.
+            workers: The number of worker processes to start.
+            context: The multiprocessing context; spawn by default, so workers don't inherit the dispatcher's
+                threads or connections.
+        """
+        if workers < 1:
+            raise ValueError("At least one worker is required.")
+
+        self.setup = setup
+        self._context = context or multiprocessing.get_context("spawn")
+        self._acks = self._context.Queue()
+        self._workers = {}  # name -> (process, queue)
+        self._ring = HashRing()
+        self._names = (f"worker-{number}" for number in itertools.count(1))
+        self._barriers = itertools.count(1)
+        self._resize_requests = 0
+        # Serializes dispatching with draining and resizing
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+
+        for _ in range(workers):
+            name = next(self._names)
+            self._workers[name] = (None, self._context.Queue())
+            self._ring.add(name)
+        for name in self._workers:
+            self._start_worker(name)
+
+    @property
+    def worker_names(self):
+        return list(self._workers)
+
+    def queued_updates(self):
+        return sum(updates.qsize() for _, updates in list(self._workers.values()))
+
+    def _start_worker(self, name):
+        updates = self._workers[name][1]
+        process = self._context.Process(target=_worker_main, name=name, daemon=True,
+                                        args=(name, self.setup, len(self._workers), updates, self._acks))
+        process.start()
+        self._workers[name] = (process, updates)
+
+    def process_new_updates(self, updates):
+        with self._lock:
+            for update in updates:
+                chat_id = chat_id_of(update)
+                self._workers[self._ring.node_for(chat_id)][1].put(("update", chat_id, update))
+
+    def drain(self):
+        """
+        Waits until every worker has processed everything dispatched so far.
+        """
+        with self._lock:
+            token = next(self._barriers)
+            waiting = set(self._workers)
+            for name in waiting:
+                self._workers[name][1].put(("barrier", token))
+
+            while waiting:
+                try:
+                    name, acked = self._acks.get(timeout=ACK_TIMEOUT)
+                except queue.Empty:
+                    # A dead worker would never answer; its replacement reads the barrier from the same queue
+                    self.check_workers()
+                    continue
+                if acked == token:
+                    waiting.discard(name)
+
+    def add_worker(self):
+        with self._lock:
+            # The chats that move to the new worker must have nothing left in flight elsewhere
+            self.drain()
+            name = next(self._names)
+            self._workers[name] = (None, self._context.Queue())
+            self._start_worker(name)
+            self._ring.add(name)
+            self._announce_worker_count()
+            logger.info("Added shard worker %s, %s running", name, len(self._workers))
+            return name
+
+    def remove_worker(self, name=None):
+        with self._lock:
+            if len(self._workers) == 1:
+                raise ValueError("Can't remove the last worker.")
+            if name == JOBS_WORKER:
+                raise ValueError(f"Can't remove {JOBS_WORKER}, it runs the background jobs.")
+
+            name = name or list(self._workers)[-1]
+            self._ring.remove(name)
+            process, updates = self._workers.pop(name)
+            # The worker finishes everything it was given before it exits, so its chats move in order
+            updates.put(None)
+            process.join()
+            self._announce_worker_count()
+            logger.info("Removed shard worker %s, %s running", name, len(self._workers))
+
+    def _announce_worker_count(self):
+        for _, updates in self._workers.values():
+            updates.put(("worker_count", len(self._workers)))
+
+    def request_resize(self, change):
+        """
+        Asks the supervisor to add (change > 0) or remove workers; safe to call from a signal handler.
+        """
+        self._resize_requests += change
+
+    def check_workers(self):
+        with self._lock:
+            for name, (process, _) in list(self._workers.items()):
+                if not process.is_alive():
+                    logger.error("Shard worker %s exited with %s, restarting it", name, process.exitcode)
+                    self._start_worker(name)
+
+    def _supervise(self):
+        while not self._stopped.wait(SUPERVISOR_INTERVAL):
+            try:
+                self.check_workers()
+                while self._resize_requests > 0:
+                    self._resize_requests -= 1
+                    self.add_worker()
+                while self._resize_requests < 0:
+                    self._resize_requests += 1
+                    if len(self._workers) > 1:
+                        self.remove_worker()
+            except Exception:
+                logger.exception("Supervising the shard workers failed")
+
+    def start_supervisor(self):
+        threading.Thread(target=self._supervise, name="shard-supervisor", daemon=True).start()
+
+    def stop(self):
+        """
+        Lets every worker finish what it was given and waits for them to exit.
+        """
+        self._stopped.set()
+        with self._lock:
+            for _, updates in self._workers.values():
+                updates.put(None)
+            for process, _ in self._workers.values():
+                process.join()
@@ -0,0 +1,20 @@
+import os
+import sys
+from unittest import mock
+
+import mongomock
+import pytest
+
+# The bot's modules live in the repository root, like for the benchmarks
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db as db_module
+
+
+@pytest.fixture
+def users_db():
+    """
+    A pymongo UsersDb on an in-memory mongomock server, without indexes.
+    """
+    with mock.patch.object(db_module, "MongoClient", mongomock.MongoClient):
+        return db_module.UsersDb("mongodb://localhost", "test", None, None, "admin")
@@ -0,0 +1,97 @@
+from db import GANG_MAX_DEPTH
+from gangs import compute_gang_stats, rebuild_gang_stats
+from runtime import run_blocking
+
+
+def sign_up(db, user_id, referrer_id=None):
+    # What the /start handler does for a referral link
+    run_blocking(db.create_user(user_id, referrer_id=referrer_id))
+    if referrer_id is not None:
+        run_blocking(db.increase_referrals_number(referrer_id))
+
+
+def stored_stats(db):
+    return {user["_id"]: {"gang_level_2": user["gang_level_2"], "gang_total": user["gang_total"]}
+            for user in db.users_collection._target.find({"gang_total": {"$gt": 0}})}
+
+
+def referral_tree(db):
+    """
+    1 recruited 2 and 3; 2 recruited 4 and 5; 4 recruited 6; 3 recruited 7.
+    """
+    sign_up(db, 1)
+    for user_id, referrer_id in ((2, 1), (3, 1), (4, 2), (5, 2), (6, 4), (7, 3)):
+        sign_up(db, user_id, referrer_id)
+
+
+def test_compute_gang_stats_counts_levels():
+    members = [
+        {"_id": 1, "referrer_id": None, "amount_of_referrals": 2},
+        {"_id": 2, "referrer_id": 1, "amount_of_referrals": 2},
+        {"_id": 3, "referrer_id": 1, "amount_of_referrals": 1},
+        {"_id": 4, "referrer_id": 2, "amount_of_referrals": 1},
+        {"_id": 5, "referrer_id": 2, "amount_of_referrals": 0},
+        {"_id": 6, "referrer_id": 4, "amount_of_referrals": 0},
+        {"_id": 7, "referrer_id": 3},
+        # Recruited before referrer_id was recorded: counted at level 1 only
+        {"_id": 8, "amount_of_referrals": 3},
+    ]
+
+    assert compute_gang_stats(members) == {
+        1: {"gang_level_2": 3, "gang_total": 6},
+        2: {"gang_level_2": 1, "gang_total": 3},
+        3: {"gang_level_2": 0, "gang_total": 1},
+        4: {"gang_level_2": 0, "gang_total": 1},
+        8: {"gang_level_2": 0, "gang_total": 3},
+    }
+
+
+def test_signups_update_the_gangs_above_them(users_db):
+    referral_tree(users_db)
+
+    assert stored_stats(users_db) == {
+        1: {"gang_level_2": 3, "gang_total": 6},
+        2: {"gang_level_2": 1, "gang_total": 3},
+        3: {"gang_level_2": 0, "gang_total": 1},
+        4: {"gang_level_2": 0, "gang_total": 1},
+    }
+    six = users_db.users_collection._target.find_one({"_id": 6})
+    assert (six["referrer_id"], six["referrer_path"]) == (4, [4, 2, 1])
+
+
+def test_a_rebuild_agrees_with_the_signups(users_db):
+    referral_tree(users_db)
+    signed_up = stored_stats(users_db)
+
+    assert run_blocking(rebuild_gang_stats(users_db)) == 0
+    assert stored_stats(users_db) == signed_up
+
+
+def test_gangs_count_down_to_the_maximum_depth(users_db):
+    # A chain where every user recruited the next one
+    chain = range(1, GANG_MAX_DEPTH + 4)
+    sign_up(users_db, 1)
+    for user_id in chain[1:]:
+        sign_up(users_db, user_id, user_id - 1)
+
+    last = users_db.users_collection._target.find_one({"_id": chain[-1]})
+    assert len(last["referrer_path"]) == GANG_MAX_DEPTH
+    assert last["referrer_path"][0] == chain[-2] and last["referrer_path"][-1] == chain[-1] - GANG_MAX_DEPTH
+
+    stats = stored_stats(users_db)
+    # Only the GANG_MAX_DEPTH levels below the root, not the whole chain
+    assert stats[1] == {"gang_level_2": 1, "gang_total": GANG_MAX_DEPTH}
+    assert stats[chain[-4]] == {"gang_level_2": 1, "gang_total": 3}
+    assert compute_gang_stats(users_db.users_collection._target.find({})) == stats
+
+
+def test_gangs_that_were_never_counted_are_left_to_the_rebuild(users_db):
+    referral_tree(users_db)
+    # A user from before gang sizes were stored
+    users_db.users_collection._target.update_one({"_id": 1}, {"$unset": {"gang_level_2": "", "gang_total": ""}})
+
+    sign_up(users_db, 9, 6)
+    assert "gang_total" not in users_db.users_collection._target.find_one({"_id": 1})
+
+    assert run_blocking(rebuild_gang_stats(users_db)) == 1
+    assert stored_stats(users_db)[1] == {"gang_level_2": 3, "gang_total": 7}
@@ -0,0 +1,124 @@
+import pytest
+
+import jobs
+from jobs import LEASE_SECONDS, MAX_ATTEMPTS, POLL_INTERVAL, RETRY_DELAY_SECONDS, TICK_SECONDS, JobScheduler
+from runtime import run_blocking
+
+
+class Stop(Exception):
+    pass
+
+
+class FakeTasks:
+    """
+    Runs submitted jobs right away and turns every sleep of the scheduler loop into a step of a simulated clock.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.ticks = 0
+
+    def submit(self, coroutine):
+        run_blocking(coroutine)
+
+    async def sleep(self, seconds):
+        if self.ticks == 0:
+            raise Stop
+        self.ticks -= 1
+        self.clock.now += seconds
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(jobs.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def scheduler(users_db, clock):
+    return JobScheduler(users_db, FakeTasks(clock))
+
+
+def run_for(scheduler, handlers, seconds):
+    scheduler.tasks.ticks = int(seconds / TICK_SECONDS)
+    with pytest.raises(Stop):
+        run_blocking(scheduler.run(None, handlers))
+
+
+def job(scheduler, job_id):
+    return scheduler.db.jobs_collection._target.find_one({"_id": job_id})
+
+
+def test_a_due_job_runs_once_and_is_deleted(scheduler):
+    runs = []
+
+    async def remind(rt, user_id):
+        runs.append(user_id)
+
+    job_id = run_blocking(scheduler.schedule("remind", delay=1, user_id=7))
+    run_for(scheduler, {"remind": remind}, 3 * POLL_INTERVAL)
+
+    assert runs == [7]
+    assert job(scheduler, job_id) is None
+
+
+def test_a_job_with_an_expired_lease_is_claimed_again(scheduler, clock):
+    runs = []
+
+    async def remind(rt, user_id):
+        runs.append(scheduler.owner)
+
+    job_id = run_blocking(scheduler.db.insert_job("remind", {"user_id": 7}, clock.now))
+    # Another replica claimed it and died
+    assert run_blocking(scheduler.db.claim_job(job_id, "dead:1", clock.now, LEASE_SECONDS)) is not None
+
+    run_for(scheduler, {"remind": remind}, LEASE_SECONDS / 2)
+    assert runs == []
+
+    run_for(scheduler, {"remind": remind}, LEASE_SECONDS)
+    assert runs == [scheduler.owner]
+    assert job(scheduler, job_id) is None
+
+
+def test_a_job_that_keeps_failing_is_kept_as_failed(scheduler):
+    attempts = []
+
+    async def remind(rt, user_id):
+        attempts.append(user_id)
+        raise ConnectionError("network down")
+
+    job_id = run_blocking(scheduler.schedule("remind", user_id=7))
+    run_for(scheduler, {"remind": remind}, (MAX_ATTEMPTS + 2) * (RETRY_DELAY_SECONDS + POLL_INTERVAL))
+
+    assert len(attempts) == MAX_ATTEMPTS
+    stored = job(scheduler, job_id)
+    assert (stored["status"], stored["attempts"]) == ("failed", MAX_ATTEMPTS)
+    assert "network down" in stored["error"]
+
+
+def test_a_job_scheduled_before_the_heap_head_runs_first(scheduler, clock):
+    runs = []
+
+    async def remind(rt, user_id):
+        runs.append((user_id, clock.now))
+
+    run_blocking(scheduler.schedule("remind", delay=3600, user_id=1))
+    run_for(scheduler, {"remind": remind}, POLL_INTERVAL)
+
+    scheduled_at = clock.now
+    run_blocking(scheduler.schedule("remind", delay=1, user_id=2))
+    # The loop polls the collection as it starts, before the job is due, and next only after POLL_INTERVAL, so
+    # only the in-memory heap can start it in time
+    run_for(scheduler, {"remind": remind}, 1 + 2 * TICK_SECONDS)
+
+    assert [user_id for user_id, _ in runs] == [2]
+    assert runs[0][1] <= scheduled_at + 1 + TICK_SECONDS
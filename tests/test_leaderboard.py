@@ -0,0 +1,95 @@
+import bisect
+
+from leaderboard import TOP_SIZE, Leaderboard, value_bucket
+
+
+def full_board():
+    """
+    A board whose top holds users 1..TOP_SIZE with balances 1000, 990, ..., the last one at 10.
+    """
+    board = Leaderboard("balance")
+    board.load_top([(user_id, 1000 - 10 * (user_id - 1)) for user_id in range(1, TOP_SIZE + 1)])
+    return board
+
+
+def histogram(values):
+    bucket_counts = {}
+    for value in values:
+        count, lowest, highest = bucket_counts.get(value_bucket(value), (0, value, value))
+        bucket_counts[value_bucket(value)] = (count + 1, min(lowest, value), max(highest, value))
+    return bucket_counts
+
+
+def test_a_user_enters_a_full_top_and_the_last_one_drops_out():
+    board = full_board()
+
+    board.observe(500, 995)
+
+    assert board.top(3) == [(1, 1000), (500, 995), (2, 990)]
+    assert board.rank(500, 995) == (2, True)
+    assert board.rank(3, 980) == (4, True)
+    assert TOP_SIZE not in dict(board.top(TOP_SIZE))
+    assert len(board.top(TOP_SIZE + 1)) == TOP_SIZE
+    assert not board.stale
+
+
+def test_a_value_below_a_full_top_is_not_taken_in():
+    board = full_board()
+
+    board.observe(500, 10)
+    board.observe(501, 5)
+
+    assert 500 not in dict(board.top(TOP_SIZE)) and 501 not in dict(board.top(TOP_SIZE))
+    assert board.top(TOP_SIZE)[-1] == (TOP_SIZE, 10)
+
+
+def test_a_user_falling_in_a_full_top_makes_it_stale():
+    board = full_board()
+
+    board.observe(1, 0)
+
+    # Somebody outside the top may be ahead now, until the next reload says
+    assert board.stale
+    assert board.top(1) == [(2, 990)]
+    assert board.top(TOP_SIZE)[-1] == (1, 0)
+
+    board.load_top([(user_id, 1000 - user_id) for user_id in range(2, TOP_SIZE + 2)])
+    assert not board.stale
+    assert board.rank(TOP_SIZE + 1, 1000 - TOP_SIZE - 1) == (TOP_SIZE, True)
+
+
+def test_ties_keep_bisect_order():
+    board = Leaderboard("balance", size=5)
+    # The database may return ties in any order
+    board.load_top([(3, 50), (1, 50), (2, 50), (4, 40)])
+
+    assert board.top() == [(1, 50), (2, 50), (3, 50), (4, 40)]
+
+    board.observe(2, 40)
+    board.observe(5, 50)
+    board.observe(0, 40)
+
+    assert board.top() == [(1, 50), (3, 50), (5, 50), (0, 40), (2, 40)]
+    assert board._top == sorted(board._top)
+    for user_id, value in board.top():
+        assert board._top[bisect.bisect_left(board._top, (-value, user_id))] == (-value, user_id)
+
+
+def test_ranks_below_the_top_come_from_the_histogram():
+    board = full_board()
+    # Everybody outside the top: one user at each value from 1 to 9, and a thousand users at 0
+    board.load_histogram(histogram([value for user_id, value in board.top(TOP_SIZE)] + list(range(1, 10)) + [0] * 1000))
+
+    assert board.rank(500, 9) == (TOP_SIZE + 1, False)
+    assert board.rank(501, 5) == (TOP_SIZE + 5, False)
+    # All ties: ranked right below every better user
+    assert board.rank(502, 0) == (TOP_SIZE + 10, False)
+
+
+def test_a_rank_below_the_top_never_beats_the_top():
+    board = full_board()
+    # A histogram from before every user of the top got rich
+    board.load_histogram(histogram([1, 2, 3]))
+
+    assert board.rank(500, 5) == (TOP_SIZE + 1, False)
+    assert board.rank(501, 2000) == (TOP_SIZE + 1, False)
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from languages import LANGUAGES
+from localization import CATALOGS, MESSAGE_PLACEHOLDERS, Localization, compile_templates
+
+
+def arguments(message_key):
+    # Numbers for counters and positions, text for the rest, like the handlers pass them
+    return {name: 1234 if name in ("amount_of_referrals", "gang_level_2", "gang_total", "user_balance", "position",
+                                   "value", "rank") else f"<{name}>"
+            for name in MESSAGE_PLACEHOLDERS.get(message_key, ())}
+
+
+@pytest.mark.parametrize("language_code", CATALOGS.language_codes)
+def test_every_message_renders_with_its_declared_placeholders(language_code):
+    catalog = CATALOGS.catalog(language_code)
+    texts = LANGUAGES.get(language_code) or CATALOGS._read_locale(language_code)
+
+    for message_key in {**LANGUAGES[CATALOGS.default_language], **texts}:
+        kwargs = arguments(message_key)
+        text = texts.get(message_key, LANGUAGES[CATALOGS.default_language][message_key])
+        assert catalog.render(message_key, **kwargs) == text.format(**kwargs), (language_code, message_key)
+
+    for message_key in MESSAGE_PLACEHOLDERS:
+        assert message_key in catalog, (language_code, message_key)
+
+
+def test_a_translation_with_an_unknown_placeholder_is_rejected():
+    with pytest.raises(ValueError, match="user_balance"):
+        compile_templates("xx", {"leaderboard_rank_message": "#{rank} with {user_balance}"})
+
+
+def test_locale_files_are_checked_when_first_used(tmp_path):
+    (tmp_path / "xx.json").write_text(json.dumps({"language_name": "X", "current_balance_message": "{balance}"}))
+    localization = Localization(LANGUAGES, locales_dir=str(tmp_path))
+
+    assert "xx" in localization.language_codes
+    with pytest.raises(ValueError, match="balance"):
+        localization.catalog("xx")
+
+
+def test_texts_with_format_specs_render_like_str_format():
+    templates = compile_templates("xx", {"current_balance_message": "{user_balance:,} gold {{ok}}",
+                                         "leaderboard_entry": "{position!r}. {value:>6}"})
+
+    assert templates["current_balance_message"].render({"user_balance": 1234567}) == "1,234,567 gold {ok}"
+    assert templates["leaderboard_entry"].render({"position": "1", "value": 50}) == "'1'.     50"
@@ -0,0 +1,173 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import membership
+from membership import NEGATIVE_TTL, POSITIVE_TTL, REVERIFY_AHEAD, MembershipChecker
+from runtime import AsyncioTasks
+
+
+CHANNEL_ID = -100
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeBot:
+    """
+    Answers get_chat_member from a set of members and counts the calls, optionally holding them until released.
+    """
+
+    def __init__(self, members=()):
+        self.members = set(members)
+        self.calls = []
+        self.release = None
+
+    async def get_chat_member(self, chat_id, user_id):
+        assert chat_id == CHANNEL_ID
+        self.calls.append(user_id)
+        if self.release is not None:
+            await self.release.wait()
+        return SimpleNamespace(status="member" if user_id in self.members else "left")
+
+
+class Stop(Exception):
+    pass
+
+
+class SteppingTasks(AsyncioTasks):
+    """
+    AsyncioTasks whose sleep advances the simulated clock instead, for a given number of sleeps.
+    """
+
+    def __init__(self, clock, sleeps):
+        super().__init__()
+        self.clock = clock
+        self.sleeps = sleeps
+
+    async def sleep(self, seconds):
+        if self.sleeps == 0:
+            raise Stop
+        self.sleeps -= 1
+        self.clock.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(membership.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def checker(bot, **kwargs):
+    return MembershipChecker(bot, AsyncioTasks(), CHANNEL_ID, **kwargs)
+
+
+def test_answers_are_cached_until_their_ttl_runs_out(clock):
+    bot = FakeBot(members={1})
+
+    async def scenario():
+        checks = checker(bot)
+        assert await checks.is_member(1) and not await checks.is_member(2)
+        assert await checks.is_member(1) and not await checks.is_member(2)
+        assert bot.calls == [1, 2]
+
+        # The user has just joined: the short negative TTL lets the next tap through
+        bot.members.add(2)
+        clock.now += NEGATIVE_TTL
+        assert await checks.is_member(2)
+        assert bot.calls == [1, 2, 2]
+
+        bot.members.discard(1)
+        clock.now += POSITIVE_TTL - NEGATIVE_TTL - 1
+        assert await checks.is_member(1)
+        clock.now += 1
+        assert not await checks.is_member(1)
+        assert bot.calls == [1, 2, 2, 1]
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_checks_of_a_user_share_one_call(clock):
+    bot = FakeBot(members={1})
+
+    async def scenario():
+        bot.release = asyncio.Event()
+        checks = checker(bot)
+        waiting = asyncio.gather(*(checks.is_member(1) for _ in range(10)))
+        await asyncio.sleep(0)
+        bot.release.set()
+        assert await waiting == [True] * 10
+        assert bot.calls == [1]
+
+    asyncio.run(scenario())
+
+
+def test_a_failed_call_fails_every_waiting_check_and_is_not_cached(clock):
+    class FailingBot(FakeBot):
+        async def get_chat_member(self, chat_id, user_id):
+            await super().get_chat_member(chat_id, user_id)
+            raise ConnectionError("network down")
+
+    bot = FailingBot(members={1})
+
+    async def scenario():
+        bot.release = asyncio.Event()
+        checks = checker(bot)
+        waiting = asyncio.gather(*(checks.is_member(1) for _ in range(3)), return_exceptions=True)
+        await asyncio.sleep(0)
+        bot.release.set()
+        assert all(isinstance(result, ConnectionError) for result in await waiting)
+
+        with pytest.raises(ConnectionError):
+            await checks.is_member(1)
+        assert bot.calls == [1, 1]
+
+    asyncio.run(scenario())
+
+
+def test_the_least_recently_checked_user_is_evicted(clock):
+    bot = FakeBot(members={1, 2, 3})
+
+    async def scenario():
+        checks = checker(bot, max_entries=2)
+        for user_id in (1, 2, 3):
+            await checks.is_member(user_id)
+        await checks.is_member(3)
+        await checks.is_member(2)
+        assert bot.calls == [1, 2, 3]
+
+        await checks.is_member(1)
+        assert bot.calls == [1, 2, 3, 1]
+
+    asyncio.run(scenario())
+
+
+def test_members_are_reverified_before_they_expire_at_the_given_rate(clock):
+    bot = FakeBot(members=range(100))
+
+    async def scenario():
+        checks = checker(bot)
+        for user_id in range(100):
+            await checks.is_member(user_id)
+        bot.calls.clear()
+
+        clock.now += POSITIVE_TTL * (1 - REVERIFY_AHEAD)
+        checks.tasks = SteppingTasks(clock, sleeps=20)
+        with pytest.raises(Stop):
+            await checks.run(checks_per_second=2)
+
+        # 21 loop iterations half a second apart, one check each
+        assert bot.calls == list(range(21))
+        # Re-verified members are answered from memory past their original expiry
+        clock.now += POSITIVE_TTL * REVERIFY_AHEAD
+        assert await checks.is_member(0)
+        assert len(bot.calls) == 21
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+import http.client
+
+import pytest
+
+from metrics import PROFILER, MetricsRequestHandler, is_loopback, serve_metrics
+
+
+@pytest.mark.parametrize("host, expected", [
+    ("127.0.0.1", True), ("127.8.0.1", True), ("::1", True), ("::ffff:127.0.0.1", True),
+    ("10.0.0.5", False), ("::ffff:10.0.0.5", False), ("2001:db8::1", False), ("localhost", False),
+])
+def test_is_loopback(host, expected):
+    assert is_loopback(host) is expected
+
+
+@pytest.fixture
+def metrics_server():
+    server = serve_metrics("127.0.0.1", 0)
+    yield server
+    PROFILER.stop()
+    server.shutdown()
+    server.server_close()
+
+
+def request(server, method, path):
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+    try:
+        connection.request(method, path)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def test_loopback_clients_drive_the_profiler(metrics_server):
+    assert request(metrics_server, "GET", "/metrics") == 200
+    assert request(metrics_server, "POST", "/profiler/start?interval=0.01") == 200
+    assert request(metrics_server, "GET", "/profiler") == 200
+    assert request(metrics_server, "POST", "/profiler/stop") == 200
+
+
+def test_remote_clients_only_get_metrics(metrics_server, monkeypatch):
+    # What the handler sees when the server listens on every interface and the request comes from elsewhere
+    handle = MetricsRequestHandler.handle
+
+    def handle_as_remote(self):
+        self.client_address = ("10.0.0.5", self.client_address[1])
+        handle(self)
+
+    monkeypatch.setattr(MetricsRequestHandler, "handle", handle_as_remote)
+
+    assert request(metrics_server, "GET", "/metrics") == 200
+    assert request(metrics_server, "POST", "/profiler/start") == 403
+    assert request(metrics_server, "GET", "/profiler") == 403
+    assert request(metrics_server, "POST", "/profiler/stop") == 403
+    assert not PROFILER.running
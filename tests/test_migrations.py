@@ -0,0 +1,171 @@
+import uuid
+
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from migrations import LEASE_SECONDS, CompactReferralCodes, Migration, MigrationRunner
+from runtime import run_blocking
+
+
+class CollidingDb:
+    """
+    bulk_update_users that reports a duplicate key error for the requests at the given indexes, once per entry
+    of collisions, and applies the rest.
+    """
+
+    def __init__(self, *collisions, code=11000):
+        self.collisions = list(collisions)
+        self.code = code
+        self.batches = []
+
+    async def bulk_update_users(self, requests):
+        self.batches.append([(request._filter["_id"], request._doc["$set"]["referral_code"]) for request in requests])
+        failed = self.collisions.pop(0) if self.collisions else []
+        if failed:
+            raise BulkWriteError({
+                "writeErrors": [{"index": index, "code": self.code, "errmsg": "E11000 duplicate key"}
+                                for index in failed],
+                "nModified": len(requests) - len(failed),
+            })
+        return len(requests)
+
+
+def legacy_users(*user_ids):
+    return [{"_id": user_id, "referral_code": str(uuid.uuid4())} for user_id in user_ids]
+
+
+def test_only_users_whose_new_code_collided_are_retried():
+    db = CollidingDb([1, 3], [0])
+
+    modified = run_blocking(CompactReferralCodes().apply(db, legacy_users(1, 2, 3, 4, 5)))
+
+    assert modified == 5
+    assert [[user_id for user_id, _ in batch] for batch in db.batches] == [[1, 2, 3, 4, 5], [2, 4], [2]]
+    # Every attempt draws a new code
+    assert db.batches[0][1][1] != db.batches[1][0][1] != db.batches[2][0][1]
+
+
+def test_users_with_compact_codes_are_skipped():
+    db = CollidingDb()
+    users = legacy_users(1, 2) + [{"_id": 3, "referral_code": "abc"}]
+
+    assert run_blocking(CompactReferralCodes().apply(db, users)) == 2
+    assert [user_id for user_id, _ in db.batches[0]] == [1, 2]
+
+
+def test_other_write_errors_are_not_retried():
+    db = CollidingDb([1], code=121)
+
+    with pytest.raises(BulkWriteError):
+        run_blocking(CompactReferralCodes().apply(db, legacy_users(1, 2, 3)))
+    assert len(db.batches) == 1
+
+
+class MarkMigrated(Migration):
+    version = 99
+    name = "mark_migrated"
+    query = {"migrated": {"$exists": False}}
+
+    def __init__(self, on_batch=None):
+        self.on_batch = on_batch
+
+    def update(self, user_data):
+        return UpdateOne({"_id": user_data["_id"]}, {"$set": {"migrated": True}})
+
+    async def apply(self, db, batch):
+        if self.on_batch is not None:
+            self.on_batch(batch)
+        return await super().apply(db, batch)
+
+
+class NoWaitTasks:
+    def spawn(self, coroutine, name=None):
+        # No live reads to measure here
+        coroutine.close()
+
+    async def sleep(self, seconds):
+        pass
+
+
+@pytest.fixture
+def runner(users_db):
+    users_db.users_collection._target.insert_many([{"_id": user_id} for user_id in range(1, 11)])
+    return MigrationRunner(users_db, NoWaitTasks(), batch_size=3)
+
+
+def checkpoint(runner, version=MarkMigrated.version):
+    return runner.db.migrations_collection._target.find_one({"_id": version})
+
+
+def migrated(runner):
+    return sorted(user["_id"] for user in runner.db.users_collection._target.find({"migrated": True}))
+
+
+def test_a_migration_runs_in_batches_and_is_marked_done(runner):
+    report = run_blocking(runner.run_migration(MarkMigrated()))
+
+    assert (report.processed, report.modified) == (10, 10)
+    assert len(report.write_latencies) == 4
+    assert migrated(runner) == list(range(1, 11))
+    assert checkpoint(runner)["status"] == "done"
+    assert run_blocking(runner.run_migration(MarkMigrated())) is None
+
+
+def test_a_runner_whose_lease_was_taken_over_stops(runner):
+    def take_over(batch):
+        # The lease ran out while this runner stalled, and another runner took it
+        if batch[0]["_id"] == 1:
+            runner.db.migrations_collection._target.update_one({"_id": MarkMigrated.version},
+                                                               {"$set": {"owner": "other:1"}})
+
+    with pytest.raises(RuntimeError, match="taken over"):
+        run_blocking(runner.run_migration(MarkMigrated(on_batch=take_over)))
+
+    # The batch in hand is written (the other runner's filters make that harmless), but no further one
+    assert migrated(runner) == [1, 2, 3]
+    assert checkpoint(runner)["owner"] == "other:1"
+    # The other runner's lease is left alone
+    assert checkpoint(runner)["lease_until"] > 0
+
+
+@pytest.mark.parametrize("interruption", [KeyboardInterrupt, ConnectionError])
+def test_an_interrupted_run_releases_its_lease(runner, interruption):
+    def interrupt(batch):
+        if batch[0]["_id"] == 4:
+            raise interruption
+
+    with pytest.raises(interruption):
+        run_blocking(runner.run_migration(MarkMigrated(on_batch=interrupt)))
+
+    assert checkpoint(runner)["lease_until"] == 0
+    # The next run resumes after the last checkpoint right away
+    report = run_blocking(runner.run_migration(MarkMigrated()))
+    assert report.processed == 7
+    assert migrated(runner) == list(range(1, 11))
+
+
+def test_a_lease_is_released_when_acquiring_fails_after_the_write(runner):
+    acquire_migration = runner.db.acquire_migration
+
+    async def acquire_then_fail(*args):
+        await acquire_migration(*args)
+        raise KeyboardInterrupt
+
+    runner.db.acquire_migration = acquire_then_fail
+    with pytest.raises(KeyboardInterrupt):
+        run_blocking(runner.run_migration(MarkMigrated()))
+
+    assert checkpoint(runner)["owner"] == runner.owner
+    assert checkpoint(runner)["lease_until"] == 0
+
+
+def test_a_held_lease_is_not_released_by_another_runner(runner, users_db):
+    other = MigrationRunner(users_db, NoWaitTasks())
+    other.owner = "other:1"
+    assert run_blocking(users_db.acquire_migration(MarkMigrated.version, MarkMigrated.name, other.owner,
+                                                   LEASE_SECONDS)) is not None
+
+    assert run_blocking(runner.run_migration(MarkMigrated())) is None
+    assert checkpoint(runner)["lease_until"] > 0
+    assert migrated(runner) == []
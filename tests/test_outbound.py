@@ -0,0 +1,195 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+from outbound import (BULK, GLOBAL_RATE, CHAT_RATE, HANDLER_THREADS, INTERACTIVE, RateLimitedBot, SendJob,
+                      SendQueue, ThreadedSendScheduler)
+from runtime import Blocking, run_blocking
+
+
+class FakeApi:
+    """
+    Records when every send reaches "Telegram", and fails the sends it is told to.
+    """
+
+    def __init__(self):
+        self.sent = []  # (monotonic time, method, chat_id)
+        self.failures = {}  # chat_id -> exceptions to raise, in order
+        self.lock = threading.Lock()
+
+    def _send(self, method, chat_id):
+        with self.lock:
+            failures = self.failures.get(chat_id)
+            if failures:
+                raise failures.pop(0)
+            self.sent.append((time.monotonic(), method, chat_id))
+        return method, chat_id
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._send("send_message", chat_id)
+
+    def delete_message(self, chat_id, message_id):
+        return self._send("delete_message", chat_id)
+
+    def get_me(self):
+        return "me"
+
+
+def too_many_requests(retry_after):
+    return ApiTelegramException("sendMessage", None, {"error_code": 429, "description": "Too Many Requests",
+                                                     "parameters": {"retry_after": retry_after}})
+
+
+def drain(queue, now=0.0):
+    """
+    Pops every job of a SendQueue on a simulated clock, returning (time, job) in send order.
+    """
+    sent = []
+    while True:
+        job, wait = queue.pop_ready(now)
+        if job is not None:
+            sent.append((now, job))
+        elif wait is None:
+            return sent
+        else:
+            now += wait
+
+
+def push(queue, chat_id, priority=INTERACTIVE, per_chat=True, now=0.0):
+    job = SendJob(chat_id, priority, per_chat, None)
+    queue.push(job, now)
+    return job
+
+
+def test_simulated_sends_never_exceed_the_global_or_chat_rate():
+    queue = SendQueue(now=0.0)
+    for chat_id in range(100):
+        for _ in range(5):
+            push(queue, chat_id)
+
+    sent = drain(queue)
+
+    assert len(sent) == 500
+    times = [at for at, _ in sent]
+    assert all(later - earlier >= 1 / GLOBAL_RATE - 1e-9 for earlier, later in zip(times, times[1:]))
+    for chat_id in range(100):
+        chat_times = [at for at, job in sent if job.chat_id == chat_id]
+        assert all(later - earlier >= 1 / CHAT_RATE - 1e-9 for earlier, later in zip(chat_times, chat_times[1:]))
+
+
+def test_interactive_sends_go_before_queued_bulk_sends():
+    queue = SendQueue(now=0.0)
+    for chat_id in range(1000, 1100):
+        push(queue, chat_id, BULK)
+    for chat_id in range(20):
+        push(queue, chat_id, INTERACTIVE)
+
+    sent = drain(queue)
+
+    assert [job.priority for _, job in sent[:20]] == [INTERACTIVE] * 20
+
+
+def test_sends_outside_the_chat_limit_skip_the_chat_bucket():
+    queue = SendQueue(now=0.0)
+    push(queue, 1)
+    push(queue, 1, per_chat=False)
+
+    (first, _), (second, _) = drain(queue)
+
+    assert second - first == pytest.approx(1 / GLOBAL_RATE)
+
+
+def test_a_paused_chat_waits_for_retry_after():
+    queue = SendQueue(now=0.0)
+    queue.pause_chat(1, 5, 0.0)
+    push(queue, 1)
+    push(queue, 2)
+
+    sent = {job.chat_id: at for at, job in drain(queue)}
+
+    assert sent[1] == pytest.approx(5)
+    assert sent[2] == 0
+
+
+def fake_bot(global_rate=200, chat_rate=20):
+    api = FakeApi()
+    scheduler = ThreadedSendScheduler(SendQueue(global_rate=global_rate, chat_rate=chat_rate))
+    return api, RateLimitedBot(Blocking(api), scheduler)
+
+
+def test_concurrent_senders_respect_both_limits_against_a_fake_api():
+    api, bot = fake_bot(global_rate=200, chat_rate=20)
+
+    with ThreadPoolExecutor(HANDLER_THREADS) as executor:
+        for _ in range(5):
+            for chat_id in range(20):
+                executor.submit(run_blocking, bot.send_message(chat_id, "hello"))
+
+    assert len(api.sent) == 100
+    times = [at for at, _, _ in api.sent]
+    # Threads run the sends a little after their grant, so allow some jitter around the exact spacing
+    assert times[-1] - times[0] >= 99 / 200 * 0.9
+    for chat_id in range(20):
+        chat_times = [at for at, _, sent_chat_id in api.sent if sent_chat_id == chat_id]
+        assert chat_times[-1] - chat_times[0] >= 4 / 20 * 0.9
+
+
+def test_a_busy_chat_does_not_hold_back_other_chats():
+    api, bot = fake_bot(global_rate=200, chat_rate=2)
+
+    with ThreadPoolExecutor(HANDLER_THREADS) as executor:
+        for _ in range(4):
+            executor.submit(run_blocking, bot.send_message(1, "spam"))
+        time.sleep(0.05)
+        started = time.monotonic()
+        executor.submit(run_blocking, bot.send_message(2, "reply")).result()
+        assert time.monotonic() - started < 0.2
+
+
+def test_a_429_is_retried_after_retry_after():
+    api, bot = fake_bot()
+    api.failures[1] = [too_many_requests(0.2)]
+
+    started = time.monotonic()
+    assert run_blocking(bot.send_message(1, "hello")) == ("send_message", 1)
+    assert time.monotonic() - started >= 0.2
+
+
+def test_other_api_errors_reach_the_caller():
+    api, bot = fake_bot()
+    forbidden = ApiTelegramException("sendMessage", None, {"error_code": 403, "description": "Forbidden"})
+    api.failures[1] = [forbidden]
+
+    with pytest.raises(ApiTelegramException):
+        run_blocking(bot.send_message(1, "hello"))
+    assert api.sent == []
+
+
+def test_unscheduled_methods_pass_straight_through():
+    api, bot = fake_bot()
+    assert run_blocking(bot.get_me()) == "me"
+
+
+def test_a_retried_upload_sends_the_whole_file_again(tmp_path):
+    uploads = []
+
+    class UploadApi(FakeApi):
+        def send_photo(self, chat_id, photo, **kwargs):
+            # Like the HTTP client, every attempt reads the file to the end
+            uploads.append(photo.read())
+            if len(uploads) == 1:
+                raise too_many_requests(0.1)
+            return "sent"
+
+    api = UploadApi()
+    bot = RateLimitedBot(Blocking(api), ThreadedSendScheduler(SendQueue(global_rate=200, chat_rate=20)))
+    image_path = tmp_path / "image.webp"
+    image_path.write_bytes(b"RIFF image bytes")
+
+    with open(image_path, "rb") as image_file:
+        assert run_blocking(bot.send_photo(1, photo=image_file)) == "sent"
+
+    assert uploads == [b"RIFF image bytes", b"RIFF image bytes"]
@@ -0,0 +1,106 @@
+from telebot import types
+
+from polling import MAX_BATCH, Poller, collapse_backlog
+from router import BUTTON_INDEX
+from runtime import ThreadedTasks, run_blocking
+
+
+BALANCE = next(label for label, button_key in BUTTON_INDEX.items() if button_key == "balance_button")
+
+
+def message(update_id, chat_id, text):
+    return types.Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text, "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Goblin"}}})
+
+
+def callback(update_id, chat_id, data, message_id):
+    return types.Update.de_json({"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "1", "data": data,
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Goblin"},
+        "message": {"message_id": message_id, "date": 0, "chat": {"id": chat_id, "type": "private"}}}})
+
+
+def ids(updates):
+    return [update.update_id for update in updates]
+
+
+class FakeDb:
+    def __init__(self, offset=None):
+        self.offset = offset
+
+    async def get_polling_offset(self):
+        return self.offset
+
+    async def commit_polling_offset(self, update_id):
+        self.offset = max(update_id, self.offset or update_id)
+
+
+class FakeTelegram:
+    """
+    Serves a backlog like getUpdates: from the offset on, at most limit updates, confirming those before it.
+    """
+
+    def __init__(self, backlog):
+        self.backlog = backlog
+        self.calls = []
+        self.poller = None
+
+    async def get_updates(self, offset, limit, timeout):
+        self.calls.append((offset, limit, timeout))
+        if offset is not None:
+            self.backlog = [update for update in self.backlog if update.update_id >= offset]
+        if not self.backlog:
+            # Caught up; the first long poll ends the test
+            self.poller.stop()
+        return self.backlog[:limit]
+
+
+def poll(backlog, db):
+    telegram = FakeTelegram(backlog)
+    dispatched = []
+    poller = telegram.poller = Poller(telegram.get_updates, dispatched.extend, db, ThreadedTasks())
+    run_blocking(poller.run())
+    return telegram, dispatched
+
+
+def test_repeated_menu_taps_collapse_into_the_last_one():
+    kept, duplicates, collapsed = collapse_backlog([message(1, 7, BALANCE), message(2, 8, BALANCE),
+                                                    message(3, 7, BALANCE)])
+    assert (ids(kept), duplicates, collapsed) == ([2, 3], 0, 1)
+
+
+def test_commands_are_never_collapsed():
+    kept, _, _ = collapse_backlog([message(1, 7, "/start"), message(2, 7, "/start")])
+    assert ids(kept) == [1, 2]
+
+
+def test_callbacks_collapse_only_on_the_same_message():
+    kept, _, collapsed = collapse_backlog([callback(1, 7, "claim_gold", 10), callback(2, 7, "claim_gold", 11),
+                                           callback(3, 7, "claim_gold", 11)])
+    assert (ids(kept), collapsed) == ([1, 3], 1)
+
+
+def test_only_the_last_language_choice_on_a_picker_counts():
+    kept, _, _ = collapse_backlog([callback(1, 7, "en", 10), callback(2, 7, "ru", 10)])
+    assert ids(kept) == [2]
+
+
+def test_duplicates_and_committed_updates_are_dropped():
+    kept, duplicates, _ = collapse_backlog([message(5, 7, "a"), message(6, 7, "b"), message(6, 7, "b")], 5)
+    assert (ids(kept), duplicates) == ([6], 2)
+
+
+def test_catch_up_resumes_after_the_committed_offset_in_full_batches():
+    backlog = [message(update_id, update_id, "/start") for update_id in range(100, 351)]
+    telegram, dispatched = poll(backlog, FakeDb(offset=149))
+
+    assert ids(dispatched) == list(range(150, 351))
+    assert telegram.calls[0] == (150, MAX_BATCH, 0)
+    assert [call[2] for call in telegram.calls[:3]] == [0, 0, 0]
+
+
+def test_the_offset_is_committed_after_dispatch():
+    db = FakeDb()
+    poll([message(1, 7, BALANCE), message(2, 7, BALANCE)], db)
+    assert db.offset == 2
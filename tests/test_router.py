@@ -0,0 +1,107 @@
+import pytest
+
+from languages import LANGUAGES
+from localization import CATALOGS
+from router import (BUTTON_INDEX, CALLBACK_ACTIONS, CALLBACK_PREFIXES, MENU_BUTTONS, build_button_index,
+                    index_catalog_buttons, route_callback, route_text)
+
+
+# The callback_data of every inline button the keyboards build, and the action it must reach
+KEYBOARD_CALLBACKS = {
+    "initiation": "initiation",
+    "claim_gold": "claim_gold",
+    "reminders_off": "reminders",
+    "reminders_on": "reminders",
+    "top_balance": "leaderboard",
+    "top_amount_of_referrals": "leaderboard",
+}
+
+# The callback_data handle_link_buttons and handle_check_buttons tell apart
+QUEST_CALLBACKS = {
+    "link_to_twitter": "link",
+    "link_bot_quest_button": "link",
+    "link_subscribe_quest_button": "link",
+    "check_daily_quest": "check",
+    "check_another_bot_quest": "check",
+    "check_subscribe_tg_channel_quest": "check",
+}
+
+
+class FakeCatalog:
+    def __init__(self, language_code, texts):
+        self.language_code = language_code
+        self.texts = texts
+
+    def labels(self, keys):
+        return {key: self.texts[key] for key in keys if key in self.texts}
+
+
+@pytest.mark.parametrize("language_code", sorted(LANGUAGES))
+@pytest.mark.parametrize("button_key", MENU_BUTTONS)
+def test_every_menu_label_routes_to_its_button(language_code, button_key):
+    label = LANGUAGES[language_code].get(button_key, LANGUAGES["en"][button_key])
+    assert route_text(label) == button_key
+
+
+@pytest.mark.parametrize("text", [None, "", "/start", "/start abc123", "hello", "Balance!"])
+def test_other_texts_are_not_routed(text):
+    assert route_text(text) is None
+
+
+def test_a_label_shared_by_two_buttons_is_rejected():
+    languages = {"en": {"balance_button": "Gold", "pillage_button": "Gold"}}
+    with pytest.raises(ValueError, match="Gold"):
+        build_button_index(languages, ("balance_button", "pillage_button"))
+
+
+def test_a_label_shared_across_languages_by_one_button_is_indexed_once():
+    languages = {"en": {"balance_button": "Balance"}, "de": {"balance_button": "Balance"}}
+    assert build_button_index(languages, ("balance_button",)) == {"Balance": "balance_button"}
+
+
+def test_missing_labels_are_skipped():
+    languages = {"en": {"balance_button": "Balance"}, "de": {}}
+    assert build_button_index(languages, ("balance_button",)) == {"Balance": "balance_button"}
+
+
+def test_a_lazy_locale_colliding_with_an_indexed_label_leaves_the_index_unchanged():
+    before = dict(BUTTON_INDEX)
+    texts = {"balance_button": "Neu", "pillage_button": LANGUAGES["en"]["balance_button"]}
+    with pytest.raises(ValueError):
+        index_catalog_buttons(FakeCatalog("xx", texts))
+    assert BUTTON_INDEX == before
+
+
+def test_a_lazy_locale_is_indexed():
+    try:
+        index_catalog_buttons(FakeCatalog("xx", {"balance_button": "Xx balance"}))
+        assert route_text("Xx balance") == "balance_button"
+    finally:
+        BUTTON_INDEX.pop("Xx balance", None)
+
+
+@pytest.mark.parametrize("data, action", sorted({**KEYBOARD_CALLBACKS, **QUEST_CALLBACKS}.items()))
+def test_every_callback_value_routes_to_its_action(data, action):
+    assert route_callback(data) == action
+
+
+@pytest.mark.parametrize("language_code", CATALOGS.language_codes)
+def test_every_language_code_routes_to_the_language_picker(language_code):
+    assert route_callback(language_code) == "language"
+
+
+def test_exact_callback_values_are_all_covered():
+    exact = set(CALLBACK_ACTIONS) - set(CATALOGS.language_codes)
+    assert exact == set(KEYBOARD_CALLBACKS)
+
+
+@pytest.mark.parametrize("prefix, action", sorted(CALLBACK_PREFIXES.items()))
+def test_every_prefix_routes_whatever_follows_it(prefix, action):
+    assert route_callback(prefix) == action
+    assert route_callback(prefix + "anything_else") == action
+    assert {route_callback(data) for data in QUEST_CALLBACKS if data.startswith(prefix)} == {action}
+
+
+@pytest.mark.parametrize("data", [None, "", "invite", "link", "check", "unknown_value", "_link", "Link_to_twitter"])
+def test_unknown_callbacks_are_not_routed(data):
+    assert route_callback(data) is None
@@ -0,0 +1,98 @@
+import threading
+import time
+
+from sharding import ChatOrderedExecutor, HashRing
+
+
+KEYS = range(10000)
+
+
+def test_a_chat_runs_in_submit_order_while_other_chats_run_alongside():
+    executor = ChatOrderedExecutor(max_workers=4)
+    order = {1: [], 2: []}
+    first_running = threading.Event()
+    release_first = threading.Event()
+
+    def handle(chat_id, number):
+        if (chat_id, number) == (1, 0):
+            first_running.set()
+            # Chat 2 finishes everything while chat 1 is still on its first update
+            assert release_first.wait(5)
+        time.sleep(0.001)
+        order[chat_id].append(number)
+
+    executor.submit(1, lambda: handle(1, 0))
+    assert first_running.wait(5)
+    for number in range(1, 20):
+        executor.submit(1, lambda number=number: handle(1, number))
+    for number in range(20):
+        executor.submit(2, lambda number=number: handle(2, number))
+
+    deadline = time.monotonic() + 5
+    while len(order[2]) < 20 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert order[2] == list(range(20))
+    assert order[1] == []
+
+    release_first.set()
+    executor.drain()
+    assert order[1] == list(range(20))
+
+
+def test_one_chat_never_runs_two_functions_at_once():
+    executor = ChatOrderedExecutor(max_workers=8)
+    running = {chat_id: 0 for chat_id in range(4)}
+    overlaps = []
+    lock = threading.Lock()
+
+    def handle(chat_id):
+        with lock:
+            running[chat_id] += 1
+            if running[chat_id] > 1:
+                overlaps.append(chat_id)
+        time.sleep(0.001)
+        with lock:
+            running[chat_id] -= 1
+
+    for _ in range(50):
+        for chat_id in running:
+            executor.submit(chat_id, lambda chat_id=chat_id: handle(chat_id))
+    executor.drain()
+
+    assert overlaps == []
+
+
+def ring(*nodes):
+    ring = HashRing()
+    for node in nodes:
+        ring.add(node)
+    return ring
+
+
+def test_adding_a_node_only_moves_keys_to_it():
+    before = ring("worker-1", "worker-2", "worker-3")
+    after = ring("worker-1", "worker-2", "worker-3", "worker-4")
+
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+
+    assert {after.node_for(key) for key in moved} == {"worker-4"}
+    # About a quarter of the keys, not a reshuffle
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+
+
+def test_removing_a_node_only_moves_its_own_keys():
+    before = ring("worker-1", "worker-2", "worker-3", "worker-4")
+    after = ring("worker-1", "worker-2", "worker-3", "worker-4")
+    after.remove("worker-2")
+
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+
+    assert moved == [key for key in KEYS if before.node_for(key) == "worker-2"]
+    assert "worker-2" not in after.nodes
+
+
+def test_the_order_nodes_were_added_in_does_not_matter():
+    one = ring("worker-1", "worker-2", "worker-3")
+    other = ring("worker-3", "worker-1", "worker-2")
+
+    assert all(one.node_for(key) == other.node_for(key) for key in KEYS)
@@ -0,0 +1,145 @@
+import time
+
+import pytest
+from telebot import types
+
+from handlers import claim_gold_callback
+from runtime import run_blocking
+from throttle import ACTION_LIMITS, DEFAULT_LIMIT, ActionLimit, UserThrottle, parse_limits
+
+
+def test_taps_older_than_every_collapse_window_are_forgotten():
+    users = UserThrottle(default_limit=ActionLimit(rate=100, burst=100, collapse_window=1))
+    longest_window = max(limit.collapse_window for limit in ACTION_LIMITS.values())
+
+    for second in range(100):
+        # Every callback message_id is a key of its own
+        assert users.admit(1, "check", key=f"message-{second}", now=second)
+        users.done(1, "check", key=f"message-{second}")
+
+    assert len(users._users[1].last_admitted) <= longest_window + 1
+
+
+LIMIT = ActionLimit(rate=1, burst=3, collapse_window=2)
+
+
+def throttle(max_users=100):
+    return UserThrottle(limits={"tap": LIMIT}, max_users=max_users)
+
+
+def test_identical_taps_collapse_inside_the_window():
+    users = throttle()
+    assert users.admit(1, "tap", now=0)
+    users.done(1, "tap")
+
+    assert not users.admit(1, "tap", now=1.9)
+    assert users.admit(1, "tap", now=2)
+
+
+def test_taps_with_other_keys_do_not_collapse():
+    users = throttle()
+    assert users.admit(1, "tap", key="a", now=0)
+    assert users.admit(1, "tap", key="b", now=0)
+    assert users.admit(2, "tap", key="a", now=0)
+
+
+def test_a_tap_still_in_flight_drops_identical_ones():
+    users = throttle()
+    assert users.admit(1, "tap", now=0)
+
+    assert not users.admit(1, "tap", now=10)
+    users.done(1, "tap")
+    assert users.admit(1, "tap", now=10)
+
+
+def test_the_bucket_refuses_a_burst():
+    users = throttle()
+    admitted = [users.admit(1, "tap", key=tap, now=0) for tap in range(5)]
+    assert admitted == [True, True, True, False, False]
+
+    # rate 1 refills one tap per second
+    assert users.admit(1, "tap", key="later", now=1)
+    assert not users.admit(1, "tap", key="too soon", now=1.5)
+
+
+def test_unlisted_actions_use_the_default_limit():
+    users = throttle()
+    admitted = [users.admit(1, "unlisted", key=tap, now=0) for tap in range(DEFAULT_LIMIT.burst + 1)]
+    assert admitted.count(True) == DEFAULT_LIMIT.burst
+
+
+def test_the_least_recently_active_user_is_evicted():
+    users = throttle(max_users=2)
+    users.admit(1, "tap", now=0)
+    users.admit(2, "tap", now=0)
+    # User 1 becomes the most recently active
+    users.admit(1, "tap", key="again", now=0)
+    users.admit(3, "tap", now=0)
+
+    assert len(users) == 2
+    assert set(users._users) == {1, 3}
+
+
+def test_a_cooldown_answer_lasts_until_ready_at():
+    users = throttle()
+    users.set_cooldown(1, "claim_gold", ready_at=100, answer="wait")
+
+    assert users.cooldown(1, "claim_gold", now=99) == "wait"
+    assert users.cooldown(1, "claim_gold", now=100) is None
+    assert users.cooldown(2, "claim_gold", now=0) is None
+
+
+def test_forgotten_cooldowns_are_not_answered():
+    users = throttle()
+    users.set_cooldown(1, "claim_gold", ready_at=100, answer="wait")
+    users.forget_cooldowns(1)
+    assert users.cooldown(1, "claim_gold", now=0) is None
+
+
+def test_parse_limits():
+    limits = parse_limits(" claim_gold=0.5/3/2, balance_button=1/5/1 ,")
+    assert {action: (limit.rate, limit.burst, limit.collapse_window) for action, limit in limits.items()} == {
+        "claim_gold": (0.5, 3, 2), "balance_button": (1, 5, 1)}
+    assert parse_limits("") == {}
+
+
+@pytest.mark.parametrize("text", ["claim_gold", "claim_gold=1/2", "claim_gold=1/2/3/4", "claim_gold=a/b/c"])
+def test_malformed_limits_are_rejected(text):
+    with pytest.raises(ValueError):
+        parse_limits(text)
+
+
+class NoDb:
+    def __getattr__(self, name):
+        raise AssertionError(f"The cached cooldown answer read the database ({name})")
+
+
+class FakeRt:
+    def __init__(self):
+        self.throttle = throttle()
+        self.calls = []
+        self.bot = self.media = self
+
+    async def delete_message(self, chat_id, message_id):
+        self.calls.append(("delete_message", chat_id, message_id))
+
+    async def send_photo(self, chat_id, image_path, caption=None):
+        self.calls.append(("send_photo", chat_id, image_path, caption))
+
+    async def reply_to(self, message, text):
+        self.calls.append(("reply_to", message.chat.id, text))
+
+
+def test_a_claim_during_the_cooldown_is_answered_without_the_database():
+    rt = FakeRt()
+    last_claim_time = time.time() - 60
+    rt.throttle.set_cooldown(7, "claim_gold", ready_at=time.time() + 3600, answer=(last_claim_time, "en"))
+    call = types.CallbackQuery.de_json({
+        "id": "1", "chat_instance": "1", "data": "claim_gold",
+        "from": {"id": 7, "is_bot": False, "first_name": "Goblin"},
+        "message": {"message_id": 10, "date": 0, "chat": {"id": 7, "type": "private"}}})
+
+    run_blocking(claim_gold_callback(rt, NoDb(), call))
+
+    assert rt.calls[0] == ("delete_message", 7, 10)
+    assert [call[:3] for call in rt.calls[1:]] == [("send_photo", 7, "webp_images/claim_unsuccessful.webp")]
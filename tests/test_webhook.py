@@ -0,0 +1,118 @@
+import asyncio
+import http.client
+import json
+import threading
+import time
+
+import pytest
+
+from webhook import SECRET_TOKEN_HEADER, WebhookServer, create_webhook_app
+
+
+SECRET = "s3cret"
+PATH = "/telegram"
+
+
+def update_body(update_id):
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "/start", "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "Goblin"}}}).encode()
+
+
+def headers(secret):
+    return {} if secret is None else {SECRET_TOKEN_HEADER: secret}
+
+
+class RecordingBot:
+    def __init__(self):
+        self.update_ids = []
+
+    def process_new_updates(self, updates):
+        self.update_ids.extend(update.update_id for update in updates)
+
+
+class AsyncRecordingBot(RecordingBot):
+    async def process_new_updates(self, updates):
+        super().process_new_updates(updates)
+
+
+@pytest.fixture
+def threaded_server():
+    bot = RecordingBot()
+    server = WebhookServer(bot, "127.0.0.1", 0, PATH, SECRET, queue_size=2)
+    # The consumer only starts when a test asks for it, so the queue can fill up
+    threading.Thread(target=server.http_server.serve_forever, daemon=True).start()
+    yield server
+    server.http_server.shutdown()
+    server.http_server.server_close()
+
+
+def post(server, body, secret=SECRET, path=PATH):
+    connection = http.client.HTTPConnection(*server.http_server.server_address[:2], timeout=5)
+    try:
+        connection.request("POST", path, body, headers(secret))
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("secret", [None, "wrong", SECRET + "x"])
+def test_threaded_webhook_rejects_a_missing_or_wrong_secret(threaded_server, secret):
+    assert post(threaded_server, update_body(1), secret) == 403
+    assert threaded_server.updates.empty()
+
+
+def test_threaded_webhook_answers_503_when_its_queue_is_full(threaded_server):
+    assert [post(threaded_server, update_body(update_id)) for update_id in (1, 2, 3)] == [200, 200, 503]
+    assert post(threaded_server, update_body(4), path="/other") == 404
+
+    threading.Thread(target=threaded_server._consume, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while threaded_server.bot.update_ids != [1, 2] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert threaded_server.bot.update_ids == [1, 2]
+
+    # Telegram's redelivery gets through once the queue has room again
+    assert post(threaded_server, update_body(3)) == 200
+
+
+def run_async_webhook(scenario, queue_size=2):
+    test_utils = pytest.importorskip("aiohttp.test_utils")
+
+    async def main():
+        bot = AsyncRecordingBot()
+        app, consume = create_webhook_app(bot, PATH, SECRET, queue_size)
+        async with test_utils.TestClient(test_utils.TestServer(app)) as client:
+            async def post(update_id, secret=SECRET, path=PATH):
+                response = await client.post(path, data=update_body(update_id), headers=headers(secret))
+                return response.status
+
+            await scenario(bot, consume, post)
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("secret", [None, "wrong", SECRET + "x"])
+def test_async_webhook_rejects_a_missing_or_wrong_secret(secret):
+    async def scenario(bot, consume, post):
+        assert await post(1, secret) == 403
+
+    run_async_webhook(scenario)
+
+
+def test_async_webhook_answers_503_when_its_queue_is_full():
+    async def scenario(bot, consume, post):
+        assert [await post(update_id) for update_id in (1, 2, 3)] == [200, 200, 503]
+        assert await post(4, path="/other") in (404, 405)
+
+        consumer = asyncio.create_task(consume())
+        for _ in range(100):
+            if bot.update_ids == [1, 2]:
+                break
+            await asyncio.sleep(0.01)
+        assert bot.update_ids == [1, 2]
+
+        assert await post(3) == 200
+        consumer.cancel()
+
+    run_async_webhook(scenario)
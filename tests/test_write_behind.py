@@ -0,0 +1,127 @@
+import threading
+
+import pytest
+
+from db import UsersDb
+from runtime import Blocking, run_blocking
+
+
+class FakeUsers:
+    """
+    A users collection that keeps documents in a dict and logs every write in the order it arrives.
+    """
+
+    def __init__(self):
+        self.documents = {1: {"_id": 1, "user_language": "en", "balance": 0}}
+        self.writes = []
+        # Called at the start of bulk_write, e.g. to fail it or to act while it is in flight
+        self.on_bulk_write = None
+
+    def _set(self, user_id, values):
+        self.documents.setdefault(user_id, {"_id": user_id}).update(values)
+
+    def bulk_write(self, requests, ordered=True):
+        if self.on_bulk_write is not None:
+            self.on_bulk_write()
+        for request in requests:
+            self.writes.append(("bulk_write", request._filter["_id"], request._doc["$set"]))
+            self._set(request._filter["_id"], request._doc["$set"])
+
+    def update_one(self, query, update):
+        self.writes.append(("update_one", query["_id"], update["$set"]))
+        self._set(query["_id"], update["$set"])
+
+    def find_one(self, query, projection=None):
+        document = self.documents.get(query["_id"])
+        return None if document is None else dict(document)
+
+
+@pytest.fixture
+def users():
+    return FakeUsers()
+
+
+@pytest.fixture
+def db(users):
+    # MongoClient connects lazily, so nothing here reaches a server
+    db = UsersDb("mongodb://localhost", "test", None, None, "admin", write_behind_interval=60)
+    db.users_collection = db.write_behind.collection = Blocking(users)
+    return db
+
+
+def test_buffered_fields_are_not_written_right_away(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru"}))
+    assert users.writes == []
+
+
+def test_a_direct_write_flushes_the_users_buffered_fields_first(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru"}))
+    run_blocking(db.update_user_data(1, {"balance": 5}))
+
+    assert users.writes == [("bulk_write", 1, {"user_language": "ru"}), ("update_one", 1, {"balance": 5})]
+
+
+def test_writes_made_during_a_flush_land_after_it(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru"}))
+    in_flight, release = threading.Event(), threading.Event()
+
+    def block_first_flush():
+        users.on_bulk_write = None
+        in_flight.set()
+        release.wait(5)
+
+    users.on_bulk_write = block_first_flush
+    flusher = threading.Thread(target=run_blocking, args=(db.write_behind.flush(),))
+    flusher.start()
+    assert in_flight.wait(5)
+
+    run_blocking(db.update_user_data(1, {"user_language": "de"}))
+    writer = threading.Thread(target=run_blocking, args=(db.update_user_data(1, {"balance": 5}),))
+    writer.start()
+    writer.join(0.2)
+    # The direct write waits for the flush in flight
+    assert writer.is_alive() and users.writes == []
+
+    release.set()
+    flusher.join(5)
+    writer.join(5)
+
+    assert users.writes == [("bulk_write", 1, {"user_language": "ru"}), ("bulk_write", 1, {"user_language": "de"}),
+                            ("update_one", 1, {"balance": 5})]
+    assert users.documents[1]["user_language"] == "de"
+
+
+def test_a_failed_flush_goes_back_under_newer_writes(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru", "subscribe_channel_quest_time": 10}))
+
+    def fail_after_a_newer_write():
+        users.on_bulk_write = None
+        run_blocking(db.write_behind.write(1, {"user_language": "de"}))
+        raise ConnectionError("network down")
+
+    users.on_bulk_write = fail_after_a_newer_write
+    with pytest.raises(ConnectionError):
+        run_blocking(db.write_behind.flush())
+
+    assert db.write_behind.pending(1) == {"user_language": "de", "subscribe_channel_quest_time": 10}
+
+    run_blocking(db.write_behind.flush())
+    assert users.writes == [("bulk_write", 1, {"user_language": "de", "subscribe_channel_quest_time": 10})]
+
+
+def test_reads_see_buffered_values(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru"}))
+
+    user = run_blocking(db.get_user(1, ("user_language", "balance")))
+
+    assert (user.user_language, user.balance) == ("ru", 0)
+    assert users.documents[1]["user_language"] == "en"
+
+
+def test_a_flush_writes_every_pending_user(db, users):
+    run_blocking(db.update_user_data(1, {"user_language": "ru"}))
+    run_blocking(db.update_user_data(2, {"user_language": "de"}))
+    run_blocking(db.write_behind.flush())
+
+    assert sorted(write[1] for write in users.writes) == [1, 2]
+    assert db.write_behind.pending_users() == 0
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from metrics import THROTTLED
+from outbound import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+
+class ActionLimit:
+    """
+    How often one user may trigger an action.
+
+    rate taps per second refill a bucket of burst taps; a tap finding it empty is dropped. A tap identical to
+    one that is still being handled, or that was admitted less than collapse_window seconds ago, is dropped too:
+    its answer would be the same.
+    """
+
+    __slots__ = ("rate", "burst", "collapse_window")
+
+    def __init__(self, rate, burst, collapse_window):
+        self.rate = rate
+        self.burst = burst
+        self.collapse_window = collapse_window
+
+
+# Actions by router key: menu button keys, callback actions and commands
+ACTION_LIMITS = {
+    # Each claim tap costs a delete, a conditional update and a photo, and mostly answers "wait"
+    "claim_gold": ActionLimit(rate=0.5, burst=3, collapse_window=2),
+    "pillage_button": ActionLimit(rate=0.5, burst=3, collapse_window=2),
+    "balance_button": ActionLimit(rate=0.5, burst=3, collapse_window=2),
+    "leaderboard": ActionLimit(rate=0.5, burst=3, collapse_window=1),
+    "start": ActionLimit(rate=0.2, burst=2, collapse_window=5),
+}
+
+# Limit of the actions not listed above
+DEFAULT_LIMIT = ActionLimit(rate=1, burst=5, collapse_window=1)
+
+
+def parse_limits(text):
+    """
+    Parses limit overrides like "claim_gold=0.5/3/2,balance_button=1/5/1" (rate/burst/collapse_window).
+
+    Returns:
+        A dict of {action: ActionLimit}.
+
+    Raises:
+        ValueError: If an entry is malformed.
+    """
+    limits = {}
+    for entry in filter(None, (part.strip() for part in text.split(","))):
+        action, separator, values = entry.partition("=")
+        parts = values.split("/")
+        if not separator or len(parts) != 3:
+            raise ValueError(f"Throttle limit {entry!r} is not action=rate/burst/collapse_window.")
+        rate, burst, collapse_window = (float(part) for part in parts)
+        limits[action.strip()] = ActionLimit(rate, burst, collapse_window)
+    return limits
+
+
+class _UserState:
+    __slots__ = ("buckets", "last_admitted", "in_flight", "cooldowns")
+
+    def __init__(self):
+        self.buckets = {}  # action -> TokenBucket
+        self.last_admitted = {}  # (action, key) -> time.monotonic() of the last admitted tap
+        self.in_flight = set()  # (action, key) being handled
+        self.cooldowns = {}  # action -> (ready_at, answer)
+
+
+class UserThrottle:
+    """
+    Decides in memory whether a user's tap is handled at all, before it costs any API call or database read.
+
+    Every user has a token bucket per action and remembers their last identical taps, so button mashing is cut
+    down to one handled tap per collapse window. Handlers can also cache the answer to a cooldown ("wait
+    03:59:12") until the cooldown ends, so repeated taps during it are answered without the database.
+
+    The users are kept in LRU order and the least recently active are evicted beyond max_users; losing one only
+    costs the next tap its shortcut. With sharding every worker has its own throttle, which is exact because
+    a chat's updates always reach the same worker.
+    """
+
+    def __init__(self, limits=None, default_limit=DEFAULT_LIMIT, max_users=100000):
+        self.limits = {**ACTION_LIMITS, **(limits or {})}
+        self.default_limit = default_limit
+        self.max_users = max_users
+        # Taps admitted longer ago than this can't collapse any tap, whatever their action
+        self._max_collapse_window = max(limit.collapse_window for limit in (default_limit, *self.limits.values()))
+        self._users = OrderedDict()  # user_id -> _UserState, least recently active first
+        # Only held for dict operations, never across an await, so it works in both runtimes
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def _user(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState()
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def admit(self, user_id, action, key=None, now=None):
+        """
+        Returns whether a tap should be handled. An admitted tap must be followed by done() once handled.
+
+        Args:
+            user_id: The user tapping.
+            action: The router key of the action, which selects its ActionLimit.
+            key: What makes two taps identical, e.g. the callback_data; the action itself if None.
+            now: time.monotonic(), for tests.
+        """
+        now = time.monotonic() if now is None else now
+        limit = self.limits.get(action, self.default_limit)
+        tap = (action, key)
+
+        with self._lock:
+            state = self._user(user_id)
+            if tap in state.in_flight or now - state.last_admitted.get(tap, -limit.collapse_window) < \
+                    limit.collapse_window:
+                reason = "collapsed"
+            else:
+                bucket = state.buckets.get(action)
+                if bucket is None:
+                    bucket = state.buckets[action] = TokenBucket(limit.rate, limit.burst, now)
+                if bucket.time_until_token(now):
+                    reason = "rate"
+                else:
+                    bucket.take(now)
+                    # Every deep link payload or message_id is a key of its own, so old ones must go
+                    for expired in [admitted for admitted, admitted_at in state.last_admitted.items()
+                                    if now - admitted_at >= self._max_collapse_window]:
+                        del state.last_admitted[expired]
+                    state.last_admitted[tap] = now
+                    state.in_flight.add(tap)
+                    return True
+
+        THROTTLED.inc(action, reason)
+        logger.debug("Dropped %s tap of user %s (%s)", action, user_id, reason)
+        return False
+
+    def done(self, user_id, action, key=None):
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.in_flight.discard((action, key))
+
+    def cooldown(self, user_id, action, now=None):
+        """
+        Returns the answer cached with set_cooldown while the cooldown lasts, else None.
+
+        Args:
+            now: time.time(), for tests.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._users.get(user_id)
+            entry = state.cooldowns.get(action) if state is not None else None
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del state.cooldowns[action]
+                return None
+            return entry[1]
+
+    def set_cooldown(self, user_id, action, ready_at, answer):
+        """
+        Caches what to answer to the action until ready_at (a time.time() timestamp), when it becomes possible.
+        """
+        with self._lock:
+            self._user(user_id).cooldowns[action] = (ready_at, answer)
+
+    def forget_cooldowns(self, user_id):
+        """
+        Drops a user's cached cooldown answers, e.g. because they are in the language the user just left.
+        """
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.cooldowns.clear()
@@ -1,13 +1,18 @@
 import time
-from languages import LANGUAGES
+from localization import CATALOGS
 import logging
 from datetime import datetime, timedelta
 
 
 logger = logging.getLogger(__name__)
 
+PILLAGE_COOLDOWN = timedelta(hours=4)
+DAILY_QUEST_DURATION = timedelta(hours=24)
+# Time after a tap on the twitter link at which the link counts as visited
+TWITTER_CLICK_DELAY = timedelta(seconds=10)
 
-def get_message_text(db, user_id, message_key, **kwargs):
+
+async def get_message_text(db, user_id, message_key, **kwargs):
     """
    Gets the message text in the user's preferred language, inserting provided kwargs into the string.
 
@@ -21,18 +26,25 @@ def get_message_text(db, user_id, message_key, **kwargs):
        The formatted message text in the user's language, or the default English message if not found.
    """
 
-    user_data = db.get_user_data(user_id)
-    user_language = user_data.get("user_language", "en")
-    message_texts = LANGUAGES.get(user_language, {})
+    return render_message(await get_user_language(db, user_id), message_key, **kwargs)
+
 
-    message_text = message_texts.get(message_key, LANGUAGES["en"][message_key])
+def render_message(language_code, message_key, **kwargs):
+    """
+    Formats a message from the compiled catalog of the given language, falling back to English.
 
-    formatted_message = message_text.format(**kwargs)
+    Args:
+        language_code: The language to render in.
+        message_key: The key of the message to retrieve from LANGUAGES.
+        **kwargs: Keyword arguments to insert into the message string.
 
-    return formatted_message
+    Returns:
+        The formatted message text.
+    """
+    return CATALOGS.catalog(language_code).render(message_key, **kwargs)
 
 
-def get_button_name(db, user_id, button_key):
+async def get_button_name(db, user_id, button_key):
     """
     Gets the button name in the user's preferred language.
 
@@ -45,25 +57,19 @@ def get_button_name(db, user_id, button_key):
         The button name in the user's language, or the default English button name if not found.
     """
 
-    user_data = db.get_user_data(user_id)
-    user_language = user_data.get("user_language", "en")
-    button_texts = LANGUAGES.get(user_language, {})
-
-    button_name = button_texts.get(button_key, LANGUAGES["en"].get(button_key, button_key))
-
-    return button_name
+    return CATALOGS.catalog(await get_user_language(db, user_id)).label(button_key)
 
 
 def get_current_timestamp():
     return time.time()
 
 
-def get_last_pillage_time(db, user_id):
-    user_data = db.get_user_data(user_id)
-    return user_data.get("last_time_pillage_claimed", 0)
+async def get_last_pillage_time(db, user_id):
+    user = await db.get_user(user_id, ("last_time_pillage_claimed",))
+    return user.last_time_pillage_claimed if user else 0
 
 
-def update_last_pillage_time(db, user_id, timestamp):
+async def update_last_pillage_time(db, user_id, timestamp):
     """
     Updates the user's last pillage claim time in the database.
 
@@ -72,16 +78,16 @@ def update_last_pillage_time(db, user_id, timestamp):
         user_id: The ID of the user to update.
         timestamp: The timestamp to set as the last pillage claim time.
     """
-    db.update_user_data(user_id, {"last_time_pillage_claimed": timestamp})
+    await db.update_user_data(user_id, {"last_time_pillage_claimed": timestamp})
 
 
-def get_gold_per_pillage(user_data) -> int:
-    if user_data is None:
+def get_gold_per_pillage(user) -> int:
+    if user is None:
         return 0
-    return user_data.get("gold_per_pillage", 0)
+    return user.gold_per_pillage
 
 
-def update_balance(db, user_id, amount):
+async def update_balance(db, user_id, amount):
     """
     Updates the user's balance in the database.
 
@@ -90,16 +96,13 @@ def update_balance(db, user_id, amount):
       user_id: The ID of the user to update.
       amount: The amount to add or subtract from the user's balance.
     """
-    # Retrieve current balance efficiently
-    current_balance = db.get_user_data(user_id).get("balance", 0)
-    new_balance = current_balance + amount
-    db.update_user_data(user_id, {"balance": new_balance})
-    return new_balance
+    # $inc on the server, so concurrent updates cannot overwrite each other
+    return await db.increase_balance(user_id, amount)
 
 
-def get_amount_of_referrals(db, user_id):
-    user_data = db.get_user_data(user_id)
-    return user_data.get("amount_of_referrals", 0)
+async def get_amount_of_referrals(db, user_id):
+    user = await db.get_user(user_id, ("amount_of_referrals",))
+    return user.amount_of_referrals if user else 0
 
 
 # Function to check if user is subscribed to the channel (replace with actual verification logic)
@@ -108,105 +111,113 @@ def is_user_subscribed(user_id):
     return True  # Placeholder for now
 
 
-def get_user_balance(db, user_id) -> int:
-    user_data = db.get_user_data(user_id)
+async def get_user_balance(db, user_id) -> int:
+    user = await db.get_user(user_id, ("balance",))
 
-    if user_data is None:
+    if user is None:
         return 0
-    return user_data.get("balance", 0)
+    return user.balance
 
 
-def get_user_referral_code(db, user_id) -> str:
-    user_data = db.get_user_data(user_id)
+async def get_user_referral_code(db, user_id) -> str:
+    user = await db.get_user(user_id, ("referral_code",))
 
-    if user_data is None:
+    if user is None:
         return ""
-    return user_data.get("referral_code", "")
+    return user.referral_code or ""
 
 
-def get_user_amount_of_referrals(db, user_id) -> int:
-    user_data = db.get_user_data(user_id)
+async def get_user_amount_of_referrals(db, user_id) -> int:
+    user = await db.get_user(user_id, ("amount_of_referrals",))
 
-    if user_data is None:
+    if user is None:
         return 0
-    return user_data.get("amount_of_referrals", 0)
+    return user.amount_of_referrals
 
 
-def get_user_language(db, user_id):
-    user_data = db.get_user_data(user_id)
-    return user_data.get("user_language", "en")
+async def get_user_language(db, user_id):
+    user = await db.get_user(user_id, ("user_language",))
+    return user.user_language if user else "en"
 
 
-def claim_gold(db, user_id):
-    user_data = db.get_user_data(user_id)
-    gold_per_pillage = get_gold_per_pillage(user_data)
+async def claim_gold(db, user_id):
+    """
+    Claims the user's pillage gold if the cooldown has passed, in a single conditional database update.
 
-    try:
-        # Check if last_time_quest_completed exists before subtracting
-        if user_data.get('last_time_daily_quest_completed'):
-            last_time_quest_completed = user_data.get('last_time_daily_quest_completed')
-            current_time = datetime.now()
-            time_difference = current_time - last_time_quest_completed
-
-            if time_difference >= timedelta(hours=24):
-                updated_balance = update_balance(db, user_id, gold_per_pillage * 2)
-            else:
-                updated_balance = update_balance(db, user_id, gold_per_pillage)
-        else:
-            # Handle the case where last_time_quest_completed is None
-            updated_balance = update_balance(db, user_id, gold_per_pillage)
+    Args:
+        db: The database object to interact with.
+        user_id: The ID of the user claiming.
 
-        if updated_balance is not None:
-            logger.info(f"User {user_id} successfully claimed gold. New balance: {updated_balance}")
-            return True
-        else:
-            logger.error(f"Failed to update balance for user {user_id}")
-            return False
+    Returns:
+        A tuple (claimed, last_claim_timestamp), where last_claim_timestamp is the claim the cooldown counts from.
+    """
+    claim_time = get_current_timestamp()
+
+    try:
+        user = await db.claim_pillage(user_id, claim_time, PILLAGE_COOLDOWN.total_seconds(),
+                                      datetime.now() - DAILY_QUEST_DURATION)
     except Exception as e:
         logger.exception(f"An error occurred while claiming gold for user {user_id}: {e}")
-        return False
+        return False, await get_last_pillage_time(db, user_id)
 
+    if user is None:
+        logger.error(f"Failed to claim gold for user {user_id}: user not found")
+        return False, None
 
-def find_user_by_referral_code(db, referral_code):
-    user_data = db.users_collection.find_one({"referral_code": referral_code})
-    if user_data:
-        return user_data["_id"]
-    else:
-        return None
+    last_claim_timestamp = user.last_time_pillage_claimed
+    claimed = last_claim_timestamp == claim_time
 
+    if claimed:
+        logger.info(f"User {user_id} successfully claimed gold. New balance: {user.balance}")
 
-def increase_referral_number(db, master_id):
-    db.increase_referrals_number(master_id)
+    return claimed, last_claim_timestamp
 
 
-def twitter_link_clicked(db, user_id):
-    time.sleep(10)
-    current_time = datetime.now()
-    db.update_user_data(user_id, {"last_time_twitter_link_clicked": current_time})
+async def find_user_by_referral_code(db, referral_code):
+    return await db.find_user_id_by_referral_code(referral_code)
+
+
+async def increase_referral_number(db, master_id):
+    await db.increase_referrals_number(master_id)
+
 
+async def twitter_link_clicked(db, user_id):
+    # Runs as a delayed job, TWITTER_CLICK_DELAY after the tap; a timestamp like last_time_pillage_claimed
+    await db.update_user_data(user_id, {"last_time_twitter_link_clicked": get_current_timestamp()})
 
-def mark_daily_quest_completed(db, user_id):
-    user_data = db.get_user_data(user_id)
-    last_time_link_clicked = user_data.get("last_time_twitter_link_clicked")
 
-    if last_time_link_clicked is not None:
+async def mark_daily_quest_completed(db, user_id):
+    user = await db.get_user(user_id, ("last_time_twitter_link_clicked",))
+
+    if user is not None and user.last_time_twitter_link_clicked is not None:
         current_time = datetime.now()
-        db.update_user_data(user_id, {"last_time_daily_quest_completed": current_time})
+        await db.update_user_data(user_id, {"last_time_daily_quest_completed": current_time})
         return True
     else:
         return False
 
 
-def get_latest_tweet_url(db):
-    common_data = db.get_common_data()
+async def get_latest_tweet_url(db):
+    common_data = await db.get_common_data()
     twitter_link = common_data["last_twitter_post_link"]
 
     return twitter_link
 
 
-def count_reward_time(db, user_id):
-    # Get the last pillage claim time as a datetime object
-    last_pillage_timestamp = get_last_pillage_time(db, user_id)
+async def count_reward_time(db, user_id):
+    return format_reward_time(await get_last_pillage_time(db, user_id))
+
+
+def format_reward_time(last_pillage_timestamp):
+    """
+    Formats the time left until the next pillage as HH:MM:SS.
+
+    Args:
+        last_pillage_timestamp: The timestamp of the last claim, or None if the user never claimed.
+
+    Returns:
+        The remaining time, or "00:00:00" if the user can pillage now.
+    """
     if last_pillage_timestamp is None:
         return "00:00:00"  # If there's no previous pillage, return 0 time remaining
 
@@ -219,11 +230,11 @@ def count_reward_time(db, user_id):
     time_difference = current_time - last_pillage_time
 
     # Check if at least 4 hours have passed since the last pillage
-    if time_difference >= timedelta(hours=4):
+    if time_difference >= PILLAGE_COOLDOWN:
         return "00:00:00"  # If 4 or more hours have passed, return 0 time remaining
 
     # Calculate remaining time until next pillage
-    remaining_time = timedelta(hours=4) - time_difference
+    remaining_time = PILLAGE_COOLDOWN - time_difference
 
     # Convert remaining seconds to integer
     remaining_seconds = int(remaining_time.total_seconds())
@@ -238,73 +249,87 @@ def count_reward_time(db, user_id):
     return reward_time
 
 
-def change_user_language(db, user_id, language_code):
+async def change_user_language(db, user_id, language_code):
     # Check if the language code is valid.
-    if language_code not in LANGUAGES:
+    if language_code not in CATALOGS.language_codes:
         raise ValueError("Invalid language code.")
 
-    db.update_user_data(user_id, {"user_language": language_code})
+    await db.update_user_data(user_id, {"user_language": language_code})
 
     # Return the success message.
     return {"message": "Language changed."}
 
 
-def get_referral_reward(db, user_id):
-    user_data = db.get_user_data(user_id)
+async def get_referral_reward(db, user_id):
+    user = await db.get_user(user_id, ("last_time_daily_quest_completed",))
 
-    if user_data.get('last_time_daily_quest_completed'):
-        last_time_quest_completed = user_data.get('last_time_daily_quest_completed')
+    if user is not None and user.last_time_daily_quest_completed:
+        last_time_quest_completed = user.last_time_daily_quest_completed
         current_time = datetime.now()
         time_difference = current_time - last_time_quest_completed
 
-        if time_difference >= timedelta(hours=24):
-            updated_balance = update_balance(db, user_id, 1000)
+        if time_difference >= DAILY_QUEST_DURATION:
+            updated_balance = await update_balance(db, user_id, 1000)
         else:
-            updated_balance = update_balance(db, user_id, 500)
+            updated_balance = await update_balance(db, user_id, 500)
     else:
         # Handle the case where last_time_quest_completed is None
         logger.info(f"User {user_id} has no previous claim time. Granting base referral reward.")
-        updated_balance = update_balance(db, user_id, 500)
+        updated_balance = await update_balance(db, user_id, 500)
+
+
+# Quests configured in the system document's quest_types: type -> (button key, user field with the completion time)
+QUEST_TYPES = {
+    "subscribe_tg_channel": ("subscribe_tg_channel_button", "subscribe_channel_quest_time"),
+    "start_another_bot": ("start_another_bot_button", "start_another_bot_quest_time"),
+}
+
+# The user fields get_active_quests reads
+QUEST_FIELDS = ("last_time_daily_quest_completed",) + tuple(field for _, field in QUEST_TYPES.values())
 
+# (common data document the table was compiled from, table)
+_quest_table = (None, ())
 
-def get_active_quests(db, user_id):
-    user_data = db.get_user_data(user_id)
-    common_data = db.get_common_data()
+
+def compile_quest_table(common_data):
+    """
+    Turns the quest_types of the system document into a tuple of (button key, user field, update time).
+
+    The table is cached for the document object it was compiled from; get_common_data returns the same object
+    until the document changes, so it is compiled once per version.
+    """
+    global _quest_table
+
+    compiled_from, table = _quest_table
+    if compiled_from is common_data:
+        return table
+
+    table = tuple(
+        QUEST_TYPES[quest_type["type"]] + (quest_type["update_time"],)
+        for quest_type in (common_data or {}).get("quest_types", ())
+        if quest_type["update_time"] is not None and quest_type.get("type") in QUEST_TYPES
+    )
+    _quest_table = (common_data, table)
+    return table
+
+
+async def get_active_quests(db, user_id):
+    user = await db.get_user(user_id, QUEST_FIELDS)
+    quest_table = compile_quest_table(await db.get_common_data())
     current_time = datetime.now()
     active_quests = []
 
-    daily_quest_completion_time = user_data.get('last_time_daily_quest_completed')
+    daily_quest_completion_time = user.last_time_daily_quest_completed if user else None
 
-    if daily_quest_completion_time is None:
+    if daily_quest_completion_time is None or current_time - daily_quest_completion_time >= DAILY_QUEST_DURATION:
         active_quests.append('daily_quest_button')
-    else:
-        time_difference = current_time - daily_quest_completion_time
-        if time_difference >= timedelta(hours=24):
-            active_quests.append('daily_quest_button')
-
-    if common_data and "quest_types" in common_data:
-        for quest_type in common_data["quest_types"]:
-            if quest_type["update_time"] is not None:
-                if quest_type.get("type") == "subscribe_tg_channel":
-                    subscribe_tg_channel_update_time = quest_type.get("update_time")
-                    quest_completion_time = user_data.get('subscribe_channel_quest_time')
-
-                    if quest_completion_time is None:
-                        active_quests.append('subscribe_tg_channel_button')
-                    else:
-                        if quest_completion_time and subscribe_tg_channel_update_time:
-                            if subscribe_tg_channel_update_time > quest_completion_time:
-                                active_quests.append('subscribe_tg_channel_button')
-
-                elif quest_type.get("type") == "start_another_bot":
-                    start_another_bot_update_time = quest_type.get("update_time")
-                    quest_completion_time = user_data.get('start_another_bot_quest_time')
-
-                    if quest_completion_time is None:
-                        active_quests.append('start_another_bot_button')
-                    else:
-                        if quest_completion_time and start_another_bot_update_time:
-                            if start_another_bot_update_time > quest_completion_time:
-                                active_quests.append('start_another_bot_button')
+
+    for button_key, completion_field, update_time in quest_table:
+        quest_completion_time = getattr(user, completion_field) if user else None
+
+        # A quest is active until completed, and again whenever it is updated after the completion
+        if quest_completion_time is None or (quest_completion_time and update_time
+                                             and update_time > quest_completion_time):
+            active_quests.append(button_key)
 
     return active_quests
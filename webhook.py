@@ -0,0 +1,177 @@
+import asyncio
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import telebot
+from metrics import QUEUE_DEPTH
+
+
+logger = logging.getLogger(__name__)
+
+# Telegram sends the secret_token given to setWebhook in this header
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Updates handed to process_new_updates at once
+UPDATE_BATCH_SIZE = 100
+
+
+def is_valid_secret(received_token, secret_token):
+    return received_token is not None and hmac.compare_digest(received_token.encode(), secret_token.encode())
+
+
+def parse_update(body):
+    return telebot.types.Update.de_json(json.loads(body))
+
+
+class WebhookServer:
+    """
+    Webhook endpoint for the threaded runtime.
+
+    Requests are answered as soon as the secret token is checked and the raw update is queued; a single
+    consumer thread parses queued updates and hands them to TeleBot, whose worker pool runs the handlers.
+    When the queue is full the endpoint answers 503, so Telegram delivers the update again later.
+
+    It can be exercised locally by POSTing a recorded update:
+        curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" --data @update.json http://localhost:8443/telegram
+    """
+
+    def __init__(self, bot, host, port, path, secret_token, queue_size=10000):
+        if not secret_token:
+            raise ValueError("A webhook secret token is required.")
+
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.updates = queue.Queue(maxsize=queue_size)
+        QUEUE_DEPTH.track("webhook", self.updates.qsize)
+        self.http_server = ThreadingHTTPServer((host, port), self._request_handler())
+
+    def _request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                elif not is_valid_secret(self.headers.get(SECRET_TOKEN_HEADER), server.secret_token):
+                    self.send_response(403)
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    try:
+                        server.updates.put_nowait(body)
+                        self.send_response(200)
+                    except queue.Full:
+                        logger.warning("Webhook queue is full, asking Telegram to retry")
+                        self.send_response(503)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # One line per update would drown the application logs
+                pass
+
+        return WebhookRequestHandler
+
+    def _consume(self):
+        while True:
+            bodies = [self.updates.get()]
+            while len(bodies) < UPDATE_BATCH_SIZE:
+                try:
+                    bodies.append(self.updates.get_nowait())
+                except queue.Empty:
+                    break
+
+            updates = []
+            for body in bodies:
+                try:
+                    updates.append(parse_update(body))
+                except (ValueError, KeyError, TypeError):
+                    logger.exception("Dropping malformed update: %r", body[:200])
+
+            try:
+                self.bot.process_new_updates(updates)
+            except Exception:
+                logger.exception("Failed to process %s webhook updates", len(updates))
+
+    def serve_forever(self):
+        threading.Thread(target=self._consume, name="webhook-consumer", daemon=True).start()
+        logger.info("Webhook listening on %s:%s%s", *self.http_server.server_address[:2], self.path)
+        self.http_server.serve_forever()
+
+
+def create_webhook_app(bot, path, secret_token, queue_size=10000):
+    """
+    The aiohttp application of serve_webhook_async, and the consume() coroutine that feeds its queued updates
+    to bot. Nothing drains the queue while consume() isn't running.
+    """
+    from aiohttp import web
+
+    if not secret_token:
+        raise ValueError("A webhook secret token is required.")
+
+    updates = asyncio.Queue(maxsize=queue_size)
+    QUEUE_DEPTH.track("webhook", updates.qsize)
+
+    async def receive_update(request):
+        if not is_valid_secret(request.headers.get(SECRET_TOKEN_HEADER), secret_token):
+            return web.Response(status=403)
+
+        try:
+            updates.put_nowait(await request.read())
+        except asyncio.QueueFull:
+            logger.warning("Webhook queue is full, asking Telegram to retry")
+            return web.Response(status=503)
+
+        return web.Response()
+
+    async def process(parsed_updates):
+        try:
+            await bot.process_new_updates(parsed_updates)
+        except Exception:
+            logger.exception("Failed to process %s webhook updates", len(parsed_updates))
+
+    # Keeps the processing tasks referenced until they finish
+    in_flight = set()
+
+    async def consume():
+        while True:
+            bodies = [await updates.get()]
+            while len(bodies) < UPDATE_BATCH_SIZE and not updates.empty():
+                bodies.append(updates.get_nowait())
+
+            parsed_updates = []
+            for body in bodies:
+                try:
+                    parsed_updates.append(parse_update(body))
+                except (ValueError, KeyError, TypeError):
+                    logger.exception("Dropping malformed update: %r", body[:200])
+
+            # Like AsyncTeleBot's own polling loop, don't wait for the handlers before taking the next batch
+            task = asyncio.create_task(process(parsed_updates))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    return app, consume
+
+
+async def serve_webhook_async(bot, host, port, path, secret_token, queue_size=10000):
+    """
+    Webhook endpoint for the asyncio runtime, on aiohttp. Behaves like WebhookServer, with an asyncio.Queue
+    and a consumer task instead of a thread.
+    """
+    from aiohttp import web
+
+    app, consume = create_webhook_app(bot, path, secret_token, queue_size)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Webhook listening on %s:%s%s", host, port, path)
+
+    try:
+        await consume()
+    finally:
+        await runner.cleanup()